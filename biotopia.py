@@ -13,11 +13,23 @@ Please see accompanied README.
 """
 
 __author__ = "Rodrigo Setti"
-__all__ = ["Creature", "Zoo", "ancestor"]
-
-from copy import copy
-from itertools import cycle, izip_longest, repeat, chain
-from random import sample, randint, random, choice
+__all__ = ["Creature", "Zoo", "Statistics", "Census", "CreatureIndex", "Profile",
+           "ancestor", "pairs"]
+
+import mmap
+import os
+import struct
+from array import array
+from collections import deque, namedtuple
+from heapq import heapify, heappop, heappush, heapreplace, nlargest, nsmallest
+from itertools import izip, izip_longest, repeat, chain, compress, count
+from math import log
+from operator import attrgetter
+import random
+from random import Random
+from threading import Event, Lock, Thread
+from time import time
+from weakref import WeakKeyDictionary, WeakValueDictionary
 
 def neighbours(cell):
     "return the orthogonal neighbours"
@@ -39,205 +51,467 @@ def distance(a, b):
     "Calculates the squared distance of two bi-dimensional points"
     return (a[0]-b[0])**2 + (a[1]-b[1])**2
 
-class Creature(object):
+def pairs(buffer):
+    "Iterate the (x, y) positions of a flat x0, y0, x1, y1... coordinates buffer"
+    return izip(buffer[::2], buffer[1::2])
+
+def analyze(cells, head=(0,0)):
     """
-    A Creature object holds the creature's structure, which is composed of a
-    set of (x,y) of its cells, relative to its head (which is (0,0)).
-    Also, some state information such as energy, age, and position.
+    Find out the mouths and the movement coefficients (horizontal, vertical) of
+    a structure, by visiting its cells from the head. Raises ValueError if the
+    structure is invalid.
     """
+    to_visit = set([head])
+    visited = set()
+    mouths = set()
+
+    vertical = horizontal = 0
+
+    # while there are cells to visit
+    while to_visit:
+
+        # get the next cell
+        cell = to_visit.pop()
+
+        # this one is visited
+        visited.add(cell)
+
+        # get the cell neighbours positions
+        possible_neighs = neighbours(cell)
+        # get actual neighbours
+        cell_neighs = cells.intersection(possible_neighs)
+
+        # if this cell is connecting to more than one, the its closing a
+        # cycle
+        if len(visited.intersection(possible_neighs)) > 1:
+            raise ValueError("Invalid structure: cycle found")
+
+        # determine if this is a movement cell:
+        elif len(cell_neighs) == 1:
+            cell_neigh = next(iter(cell_neighs))
+            if cell_neigh[0] == cell[0] - 1:
+                horizontal -= 1
+            elif cell_neigh[0] == cell[0] + 1:
+                horizontal += 1
+            elif cell_neigh[1] == cell[1] - 1:
+                vertical -= 1
+            elif cell_neigh[1] == cell[1] + 1:
+                vertical += 1
+            else:
+                raise Exception("Unexpected neighbour value")
 
-    def __init__(self, position, cells, head, generation=1, energy=0):
-        """
-        Create a new creature from structure. "cells" is a set of (x,y) tuples
-        representing positions of the cells. "head" is a position, contained in
-        "cells", that is the creature's head.
-        """
-        self.position = position
-        self.cells = set(cells)
-        self.head = head
-        self.generation = generation
-        self.energy = energy
-        self.age = 0
+        # add the unvisited neighbours to be visited
+        to_visit.update(n for n in cell_neighs if n not in visited)
 
-        self.analyze()
+        # determine mouths, by checking the candidates which are not
+        # already mouths, and are not living cells (i.e. are empty)
+        for possible_mounth in (n for n in possible_neighs if n not in cell_neighs and n not in mouths):
 
-    def mirror_horizontal(self):
-        self.cells = set((-c[0], c[1]) for c in self.cells)
-        self.analyze()
+            # checkout the neighbours of this mouth candidate
+            possible_mounth_possible_neighs = neighbours(possible_mounth)
 
-    def mirror_vertical(self):
-        self.cells = set((c[0], -c[1]) for c in self.cells)
-        self.analyze()
+            # if the number of living cell of this possible mouth is more
+            # than 2, the it's a real mounth
+            if len(cells.intersection(possible_mounth_possible_neighs)) >= 3:
+                mouths.add(possible_mounth)
 
-    def rotate_right(self):
-        self.cells = set((c[1], -c[0]) for c in self.cells)
-        self.analyze()
+    # if the total visited cells is less than the actual cells, there are
+    # some unreachable cells
+    if len(visited) < len(cells):
+        raise ValueError("Invalid structure: unconnected cells")
 
-    def rotate_left(self):
-        self.cells = set((-c[1], c[0]) for c in self.cells)
-        self.analyze()
+    return mouths, horizontal, vertical
 
-    def mutate(self):
-        """
-        Perform one of the mutations:
-        - add a new cell in a valid position (one neighbour empty space)
-        - remove a movement cell (one neighbour cell)
-        """
-        if randint(0,1) == 0:
-            return self.add_random_cell()
+def frontier(cells, head=(0,0)):
+    """
+    Find out the growth sites (empty places next to a single cell, where a
+    cell may be added) and the leaves (cells, other than the head, next to a
+    single cell, which may be removed) of a structure, as two sets.
+    """
+    sites = set()
+    leaves = set()
+    for cell in cells:
+        for place in neighbours(cell):
+            if place not in cells and len(cells.intersection(neighbours(place))) == 1:
+                sites.add(place)
+        if cell != head and len(cells.intersection(neighbours(cell))) == 1:
+            leaves.add(cell)
+    return sites, leaves
+
+def update_frontier(cells, sites, leaves, changed, head=(0,0)):
+    """
+    Update the growth sites and leaves of a structure (sets, changed in place)
+    after a "changed" cell was added to or removed from its "cells": only the
+    changed cell and its neighbours may have changed.
+    """
+    for place in chain([changed], neighbours(changed)):
+        sites.discard(place)
+        leaves.discard(place)
+        if len(cells.intersection(neighbours(place))) == 1:
+            if place not in cells:
+                sites.add(place)
+            elif place != head:
+                leaves.add(place)
+
+def update_analysis(cells, changed, mouths, horizontal, vertical):
+    """
+    Update the mouths (a set, changed in place) and the movement coefficients
+    of a structure after a "changed" cell was added to or removed from its
+    "cells", keeping it valid (a growth site added, or a leaf removed): only
+    the changed cell and its neighbours may have changed. Return the new
+    movement coefficients (horizontal, vertical).
+    """
+    added = changed in cells
+    for place in chain([changed], neighbours(changed)):
+        cell_neighs = cells.intersection(neighbours(place))
+        if place == changed:
+            was_cell, previous_neighs = not added, cell_neighs
         else:
-            return self.remove_random_cell() or self.add_random_cell()
-
-    def add_random_cell(self):
-
-        visited_empty_neighs = set()
-
-        # look in every cell, in a random order
-        for cell in sample(self.cells, len(self.cells)):
-
-            # look all possible neighbours of this cell
-            possible_neighs = neighbours(cell)
-
-            # look all empty neighbours of this cell (takes out living cells)
-            empty_neighs = possible_neighs.difference(self.cells)
+            was_cell, previous_neighs = place in cells, cell_neighs.symmetric_difference([changed])
+
+        # take out the movement of the cell before the change, and put in the
+        # one after it (a cell with a single neighbour moves towards it)
+        if was_cell and len(previous_neighs) == 1:
+            neigh = next(iter(previous_neighs))
+            horizontal -= neigh[0] - place[0]
+            vertical -= neigh[1] - place[1]
+        if place in cells and len(cell_neighs) == 1:
+            neigh = next(iter(cell_neighs))
+            horizontal += neigh[0] - place[0]
+            vertical += neigh[1] - place[1]
+
+        # empty places next to 3 or more cells are mouths
+        mouths.discard(place)
+        if place not in cells and len(cell_neighs) >= 3:
+            mouths.add(place)
+
+    return horizontal, vertical
+
+def movement_cycle(horizontal, vertical):
+    """
+    Return the creature's cyclic movement from its coefficients: stands still
+    one cycle, then walks one pixel in each direction while the coefficient
+    allows.
+    """
+    return tuple(chain([(0, 0)],
+                       izip_longest(repeat(sign(horizontal), abs(horizontal)),
+                                    repeat(sign(vertical), abs(vertical)),
+                                    fillvalue = 0)))
+
+#: The eight orientations of a structure (the identity, three rotations, and
+#: the mirrors of those), as the matrices (a, b, c, d) which take a cell (x, y)
+#: to (a*x + b*y, c*x + d*y).
+ORIENTATIONS = ((1, 0, 0, 1), (0, 1, -1, 0), (-1, 0, 0, -1), (0, -1, 1, 0),
+                (-1, 0, 0, 1), (0, 1, 1, 0), (1, 0, 0, -1), (0, -1, -1, 0))
+
+def transform(matrix, cell):
+    "apply an orientation matrix to a cell (or a vector)"
+    return (matrix[0]*cell[0] + matrix[1]*cell[1],
+            matrix[2]*cell[0] + matrix[3]*cell[1])
+
+def compose(first, second):
+    "return the orientation matrix of applying first, then second"
+    return (second[0]*first[0] + second[1]*first[2],
+            second[0]*first[1] + second[1]*first[3],
+            second[2]*first[0] + second[3]*first[2],
+            second[2]*first[1] + second[3]*first[3])
+
+#: For each rotation or mirror operation, the resulting orientation index when
+#: applied to a creature at each of the eight orientations.
+REORIENT = dict((name, tuple(ORIENTATIONS.index(compose(o, matrix)) for o in ORIENTATIONS))
+                for name, matrix in (('mirror_horizontal', (-1, 0, 0, 1)),
+                                     ('mirror_vertical', (1, 0, 0, -1)),
+                                     ('rotate_right', (0, 1, -1, 0)),
+                                     ('rotate_left', (0, -1, 1, 0))))
+
+#: Kinds of creature cells, for rendering: heads, and the bodies of grown,
+#: newborn and dying creatures
+HEAD, BODY, NEWBORN, DYING = range(4)
+
+class Genome(object):
+    """
+    An immutable creature structure, interned: there's only one Genome for all
+    the rotations and mirrors of the same set of cells, shared by every creature
+    with that structure. The cells, mouths and movement cycle of each of the
+    eight orientations are computed only once, when the genome is created.
+    The frontier (growth sites and leaves) is kept too, so mutations are drawn
+    directly from it, and the genomes of mutations are analyzed incrementally
+    from their parents'.
+    """
 
-            # look all non-visited empty neighbours of this cell
-            # (takes out visited)
-            empty_neighs = empty_neighs.difference(visited_empty_neighs)
+    #: every orientation's cells (as frozensets) to its interned genome
+    interned = WeakValueDictionary()
 
-            # look in every empty neighbour of every cell, in a random order
-            for empty_neigh in sample(empty_neighs, len(empty_neighs)):
+    #: sequence for the genomes' identifiers
+    identifiers = count(1)
 
-                # look all possible neighbour of this empty neighbour
-                candidate_possible_neighs = neighbours(empty_neigh)
+    #: whether to check every incremental analysis against a full one (slow)
+    validate = False
 
-                # look all neighbours living cells of this empty neighbour
-                candidate_cell_neighs = self.cells.intersection(candidate_possible_neighs)
+    def __init__(self, cells, parent=None):
+        """
+        Analyze and create a genome from a structure (a set of cells, with the
+        head at (0,0)), which will be its orientation zero. Use Genome.intern
+        instead, to share the existing genome of the structure.
+
+        If the structure is a mutation of another genome, "parent" is that
+        genome, the orientation in which the cells are given, and the changed
+        cell (a growth site added, or a leaf removed): the analysis is then
+        updated from the parent's, around the changed cell only.
+        """
+        cells = frozenset(cells)
+        if parent is None:
+            mouths, horizontal, vertical = analyze(cells)
+            sites, leaves = frontier(cells)
+        else:
+            genome, orientation, changed = parent
+            mouths = set(genome.mouths[orientation])
+            horizontal, vertical = update_analysis(
+                cells, changed, mouths,
+                *transform(ORIENTATIONS[orientation], genome.coefficients))
+            sites, leaves = (set(places) for places in genome.frontier(orientation))
+            update_frontier(cells, sites, leaves, changed)
+            if Genome.validate and ((mouths, horizontal, vertical) != analyze(cells) or
+                                    (sites, leaves) != frontier(cells)):
+                raise AssertionError("Inconsistent incremental analysis: %s" %
+                                     sorted(cells))
+
+        self.id = next(Genome.identifiers)
+        self.cells = tuple(frozenset(transform(m, c) for c in cells)
+                           for m in ORIENTATIONS)
+        self.mouths = tuple(tuple(sorted(transform(m, c) for c in mouths))
+                            for m in ORIENTATIONS)
+        self.coefficients = (horizontal, vertical)
+        self.movements = tuple(movement_cycle(*transform(m, self.coefficients))
+                               for m in ORIENTATIONS)
+        # for rendering: the cells' coordinates, and their kinds for each kind
+        # of body
+        self.layouts = tuple((tuple(x for x, y in variant),
+                              tuple(y for x, y in variant),
+                              tuple(tuple(kind if x or y else HEAD for x, y in variant)
+                                    for kind in xrange(4)))
+                             for variant in self.cells)
+        # the frontier of each orientation (the others on demand), sorted so
+        # random choices don't depend on the sets' internal order
+        self.frontiers = [None] * len(ORIENTATIONS)
+        self.frontiers[0] = (tuple(sorted(sites)), tuple(sorted(leaves)))
+        self._morphology = None
+
+    @staticmethod
+    def intern(cells, parent=None):
+        """
+        Return the genome of a structure (a set of cells with the head at
+        (0,0)), and the orientation in which the genome has those cells.
+        "parent" is passed to the new genome, if one is created.
+        """
+        cells = frozenset(cells)
+        genome = Genome.interned.get(cells)
+        if genome is None:
+            genome = Genome(cells, parent)
+            for variant in genome.cells:
+                Genome.interned.setdefault(variant, genome)
+        return genome, genome.cells.index(cells)
+
+    @property
+    def morphology(self):
+        """
+        The canonical form of the structure, the same for all its rotations
+        and mirrors in any process: the least of its orientations' sorted
+        cells.
+        """
+        if self._morphology is None:
+            self._morphology = min(tuple(sorted(variant)) for variant in self.cells)
+        return self._morphology
+
+    def frontier(self, orientation):
+        "return the sorted growth sites and leaves of an orientation"
+        if self.frontiers[orientation] is None:
+            matrix = ORIENTATIONS[orientation]
+            self.frontiers[orientation] = tuple(tuple(sorted(transform(matrix, c) for c in cells))
+                                                for cells in self.frontiers[0])
+        return self.frontiers[orientation]
 
-                # if there is only one living cell neighbour, then add a new
-                # cell there, analyze and return
-                if len(candidate_cell_neighs) == 1:
-                    self.cells.add(empty_neigh)
-                    self.analyze()
-                    return True
+    def __len__(self):
+        return len(self.cells[0])
 
-            # mark as visited
-            visited_empty_neighs.update(empty_neighs)
+    def __repr__(self):
+        return "<Genome %d, %d cells>" % (self.id, len(self))
 
-        # couldn't add any cell (IMPOSSIBLE!)
-        raise Exception("Unexpected mutation error: could not add cell")
+class Ledger(object):
+    """
+    The cycles elapsed and the energy spent by every creature of a zoo. The
+    creatures keep their energy and age relative to it, so aging a whole
+    population is a single update.
+    """
 
-    def remove_random_cell(self):
+    def __init__(self):
+        self.elapsed = 0
+        self.spent = 0
 
-        # look in every cell, in a random order
-        for cell in sample(self.cells, len(self.cells)):
+    def advance(self, energy_loss):
+        "every creature ages one cycle, and loses some energy"
+        self.elapsed += 1
+        self.spent += energy_loss
 
-            # cannot remove head
-            if cell != self.head:
-                # look all possible neighbours of this cell
-                possible_neighs = neighbours(cell)
+class Creature(object):
+    """
+    A Creature object holds the creature's structure, which is composed of a
+    set of (x,y) of its cells, relative to its head (which is (0,0)).
+    Also, some state information such as energy, age, and position.
 
-                # look all living cell neighbours of this cell
-                cell_neighs = self.cells.intersection(possible_neighs)
+    The structure is an interned Genome, shared with the creature's relatives,
+    plus the index of the creature's orientation (rotation or mirror).
 
-                # if there is only one (movement), remove this cell, analyze and
-                # return
-                if len(cell_neighs) == 1:
-                    self.cells.remove(cell)
-                    self.analyze()
-                    return True
+    The energy and age are kept relative to a Ledger, as the "reserve" (the
+    energy plus the ledger's spent energy: the creature dies once the ledger
+    has spent more) and the cycle it was "born" in the ledger's count.
+    """
 
-        # couldn't remove any (single or no-cells case)
-        return False
+    #: The ledger of the creatures outside a zoo, never advanced
+    ledger = Ledger()
 
-    def analyze(self):
+    def __init__(self, position, cells=None, head=(0,0), generation=1, energy=0,
+                 genome=None, orientation=0, ledger=None):
         """
-        Find out the movement and the mouths from the structure. Must be called
-        each time the structure changes.
+        Create a new creature from structure. "cells" is a set of (x,y) tuples
+        representing positions of the cells. "head" is a position, contained in
+        "cells", that is the creature's head. Alternatively, an existing
+        "genome" and "orientation" may be given instead of the cells.
         """
-        to_visit = set([self.head])
-        visited = set()
-        self.mouths = set()
-
-        vertical = horizontal = 0
-
-        # while there are cells to visit
-        while to_visit:
-
-            # get the next cell
-            cell = to_visit.pop()
-
-            # this one is visited
-            visited.add(cell)
-
-            # get the cell neighbours positions
-            possible_neighs = neighbours(cell)
-            # get actual neighbours
-            cell_neighs = self.cells.intersection(possible_neighs)
-
-            # if this cell is connecting to more than one, the its closing a
-            # cycle
-            if len(visited.intersection(possible_neighs)) > 1:
-                raise ValueError("Invalid structure: cycle found")
+        if ledger is not None:
+            self.ledger = ledger
+        self.position = position
+        self.generation = generation
+        self.energy = energy
+        self.age = 0
+        # the lineage identifier, given when recorded (zero if not)
+        self.id = 0
+
+        if genome is None:
+            # normalize all for head to be at 0,0
+            genome, orientation = Genome.intern((c[0]-head[0], c[1]-head[1])
+                                                for c in cells)
+        self.genome = genome
+        self.head = (0,0)
+        self.orient(orientation)
+
+    @property
+    def energy(self):
+        return self.reserve - self.ledger.spent
+
+    @energy.setter
+    def energy(self, energy):
+        self.reserve = energy + self.ledger.spent
+
+    @property
+    def age(self):
+        return self.ledger.elapsed - self.born
+
+    @age.setter
+    def age(self, age):
+        self.born = self.ledger.elapsed - age
+
+    def transfer(self, ledger):
+        "keep the energy and age relative to another ledger (a zoo's it joins)"
+        energy, age = self.energy, self.age
+        self.ledger = ledger
+        self.energy, self.age = energy, age
+
+    def orient(self, orientation):
+        """
+        Change the creature's orientation, looking up the structure in the
+        genome. The movement cycle is restarted.
+        """
+        self.orientation = orientation
+        self.cells = self.genome.cells[orientation]
+        self.mouths = self.genome.mouths[orientation]
+        self.movements = self.genome.movements[orientation]
+        self.phase = 0
+
+    def next_movement(self):
+        "return the next movement of the creature's cycle"
+        movement = self.movements[self.phase]
+        self.phase = (self.phase + 1) % len(self.movements)
+        return movement
+
+    def replicate(self, position, energy):
+        """
+        Return an offspring: an exact copy of this creature's structure (sharing
+        the same genome) at position, on the next generation.
+        """
+        return Creature(position, generation = self.generation + 1,
+                        energy = energy, genome = self.genome,
+                        orientation = self.orientation, ledger = self.ledger)
 
-            # determine if this is a movement cell:
-            elif len(cell_neighs) == 1:
-                cell_neigh = next(iter(cell_neighs))
-                if cell_neigh[0] == cell[0] - 1:
-                    horizontal -= 1
-                elif cell_neigh[0] == cell[0] + 1:
-                    horizontal += 1
-                elif cell_neigh[1] == cell[1] - 1:
-                    vertical -= 1
-                elif cell_neigh[1] == cell[1] + 1:
-                    vertical += 1
-                else:
-                    raise Exception("Unexpected neighbour value")
+    def mirror_horizontal(self):
+        self.orient(REORIENT['mirror_horizontal'][self.orientation])
 
-            # add the unvisited neighbours to be visited
-            to_visit.update(n for n in cell_neighs if n not in visited)
+    def mirror_vertical(self):
+        self.orient(REORIENT['mirror_vertical'][self.orientation])
 
-            # determine mouths, by checking the candidates which are not
-            # already mouths, and are not living cells (i.e. are empty)
-            for possible_mounth in (n for n in possible_neighs if n not in cell_neighs and n not in self.mouths):
+    def rotate_right(self):
+        self.orient(REORIENT['rotate_right'][self.orientation])
 
-                # checkout the neighbours of this mouth candidate
-                possible_mounth_possible_neighs = neighbours(possible_mounth)
+    def rotate_left(self):
+        self.orient(REORIENT['rotate_left'][self.orientation])
 
-                # if the number of living cell of this possible mouth is more
-                # than 2, the it's a real mounth
-                if len(self.cells.intersection(possible_mounth_possible_neighs)) >= 3:
-                    self.mouths.add(possible_mounth)
+    def restructure(self, cells, changed=None):
+        """
+        Change the creature's structure to a new set of cells. If it is a
+        mutation of the current one, with a single "changed" cell (a growth
+        site added or a leaf removed), a new genome is analyzed incrementally.
+        """
+        parent = None
+        if changed is not None:
+            parent = (self.genome, self.orientation, changed)
+        self.genome, orientation = Genome.intern(cells, parent)
+        self.orient(orientation)
 
-        # if the total visited cells is less than the actual cells, there are
-        # some unreachable cells
-        if len(visited) < len(self.cells):
-            raise ValueError("Invalid structure: unconnected cells")
+    def mutate(self, rng=random):
+        """
+        Perform one of the mutations:
+        - add a new cell in a valid position (one neighbour empty space)
+        - remove a movement cell (one neighbour cell)
+        The choices are drawn from the "rng" random generator.
+        """
+        if rng.randint(0,1) == 0:
+            return self.add_random_cell(rng)
+        else:
+            return self.remove_random_cell(rng) or self.add_random_cell(rng)
 
-        # determine movement:
-        self.movement = cycle(chain([(0, 0)],
-                                    izip_longest(repeat(sign(horizontal), abs(horizontal)),
-                                                 repeat(sign(vertical), abs(vertical)),
-                                                 fillvalue = 0)))
+    def add_random_cell(self, rng=random):
+        "add a cell at a random growth site (an empty space next to one cell)"
+        sites, leaves = self.genome.frontier(self.orientation)
+        site = sites[rng.randrange(len(sites))]
+        self.restructure(self.cells.union([site]), site)
+        return True
 
-        # normalize all for head to be at 0,0
-        if self.head != (0,0):
-            self.cells = set((c[0]-self.head[0], c[1]-self.head[1]) for c in
-                             self.cells)
+    def remove_random_cell(self, rng=random):
+        """
+        Remove a random leaf (a cell next to one cell, other than the head).
+        Returns False if there are none.
+        """
+        sites, leaves = self.genome.frontier(self.orientation)
+        if not leaves:
+            return False
+        leaf = leaves[rng.randrange(len(leaves))]
+        self.restructure(self.cells.difference([leaf]), leaf)
+        return True
 
     def __repr__(self):
         return "<Creature %s, head=%s>" % (self.cells, self.head)
 
-def ancestor(position=(0,0), energy=0):
+def ancestor(position=(0,0), energy=0, rng=random):
     """
-    Return a random oriented default root ancestor.
+    Return a random oriented default root ancestor. The orientation and
+    movement cycle are drawn from the "rng" random generator.
     """
     creature = Creature(position, ((-1,1), (-1,0), (0,0), (1,0), (1,1)),
                         head=(0,0),
                         energy=energy)
 
     # perform a random rotation
-    r = randint(1,4)
+    r = rng.randint(1,4)
     if r == 1:
         creature.rotate_right()
     elif r == 2:
@@ -246,8 +520,8 @@ def ancestor(position=(0,0), energy=0):
         creature.mirror_vertical()
 
     # let creature with a random movement cycle
-    for x in xrange(randint(0,2)):
-        next(creature.movement)
+    for x in xrange(rng.randint(0,2)):
+        creature.next_movement()
 
     return creature
 
@@ -296,6 +570,792 @@ class MultiSet(object):
     def __repr__(self):
         return "<multiset %s>" % ','.join(iter(self))
 
+class ParticleGrid(object):
+    """
+    A multi-set of particles positions, with the same interface of MultiSet,
+    backed by a compact array of counts covering the environment (from (0,0) to
+    "size", inclusive) plus an optional margin all around it. The few particles
+    beyond that (left by creatures' cells at the borders) are kept in an
+    overflow MultiSet. The total count is kept up to date, so its length is
+    O(1). The counts array may be given, e.g. to share it between processes.
+    """
+
+    def __init__(self, size, iterable = [], margin = 0, counts = None):
+        self.width, self.height = size
+        self.margin = margin
+        self.left = self.top = -margin
+        self.right = self.width + margin
+        self.bottom = self.height + margin
+        self.stride = self.height + 1 + 2*margin
+        self.offset = margin * self.stride + margin
+        if counts is None:
+            counts = array('I', [0]) * ((self.width + 1 + 2*margin) * self.stride)
+        self.counts = counts
+        self.overflow = MultiSet()
+        self.total = 0
+        for value in iterable:
+            self.add(value)
+
+    def __contains__(self, value):
+        x, y = value
+        if self.left <= x <= self.right and self.top <= y <= self.bottom:
+            return self.counts[x * self.stride + y + self.offset] > 0
+        return value in self.overflow
+
+    def __len__(self):
+        return self.total
+
+    def add(self, value):
+        "adds this value to the set, incrementing the value's count"
+        x, y = value
+        if self.left <= x <= self.right and self.top <= y <= self.bottom:
+            self.counts[x * self.stride + y + self.offset] += 1
+        else:
+            self.overflow.add(value)
+        self.total += 1
+
+    def remove(self, value):
+        "remove this value from the set, decrementing the value's count"
+        x, y = value
+        if self.left <= x <= self.right and self.top <= y <= self.bottom:
+            self.counts[x * self.stride + y + self.offset] -= 1
+        else:
+            self.overflow.remove(value)
+        self.total -= 1
+
+    def position(self, index):
+        "return the position of an index of the counts array"
+        x, y = divmod(index, self.stride)
+        return (x - self.margin, y - self.margin)
+
+    def __iter__(self):
+        counts = self.counts
+        for index in compress(count(), counts):
+            value = self.position(index)
+            for i in xrange(counts[index]):
+                yield value
+        for value in self.overflow:
+            yield value
+
+    def iter_unique(self):
+        """
+        iterate over the unique values of the set, not repeating if the same
+        value occurs more than once in the set.
+        """
+        for index in compress(count(), self.counts):
+            yield self.position(index)
+        for value in self.overflow.iter_unique():
+            yield value
+
+    def dump(self):
+        """
+        return the non-empty cells of the grid (their indexes and counts), and
+        the overflow particles, as a binary string
+        """
+        indexes = array('I', compress(count(), self.counts))
+        counts = array('I', (self.counts[i] for i in indexes))
+        overflow = [struct.pack('<iiI', x, y, value) for
+                    (x, y), value in self.overflow.items.iteritems()]
+        return ''.join([struct.pack('<QII', len(self.counts), len(indexes),
+                                    len(overflow)),
+                        indexes.tostring(), counts.tostring()] + overflow)
+
+    def restore(self, buffer, offset):
+        """
+        Restore the counts and overflow particles from a binary string (or
+        memory map) written by dump, starting at offset. Returns the offset
+        right after the data.
+        """
+        length, cells, overflow = struct.unpack_from('<QII', buffer, offset)
+        offset += struct.calcsize('<QII')
+        if length != len(self.counts):
+            raise ValueError("Invalid particles: grid size mismatch")
+
+        indexes, counts = array('I'), array('I')
+        indexes.fromstring(buffer[offset:offset + cells * indexes.itemsize])
+        offset += cells * indexes.itemsize
+        counts.fromstring(buffer[offset:offset + cells * counts.itemsize])
+        offset += cells * counts.itemsize
+
+        self.counts = array('I', [0]) * length
+        for index, value in izip(indexes, counts):
+            self.counts[index] = value
+        self.total = sum(counts)
+
+        self.overflow = MultiSet()
+        for i in xrange(overflow):
+            x, y, value = struct.unpack_from('<iiI', buffer, offset)
+            offset += struct.calcsize('<iiI')
+            self.overflow.items[(x, y)] = value
+            self.total += value
+        return offset
+
+    def __repr__(self):
+        return "<particlegrid %s>" % ','.join(str(v) for v in self)
+
+class ParticleChunks(object):
+    """
+    A multi-set of particles positions, with the same interface of
+    ParticleGrid, backed by square chunks of counts ("side" cells wide, a
+    power of two) allocated only when first touched. The chunks cover the
+    environment plus a margin of one chunk all around it; the few particles
+    beyond that are kept in an overflow MultiSet. A new chunk is passed to
+    "touch" (with its index), if given, which may allocate it with its initial
+    particles.
+    """
+
+    def __init__(self, size, side=64, touch=None):
+        self.width, self.height = size
+        self.side = side
+        self.shift = side.bit_length() - 1
+        if side != 1 << self.shift:
+            raise ValueError("The chunk side must be a power of two: %d" % side)
+        self.mask = side - 1
+        self.columns = (self.width + side) // side + 2
+        self.rows = (self.height + side) // side + 2
+        self.chunks = [None] * (self.columns * self.rows)
+        self.touch = touch
+        self.overflow = MultiSet()
+        self.total = 0
+
+    def locate(self, value):
+        "return the chunk index and the place in the chunk of a position, or None"
+        x = value[0] + self.side
+        y = value[1] + self.side
+        column, row = x >> self.shift, y >> self.shift
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return column * self.rows + row, (x & self.mask) << self.shift | (y & self.mask)
+        return None
+
+    def position(self, index, place):
+        "return the position of a place in a chunk"
+        column, row = divmod(index, self.rows)
+        return (((column << self.shift) | (place >> self.shift)) - self.side,
+                ((row << self.shift) | (place & self.mask)) - self.side)
+
+    def chunk(self, index):
+        "return the counts of a chunk, touching it if new"
+        counts = self.chunks[index]
+        if counts is None:
+            if self.touch:
+                self.touch(index)
+            counts = self.chunks[index]
+            if counts is None:
+                counts = self.allocate(index)
+        return counts
+
+    def allocate(self, index, places=()):
+        """
+        allocate a new chunk, with a particle at each of some places (already
+        accounted for in the total)
+        """
+        counts = self.chunks[index] = array('I', [0]) * (self.side * self.side)
+        for place in places:
+            counts[place] += 1
+        return counts
+
+    def __contains__(self, value):
+        located = self.locate(value)
+        if located:
+            index, place = located
+            return self.chunk(index)[place] > 0
+        return value in self.overflow
+
+    def __len__(self):
+        return self.total
+
+    def add(self, value):
+        "adds this value to the set, incrementing the value's count"
+        located = self.locate(value)
+        if located:
+            index, place = located
+            self.chunk(index)[place] += 1
+        else:
+            self.overflow.add(value)
+        self.total += 1
+
+    def remove(self, value):
+        "remove this value from the set, decrementing the value's count"
+        located = self.locate(value)
+        if located:
+            index, place = located
+            self.chunk(index)[place] -= 1
+        else:
+            self.overflow.remove(value)
+        self.total -= 1
+
+    def __iter__(self):
+        "iterate over the values of the set (touching every chunk)"
+        for index in xrange(len(self.chunks)):
+            counts = self.chunk(index)
+            for place in compress(count(), counts):
+                value = self.position(index, place)
+                for i in xrange(counts[place]):
+                    yield value
+        for value in self.overflow:
+            yield value
+
+    def iter_unique(self):
+        """
+        iterate over the unique values of the set, not repeating if the same
+        value occurs more than once in the set (touching every chunk).
+        """
+        for index in xrange(len(self.chunks)):
+            for place in compress(count(), self.chunk(index)):
+                yield self.position(index, place)
+        for value in self.overflow.iter_unique():
+            yield value
+
+    def dump(self):
+        """
+        return the allocated chunks (their indexes, and the places and counts
+        of their non-empty cells), and the overflow particles, as a binary
+        string. The particles of the chunks not yet touched are left to be
+        dumped by their "touch" (see ParticleQuotas).
+        """
+        chunks = []
+        for index, counts in enumerate(self.chunks):
+            if counts is not None:
+                places = array('I', compress(count(), counts))
+                values = array('I', (counts[p] for p in places))
+                chunks.extend([struct.pack('<II', index, len(places)),
+                               places.tostring(), values.tostring()])
+        overflow = [struct.pack('<iiI', x, y, value) for
+                    (x, y), value in self.overflow.items.iteritems()]
+        return ''.join([struct.pack('<III', self.side, len(chunks) // 3,
+                                    len(overflow))] + chunks + overflow)
+
+    def restore(self, buffer, offset):
+        """
+        Restore the allocated chunks and overflow particles from a binary
+        string (or memory map) written by dump, starting at offset; the other
+        chunks are left unallocated. Returns the offset right after the data.
+        """
+        side, allocated, overflow = struct.unpack_from('<III', buffer, offset)
+        offset += struct.calcsize('<III')
+        if side != self.side:
+            raise ValueError("Invalid particles: chunk side mismatch")
+
+        self.chunks = [None] * len(self.chunks)
+        self.total = 0
+        for i in xrange(allocated):
+            index, cells = struct.unpack_from('<II', buffer, offset)
+            offset += struct.calcsize('<II')
+            if index >= len(self.chunks):
+                raise ValueError("Invalid particles: chunk beyond the environment")
+            places, values = array('I'), array('I')
+            places.fromstring(buffer[offset:offset + cells * places.itemsize])
+            offset += cells * places.itemsize
+            values.fromstring(buffer[offset:offset + cells * values.itemsize])
+            offset += cells * values.itemsize
+            counts = self.allocate(index)
+            for place, value in izip(places, values):
+                counts[place] = value
+            self.total += sum(values)
+
+        self.overflow = MultiSet()
+        for i in xrange(overflow):
+            x, y, value = struct.unpack_from('<iiI', buffer, offset)
+            offset += struct.calcsize('<iiI')
+            self.overflow.items[(x, y)] = value
+            self.total += value
+        return offset
+
+    def __repr__(self):
+        return "<particlechunks %s>" % ','.join(str(v) for v in self)
+
+class ParticleQuotas(object):
+    """
+    The particles of the chunks not yet touched of a pair of food and key
+    ParticleChunks (see chunked_particles): how many of each every such chunk
+    holds, and the seed their places are drawn from, with the chunk's index,
+    when it's first touched. It's the "touch" of both.
+    """
+
+    def __init__(self, food, keys, quotas={}, seed=0):
+        self.food = food
+        self.keys = keys
+        # food and key counts of the untouched chunks, by index (the chunks
+        # not found hold no particles)
+        self.quotas = dict(quotas)
+        self.seed = seed
+
+    def extent(self, index):
+        """
+        return the cells of the environment in a chunk, as the ranges of their
+        columns and rows within the chunk
+        """
+        side = self.food.side
+        column, row = divmod(index, self.food.rows)
+        x, y = (column - 1) * side, (row - 1) * side
+        width, height = self.food.width + 1, self.food.height + 1
+        return (max(0, -x), max(0, min(side, width - x)),
+                max(0, -y), max(0, min(side, height - y)))
+
+    def __call__(self, index):
+        "allocate a chunk just touched, with its particles, in both sets"
+        food_count, key_count = self.quotas.pop(index, (0, 0))
+        left, right, top, bottom = self.extent(index)
+        rows = bottom - top
+        shift = self.food.shift
+        places = [(left + p // rows) << shift | (top + p % rows) for p in
+                  Random(self.seed + index).sample(xrange((right - left) * rows),
+                                                   food_count + key_count)]
+        self.food.allocate(index, places[:food_count])
+        self.keys.allocate(index, places[food_count:])
+
+    def dump(self):
+        """
+        return the seed and the food and key counts of the untouched chunks,
+        as a binary string
+        """
+        indexes = array('I', sorted(self.quotas))
+        food = array('I', (self.quotas[i][0] for i in indexes))
+        keys = array('I', (self.quotas[i][1] for i in indexes))
+        return ''.join([struct.pack('<QI', self.seed, len(indexes)),
+                        indexes.tostring(), food.tostring(), keys.tostring()])
+
+    def restore(self, buffer, offset):
+        """
+        Restore the seed and the counts of the untouched chunks from a binary
+        string (or memory map) written by dump, starting at offset, adding
+        them to the totals of the sets. Returns the offset right after the
+        data.
+        """
+        self.seed, length = struct.unpack_from('<QI', buffer, offset)
+        offset += struct.calcsize('<QI')
+        columns = []
+        for i in xrange(3):
+            values = array('I')
+            values.fromstring(buffer[offset:offset + length * values.itemsize])
+            offset += length * values.itemsize
+            columns.append(values)
+        indexes, food, keys = columns
+        for index in indexes:
+            if index >= len(self.food.chunks) or self.food.chunks[index] is not None:
+                raise ValueError("Invalid particles: chunk quota mismatch")
+        self.quotas = dict(izip(indexes, izip(food, keys)))
+        self.food.total += sum(food)
+        self.keys.total += sum(keys)
+        return offset
+
+def chunked_particles(size, start_food, start_keys, seed, side=64):
+    """
+    Return food and key ParticleChunks of an environment, with "start_food"
+    and "start_keys" particles scattered at distinct random places. How many
+    of each every chunk holds is drawn from "seed" at once; their places only
+    when the chunk is first touched, from the seed and the chunk's index, so
+    the particles are always the same whatever the order chunks are touched.
+    """
+    food = ParticleChunks(size, side)
+    keys = ParticleChunks(size, side)
+    food.total, keys.total = start_food, start_keys
+    width, height = size[0] + 1, size[1] + 1
+    if start_food + start_keys > width * height:
+        raise ValueError("Too many particles for the environment")
+    touch = ParticleQuotas(food, keys)
+
+    # the particles of each chunk: its proportional share (rounded down), and
+    # the rest scattered at random over the environment, one by one
+    rng = Random(seed)
+    quotas = [[0, 0] for index in xrange(len(food.chunks))]
+    areas = []
+    for index in xrange(len(food.chunks)):
+        left, right, top, bottom = touch.extent(index)
+        areas.append((right - left) * (bottom - top))
+    area = width * height
+    for kind, total in enumerate((start_food, start_keys)):
+        for index, chunk_area in enumerate(areas):
+            quotas[index][kind] = total * chunk_area // area
+        remaining = total - sum(quota[kind] for quota in quotas)
+        while remaining:
+            index, place = food.locate((rng.randrange(width), rng.randrange(height)))
+            if sum(quotas[index]) < areas[index]:
+                quotas[index][kind] += 1
+                remaining -= 1
+
+    touch.seed = rng.getrandbits(32) * len(quotas)
+    touch.quotas = dict((index, tuple(quota)) for index, quota in
+                        enumerate(quotas) if quota != [0, 0])
+    food.touch = keys.touch = touch
+    return food, keys
+
+class Histogram(object):
+    """
+    A multi-set of numbers, with their count and total, and their minimum and
+    maximum found in amortized constant time: values are pushed to a pair of
+    heaps when they first appear, and popped only when found to be gone.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.length = 0
+        self.total = 0
+        self.low = []
+        self.high = []
+
+    def __len__(self):
+        return self.length
+
+    def add(self, value):
+        counts = self.counts
+        present = counts.get(value, 0)
+        counts[value] = present + 1
+        self.length += 1
+        self.total += value
+        if not present:
+            if len(self.low) > 2 * len(counts) + 16:
+                # too many stale values: rebuild the heaps
+                self.low = list(counts)
+                self.high = [-v for v in counts]
+                heapify(self.low)
+                heapify(self.high)
+            else:
+                heappush(self.low, value)
+                heappush(self.high, -value)
+
+    def remove(self, value):
+        counts = self.counts
+        present = counts[value]
+        if present > 1:
+            counts[value] = present - 1
+        else:
+            del counts[value]
+        self.length -= 1
+        self.total -= value
+
+    def minimum(self):
+        low, counts = self.low, self.counts
+        while low[0] not in counts:
+            heappop(low)
+        return low[0]
+
+    def maximum(self):
+        high, counts = self.high, self.counts
+        while -high[0] not in counts:
+            heappop(high)
+        return -high[0]
+
+def entropy_term(n):
+    return n * log(n) if n else 0.0
+
+class Census(object):
+    """
+    The population of each species: creatures with the same structure (in any
+    rotation or mirror), that is, the same interned Genome. The sums behind
+    the diversity indexes are kept along, so they're found in constant time.
+    """
+
+    def __init__(self, counts={}):
+        self.counts = dict(counts)
+        self.length = sum(self.counts.itervalues())
+        self.squares = sum(n * n for n in self.counts.itervalues())
+        self.entropy = sum(entropy_term(n) for n in self.counts.itervalues())
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, genome):
+        counts = self.counts
+        present = counts.get(genome, 0)
+        counts[genome] = present + 1
+        self.length += 1
+        self.squares += 2 * present + 1
+        self.entropy += entropy_term(present + 1) - entropy_term(present)
+
+    def remove(self, genome):
+        counts = self.counts
+        present = counts[genome]
+        if present > 1:
+            counts[genome] = present - 1
+        else:
+            del counts[genome]
+        self.length -= 1
+        self.squares -= 2 * present - 1
+        self.entropy -= entropy_term(present) - entropy_term(present - 1)
+
+    def top(self, k):
+        "return the k most populous species, as (genome, population) pairs"
+        return nlargest(k, self.counts.iteritems(),
+                        key=lambda item: (item[1], -item[0].id))
+
+    def diversity(self):
+        """
+        Return the number of species, and the Shannon (natural logarithm) and
+        Gini-Simpson diversity indexes.
+        """
+        if not self.length:
+            return (0, 0.0, 0.0)
+        total = float(self.length)
+        return (len(self.counts),
+                max(log(total) - self.entropy / total, 0.0),
+                1 - self.squares / (total * total))
+
+class Statistics(object):
+    """
+    The age, mouths, energy and generation aggregates of the creatures of a
+    Zoo, kept up to date by the zoo as creatures are born, eat, age and die.
+    Each one is queried as a (minimum, average, maximum) tuple. The species
+    census is kept too.
+
+    The creatures' ages and energies are kept as the cycles they were born and
+    their reserves, relative to the "ledger" they keep them in (a zoo's), so
+    aging a whole population needs no update.
+    """
+
+    def __init__(self, creatures=[], ledger=Creature.ledger):
+        self.ledger = ledger
+        self.ages = Histogram()
+        self.mouth_counts = Histogram()
+        self.energies = Histogram()
+        self.generations = Histogram()
+        self.species = Census()
+        for creature in creatures:
+            self.add(creature)
+
+    @property
+    def population(self):
+        return len(self.generations)
+
+    def add(self, creature):
+        "track a creature"
+        self.ages.add(-creature.born)
+        self.mouth_counts.add(len(creature.mouths))
+        self.energies.add(creature.reserve)
+        self.generations.add(creature.generation)
+        self.species.add(creature.genome)
+
+    def remove(self, creature):
+        "stop tracking a creature"
+        self.ages.remove(-creature.born)
+        self.mouth_counts.remove(len(creature.mouths))
+        self.energies.remove(creature.reserve)
+        self.generations.remove(creature.generation)
+        self.species.remove(creature.genome)
+
+    def update_energy(self, creature, energy):
+        "change the energy of a tracked creature"
+        self.energies.remove(creature.reserve)
+        creature.energy = energy
+        self.energies.add(creature.reserve)
+
+    def summary(self, histogram, shift=0):
+        if not histogram:
+            return (0, 0.0, 0)
+        return (histogram.minimum() + shift,
+                histogram.total / float(len(histogram)) + shift,
+                histogram.maximum() + shift)
+
+    @property
+    def age(self):
+        return self.summary(self.ages, self.ledger.elapsed)
+
+    @property
+    def mouths(self):
+        return self.summary(self.mouth_counts)
+
+    @property
+    def energy(self):
+        return self.summary(self.energies, -self.ledger.spent)
+
+    @property
+    def generation(self):
+        return self.summary(self.generations)
+
+    @property
+    def diversity(self):
+        "the number of species, and the Shannon and Gini-Simpson indexes"
+        return self.species.diversity()
+
+    def top_species(self, k):
+        "return the k most populous species, as (genome, population) pairs"
+        return self.species.top(k)
+
+class CreatureIndex(object):
+    """
+    The creatures of an environment in a uniform grid of square buckets, by
+    position, so nearest neighbours and region queries only visit the buckets
+    around the queried place. Creatures beyond the environment are kept in the
+    buckets of its border. Only the occupied buckets are kept, by place.
+    """
+
+    def __init__(self, size, creatures=[], bucket=16):
+        self.size = size
+        self.bucket = bucket
+        self.columns = size[0] // bucket + 1
+        self.rows = size[1] // bucket + 1
+        self.buckets = {}
+        self.places = {}
+        for creature in creatures:
+            self.add(creature)
+
+    def __len__(self):
+        return len(self.places)
+
+    def __contains__(self, creature):
+        return creature in self.places
+
+    def __iter__(self):
+        return iter(self.places)
+
+    def cell(self, position):
+        "return the (column, row) of the bucket of a position"
+        return (min(max(position[0] // self.bucket, 0), self.columns - 1),
+                min(max(position[1] // self.bucket, 0), self.rows - 1))
+
+    def add(self, creature):
+        column, row = self.cell(creature.position)
+        place = self.places[creature] = column * self.rows + row
+        self.enter(creature, place)
+
+    def remove(self, creature):
+        self.leave(creature, self.places.pop(creature))
+
+    def enter(self, creature, place):
+        bucket = self.buckets.get(place)
+        if bucket is None:
+            bucket = self.buckets[place] = set()
+        bucket.add(creature)
+
+    def leave(self, creature, place):
+        bucket = self.buckets[place]
+        bucket.remove(creature)
+        if not bucket:
+            del self.buckets[place]
+
+    def move(self, creature, place=None):
+        """
+        Update the bucket of a creature, after its position changed. The
+        bucket's place (column * rows + row) may be given, if already known.
+        """
+        if place is None:
+            column, row = self.cell(creature.position)
+            place = column * self.rows + row
+        previous = self.places[creature]
+        if place != previous:
+            self.leave(creature, previous)
+            self.enter(creature, place)
+            self.places[creature] = place
+
+    def within(self, left, top, right, bottom):
+        "return the creatures within a rectangle (inclusive)"
+        first_column, first_row = self.cell((left, top))
+        last_column, last_row = self.cell((right, bottom))
+        found = []
+        for column in xrange(first_column, last_column + 1):
+            for row in xrange(first_row, last_row + 1):
+                for creature in self.buckets.get(column * self.rows + row, ()):
+                    x, y = creature.position
+                    if left <= x <= right and top <= y <= bottom:
+                        found.append(creature)
+        return found
+
+    def k_nearest(self, position, k):
+        """
+        Return the k creatures nearest to a position, nearest first. The
+        buckets are visited in rings around the position's bucket, until no
+        unvisited bucket can hold a nearer creature.
+        """
+        center_column, center_row = self.cell(position)
+        best = [] # heap of (-squared distance, sequence, creature)
+        sequence = count()
+        for ring in xrange(max(self.columns, self.rows)):
+            for column in xrange(center_column - ring, center_column + ring + 1):
+                if not 0 <= column < self.columns:
+                    continue
+                step = 1 if abs(column - center_column) == ring else 2 * ring
+                for row in xrange(center_row - ring, center_row + ring + 1, step or 1):
+                    if not 0 <= row < self.rows:
+                        continue
+                    for creature in self.buckets.get(column * self.rows + row, ()):
+                        entry = (-distance(creature.position, position),
+                                 next(sequence), creature)
+                        if len(best) < k:
+                            heappush(best, entry)
+                        elif entry[0] > best[0][0]:
+                            heapreplace(best, entry)
+            # creatures in the next ring are farther than this
+            if len(best) == k and -best[0][0] <= (ring * self.bucket) ** 2:
+                break
+        return [creature for d, s, creature in sorted(best, reverse=True)]
+
+    def nearest(self, position):
+        "return the creature nearest to a position, or None if there are none"
+        found = self.k_nearest(position, 1)
+        return found[0] if found else None
+
+class Profile(object):
+    """
+    The wall time and event counts of the steps of a Zoo, accumulated by phase
+    while the zoo is profiled: probing the mouths (and eating), reproduction
+    (replication, mutation and rotation), movement (and bouncing or wrapping)
+    and death (leaving the remains). The rest of a step, bookkeeping, is
+    "other".
+    """
+
+    #: The phases of a step, in order
+    PHASES = ('mouths', 'reproduction', 'movement', 'death')
+
+    #: The events counted
+    EVENTS = ('foods', 'births', 'mutations', 'bounces', 'deaths')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        "start accumulating again"
+        self.steps = 0
+        self.creature_steps = 0
+        self.elapsed = 0.0
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.counts = dict.fromkeys(self.EVENTS, 0)
+
+    def report(self):
+        "return a readable report of the accumulated times and counts, as lines"
+        lines = ["%d steps, %d creature steps in %.3f s (%.2f usec/creature step)" %
+                 (self.steps, self.creature_steps, self.elapsed,
+                  self.elapsed * 1e6 / self.creature_steps if self.creature_steps else 0.0)]
+        other = self.elapsed - sum(self.times.itervalues())
+        for phase, spent in [(p, self.times[p]) for p in self.PHASES] + [('other', other)]:
+            lines.append("%-12s %9.3f s %5.1f%%" %
+                         (phase, spent, 100 * spent / self.elapsed if self.elapsed else 0.0))
+        lines.append(" ".join("%s: %d" % (e, self.counts[e]) for e in self.EVENTS))
+        return lines
+
+def resident_memory():
+    "return the resident memory of the process, in bytes (None if unknown)"
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+#: How often (in cycles) a zoo with a memory budget checks the memory
+MEMORY_CHECK_EVERY = 64
+
+def report_changes(zoo):
+    "call a zoo's particle callbacks with the changes of the last step"
+    for callback, changes in ((zoo.del_food_callback, zoo.food_removed),
+                              (zoo.del_key_callback, zoo.keys_removed),
+                              (zoo.new_food_callback, zoo.food_added),
+                              (zoo.new_key_callback, zoo.keys_added)):
+        if callback:
+            for position in pairs(changes):
+                callback(position)
+
+#: Checkpoint files signature and format version
+CHECKPOINT_MAGIC = 'BIOTOPIA'
+CHECKPOINT_VERSION = 5
+
+#: Checkpoint header: magic, version, size, offspring energy, energy loss,
+#: energy gain, vertical and horizontal wrapping, mutation probability, cycle
+#: count, and side of the particles chunks (zero for particle grids)
+CHECKPOINT_HEADER = '<8sHiiqqq??dQI'
+
+#: Checkpoint creature record: genome index, orientation, movement phase,
+#: position, energy, age, generation and lineage identifier
+CHECKPOINT_CREATURE = '<IBIiiqqqQ'
+
 class Zoo(object):
     """
     Holds a complete simulation with a set of creatures, foods and key
@@ -307,8 +1367,22 @@ class Zoo(object):
                  start_food, start_keys,
                  energy_loss=1, energy_gain=10,
                  wrap_vertical=False, wrap_horizontal=False,
-                 mutation_probability = 0.2):
-        self.creatures = set(descendants)
+                 mutation_probability = 0.2, seed=None, chunk=0):
+        """
+        Create a new simulation. All the random choices are drawn from the
+        zoo's own random generator, seeded with "seed": the same seed (and
+        parameters) always yields the same simulation. The creatures are kept
+        in a list, so they are always stepped in the same order.
+
+        If "chunk" is given, the particles are kept in chunks of that side,
+        generated when first touched (see chunked_particles), so even huge
+        environments start at once, and take memory only where touched.
+        """
+        self.creatures = list(descendants)
+        # the creatures' energies and ages are kept relative to the ledger
+        self.ledger = Ledger()
+        for creature in self.creatures:
+            creature.transfer(self.ledger)
         self.size = size
         self.offspring_energy = offspring_energy
         self.energy_loss = energy_loss
@@ -316,145 +1390,528 @@ class Zoo(object):
         self.wrap_horizontal = wrap_horizontal
         self.wrap_vertical = wrap_vertical
         self.mutation_probability = mutation_probability
-
-        self.food = MultiSet()
-        for i in xrange(start_food):
-            while True:
-                new_food = (randint(0,size[0]), randint(0,size[1]))
-                if new_food not in self.food:
-                    self.food.add(new_food)
-                    break
-
-        self.keys = MultiSet()
-        for i in xrange(start_keys):
-            while True:
-                new_key = (randint(0,size[0]), randint(0,size[1]))
-                if new_key not in self.keys and new_key not in self.food:
-                    self.keys.add(new_key)
-                    break
-
+        self.cycle = 0
+        self.random = Random(seed)
+        self.statistics = Statistics(self.creatures, self.ledger)
+        self.index = CreatureIndex(size, self.creatures)
+
+        if chunk:
+            self.food, self.keys = chunked_particles(size, start_food, start_keys,
+                                                     self.random.getrandbits(32),
+                                                     chunk)
+        else:
+            self.food = ParticleGrid(size)
+            for i in xrange(start_food):
+                while True:
+                    new_food = (self.random.randint(0,size[0]), self.random.randint(0,size[1]))
+                    if new_food not in self.food:
+                        self.food.add(new_food)
+                        break
+
+            self.keys = ParticleGrid(size)
+            for i in xrange(start_keys):
+                while True:
+                    new_key = (self.random.randint(0,size[0]), self.random.randint(0,size[1]))
+                    if new_key not in self.keys and new_key not in self.food:
+                        self.keys.add(new_key)
+                        break
+
+        # the particles added and removed in the last step, as flat
+        # x0, y0, x1, y1... coordinates buffers
+        self.food_added = array('i')
+        self.food_removed = array('i')
+        self.keys_added = array('i')
+        self.keys_removed = array('i')
+
+        # also reported to these, if set, after each step
         self.new_food_callback = None
         self.del_food_callback = None
         self.new_key_callback = None
         self.del_key_callback = None
 
+        # the Profile the steps are accumulated to, if set
+        self.profile = None
+
+        # the recorder the births are recorded to, if set (a
+        # biotopia_lineage.LineageRecorder)
+        self.lineage = None
+        # the lineage identifiers of the genomes recorded (shared with the
+        # recorder, see LineageRecorder.attach), kept in checkpoints
+        self.genome_ids = WeakKeyDictionary()
+
+        # the population cap, if set (see step), and the resident memory
+        # budget, in bytes, that caps the population once exceeded
+        self.population_cap = 0
+        self.cull = False
+        self.memory_budget = 0
+        # whether the cap was reached, and the births refused and creatures
+        # culled since (a key refused counts once, however many creatures
+        # probe it, until a key is eaten at its position)
+        self.capped = False
+        self.refused = 0
+        self.culled = 0
+        self.refused_keys = set()
+        # called with a message when the cap is first reached, or the memory
+        # budget exceeded, if set
+        self.warning_callback = None
+
+    def populate(self, amount, energy):
+        "add an amount of ancestors, at random positions, with some energy"
+        for i in xrange(amount):
+            position = (self.random.randint(0, self.size[0]),
+                        self.random.randint(0, self.size[1]))
+            creature = ancestor(position, energy, self.random)
+            creature.transfer(self.ledger)
+            self.creatures.append(creature)
+            self.statistics.add(creature)
+            self.index.add(creature)
+
     def step(self):
         """
-        Perform one step of the simulation.
+        Perform one step of the simulation. The statistics and the index of
+        the creatures are updated along, and the particle changes are
+        collected in the buffers. If profiled, the time of each phase and the
+        events are accumulated to the profile (otherwise, at the cost of a few
+        tests per creature). Births are recorded to the lineage, if set.
+
+        If the population is capped, births are refused while the population
+        is at the cap (the keys are left alone, and each counted once as a
+        refused birth, see refused_keys), or, if "cull" is set, the
+        creatures with the least energy in excess of the cap die at the end
+        of the step (leaving their remains, as any death). Either way, the
+        warning callback is called the first time the cap is reached.
         """
-        survivors = set()
+        profile = self.profile
+        lineage = self.lineage
+        if profile:
+            step_start = time()
+            population = len(self.creatures)
+        survivors = []
+        food_added, food_removed = array('i'), array('i')
+        keys_added, keys_removed = array('i'), array('i')
+
+        statistics, index, ledger = self.statistics, self.index, self.ledger
+        if statistics.population != len(self.creatures):
+            # the creatures were changed by hand
+            for creature in self.creatures:
+                if creature.ledger is not ledger:
+                    creature.transfer(ledger)
+            statistics = self.statistics = Statistics(self.creatures, ledger)
+            index = self.index = CreatureIndex(self.size, self.creatures)
+        # every creature ages and loses energy in this step: a creature whose
+        # reserve is below the energy spent is dead
+        ledger.advance(self.energy_loss)
+        energy_spent = ledger.spent
+        # births are refused at this population, unless culling
+        refuse = 0 if self.cull else self.population_cap
+        refused = 0
+        refused_keys = self.refused_keys
+
+        # the particles grids are probed inline, for speed (chunked particles
+        # are probed through their interface, as if beyond the grid)
+        food, keys = self.food, self.keys
+        if isinstance(food, ParticleGrid):
+            food_counts, key_counts = food.counts, keys.counts
+            left, top, right, bottom = food.left, food.top, food.right, food.bottom
+            stride, offset = food.stride, food.offset
+        else:
+            left, top, right, bottom = 0, 0, -1, -1
+        # and so are the buckets of the index (survivors are always within
+        # the environment, so their buckets need no clamping)
+        places, bucket, rows = index.places, index.bucket, index.rows
 
         for creature in self.creatures:
-            creature.energy -= self.energy_loss
-            creature.age += 1
+            if profile:
+                mark = time()
 
             for mouth in creature.mouths:
                 # calculate absolute mouth position
-                mouth_position = (mouth[0] + creature.position[0],
-                                  mouth[1] + creature.position[1])
+                x = mouth[0] + creature.position[0]
+                y = mouth[1] + creature.position[1]
+
+                if left <= x <= right and top <= y <= bottom:
+                    place = x * stride + y + offset
+                    has_food = food_counts[place]
+                    has_key = key_counts[place]
+                    if not (has_food or has_key):
+                        continue
+                    mouth_position = (x, y)
+                else:
+                    mouth_position = (x, y)
+                    has_food = mouth_position in food
+                    has_key = mouth_position in keys
 
-                if mouth_position in self.food:
+                if has_food:
                     # remove food particle from soup
-                    self.food.remove(mouth_position)
-                    if self.del_food_callback:
-                        self.del_food_callback(mouth_position)
+                    food.remove(mouth_position)
+                    food_removed.extend(mouth_position)
 
                     # increment creature's energy
-                    creature.energy += self.energy_gain
-                if mouth_position in self.keys:
+                    statistics.update_energy(creature, creature.energy +
+                                             self.energy_gain)
+                if has_key and refuse and statistics.population >= refuse:
+                    if mouth_position not in refused_keys:
+                        refused_keys.add(mouth_position)
+                        refused += 1
+                elif has_key:
+                    if profile:
+                        born = time()
                     # remove key particle from soup
-                    self.keys.remove(mouth_position)
-                    if self.del_key_callback:
-                        self.del_key_callback(mouth_position)
+                    keys.remove(mouth_position)
+                    keys_removed.extend(mouth_position)
+                    if refused_keys:
+                        refused_keys.discard(mouth_position)
 
                     # create a copy of current creature with start energy
-                    new_creature = Creature(mouth_position,
-                                            copy(creature.cells),
-                                            creature.head,
-                                            generation = creature.generation + 1,
-                                            energy = self.offspring_energy)
+                    new_creature = creature.replicate(mouth_position,
+                                                      self.offspring_energy)
 
                     # mutate with probability
-                    if random() < self.mutation_probability:
-                        new_creature.mutate()
+                    mutated = self.random.random() < self.mutation_probability
+                    if mutated:
+                        new_creature.mutate(self.random)
+                        if profile:
+                            profile.counts['mutations'] += 1
 
                     # turn to a random direction (left or right)
-                    if randint(1,2) == 1:
+                    if self.random.randint(1,2) == 1:
                         new_creature.rotate_left()
                     else:
                         new_creature.rotate_right()
-                    survivors.add(new_creature)
-
+                    survivors.append(new_creature)
+                    statistics.add(new_creature)
+                    index.add(new_creature)
+                    if lineage:
+                        lineage.birth(new_creature, creature, mutated,
+                                      self.cycle + 1)
+                    if profile:
+                        # not part of the mouths phase
+                        spent = time() - born
+                        profile.times['reproduction'] += spent
+                        mark += spent
+
+            if profile:
+                now = time()
+                profile.times['mouths'] += now - mark
+                mark = now
 
             # move
-            try:
-                movement = next(creature.movement)
-                creature.position = (creature.position[0] + movement[0],
-                                     creature.position[1] + movement[1])
-
-                # colide or wrap horizontally
-                if creature.position[0] < 0:
-                    if self.wrap_horizontal:
-                        creature.position = (creature.position[0] + self.size[0],
-                                             creature.position[1])
-                    else:
-                        creature.position = (0, creature.position[1])
-                        creature.mirror_horizontal()
-                elif creature.position[0] > self.size[0]:
-                    if self.wrap_horizontal:
-                        creature.position = (creature.position[0] - self.size[0],
-                                             creature.position[1])
-                    else:
-                        creature.position = (self.size[0], creature.position[1])
-                        creature.mirror_horizontal()
-
-                # colide or wrap vertically
-                if creature.position[1] < 0:
-                    if self.wrap_vertical:
-                        creature.position = (creature.position[0],
-                                             creature.position[1] + self.size[1])
-                    else:
-                        creature.position = (creature.position[0], 0)
-                        creature.mirror_vertical()
-                elif creature.position[1] > self.size[1]:
-                    if self.wrap_vertical:
-                        creature.position = (creature.position[0],
-                                             creature.position[1] - self.size[1])
-                    else:
-                        creature.position = (creature.position[0], self.size[1])
-                        creature.mirror_vertical()
+            movement = creature.next_movement()
+            creature.position = (creature.position[0] + movement[0],
+                                 creature.position[1] + movement[1])
+
+            # colide or wrap horizontally
+            if creature.position[0] < 0:
+                if self.wrap_horizontal:
+                    creature.position = (creature.position[0] + self.size[0],
+                                         creature.position[1])
+                else:
+                    creature.position = (0, creature.position[1])
+                    creature.mirror_horizontal()
+                    if profile:
+                        profile.counts['bounces'] += 1
+            elif creature.position[0] > self.size[0]:
+                if self.wrap_horizontal:
+                    creature.position = (creature.position[0] - self.size[0],
+                                         creature.position[1])
+                else:
+                    creature.position = (self.size[0], creature.position[1])
+                    creature.mirror_horizontal()
+                    if profile:
+                        profile.counts['bounces'] += 1
+
+            # colide or wrap vertically
+            if creature.position[1] < 0:
+                if self.wrap_vertical:
+                    creature.position = (creature.position[0],
+                                         creature.position[1] + self.size[1])
+                else:
+                    creature.position = (creature.position[0], 0)
+                    creature.mirror_vertical()
+                    if profile:
+                        profile.counts['bounces'] += 1
+            elif creature.position[1] > self.size[1]:
+                if self.wrap_vertical:
+                    creature.position = (creature.position[0],
+                                         creature.position[1] - self.size[1])
+                else:
+                    creature.position = (creature.position[0], self.size[1])
+                    creature.mirror_vertical()
+                    if profile:
+                        profile.counts['bounces'] += 1
 
-            except StopIteration:
-                pass
+            if profile:
+                now = time()
+                profile.times['movement'] += now - mark
+                mark = now
 
             # creature dies if is beyond the life expectancy, and the energy
             # level is less or equal than zero - for energy balance
-            if creature.energy < 0:
-                # dying creature, will not go to the next step, and will leave
-                # a trace of food for each of its cells and head as key
-                for cell in creature.cells:
-                    absolute_pos = (creature.position[0] + cell[0],
-                                    creature.position[1] + cell[1])
-                    if cell == creature.head:
-                        self.keys.add(absolute_pos)
-                        if self.new_key_callback:
-                            self.new_key_callback(absolute_pos)
-                    else:
-                        self.food.add(absolute_pos)
-                        if self.new_food_callback:
-                            self.new_food_callback(absolute_pos)
+            if creature.reserve < energy_spent:
+                # dying creature, will not go to the next step
+                self.bury(creature, food_added, keys_added)
+                if profile:
+                    profile.times['death'] += time() - mark
             else:
-                survivors.add(creature)
+                survivors.append(creature)
+                place = (creature.position[0] // bucket * rows +
+                         creature.position[1] // bucket)
+                if place != places[creature]:
+                    index.move(creature, place)
+
+        culled = 0
+        if self.cull and self.population_cap and len(survivors) > self.population_cap:
+            culled = len(survivors) - self.population_cap
+            for creature in nsmallest(culled, survivors, key=attrgetter('reserve')):
+                self.bury(creature, food_added, keys_added)
+            survivors = [c for c in survivors if c in index]
+        if (refused or culled) and not self.capped:
+            self.capped = True
+            self.warn("population cap of %d reached: %s" %
+                      (self.population_cap,
+                       "culling the creatures with the least energy" if culled else
+                       "refusing births"))
+        self.refused += refused
+        self.culled += culled
 
         self.creatures = survivors
+        self.cycle += 1
+        if self.memory_budget and self.cycle % MEMORY_CHECK_EVERY == 0:
+            self.check_memory()
+
+        self.food_added, self.food_removed = food_added, food_removed
+        self.keys_added, self.keys_removed = keys_added, keys_removed
+        if profile:
+            # every food and key eaten is a food and a birth, and every
+            # death leaves a key
+            profile.counts['foods'] += len(food_removed) // 2
+            profile.counts['births'] += len(keys_removed) // 2
+            profile.counts['deaths'] += len(keys_added) // 2
+            profile.creature_steps += population
+            profile.steps += 1
+            profile.elapsed += time() - step_start
+        report_changes(self)
+
+    def bury(self, creature, food_added, keys_added):
+        """
+        Remove a dead creature, leaving a trace of food for each of its cells
+        and its head as key (added to the particle changes buffers).
+        """
+        self.statistics.remove(creature)
+        self.index.remove(creature)
+        for cell in creature.cells:
+            absolute_pos = (creature.position[0] + cell[0],
+                            creature.position[1] + cell[1])
+            if cell == creature.head:
+                self.keys.add(absolute_pos)
+                keys_added.extend(absolute_pos)
+            else:
+                self.food.add(absolute_pos)
+                food_added.extend(absolute_pos)
 
-if __name__  == "__main__":
-    import sys
-    import pygame
-    from pygame.locals import MOUSEBUTTONDOWN, MOUSEBUTTONUP, QUIT, K_SPACE, K_r, K_d, K_v, K_h, KEYDOWN
+    def check_memory(self):
+        """
+        Cap the population at its current size if the resident memory is over
+        the budget (and it isn't capped lower already).
+        """
+        memory = resident_memory()
+        if memory is None or memory <= self.memory_budget:
+            return
+        population = len(self.creatures)
+        if not self.population_cap or population < self.population_cap:
+            self.population_cap = max(population, 1)
+            self.warn("memory budget exceeded (%d MB resident): population capped at %d" %
+                      (memory >> 20, self.population_cap))
+
+    def warn(self, message):
+        "call the warning callback, if set, with a message"
+        if self.warning_callback:
+            self.warning_callback(message)
+
+    def cells(self):
+        """
+        Return the absolute positions of every creature cell, as two arrays of
+        coordinates, and an array of their kinds (HEAD, BODY, NEWBORN or
+        DYING).
+        """
+        xs, ys, kinds = array('i'), array('i'), array('b')
+        for creature in self.creatures:
+            px, py = creature.position
+            if creature.age <= 0:
+                kind = NEWBORN
+            elif creature.energy <= 0:
+                kind = DYING
+            else:
+                kind = BODY
+            cell_xs, cell_ys, cell_kinds = creature.genome.layouts[creature.orientation]
+            xs.extend([px + x for x in cell_xs])
+            ys.extend([py + y for y in cell_ys])
+            kinds.extend(cell_kinds[kind])
+        return xs, ys, kinds
+
+    def save(self, path):
+        """
+        Save a checkpoint of the simulation (see dump) in a file. The file is
+        replaced atomically. The lineage, if set, is flushed first, so the
+        creatures saved are all in its log.
+        """
+        if self.lineage:
+            self.lineage.flush()
+        with open(path + '.tmp', 'wb') as checkpoint:
+            checkpoint.write(self.dump())
+        os.rename(path + '.tmp', path)
+
+    def dump(self):
+        """
+        Return a checkpoint of the simulation, as a compact binary string: the
+        parameters, the cycle count, the random generator state, the genomes,
+        the creatures (in order), and the food and key particles (chunked
+        particles with the quotas of their untouched chunks, so they stay
+        untouched).
+        """
+        genomes = {}
+        creatures = []
+        for creature in self.creatures:
+            index = genomes.setdefault(creature.genome, len(genomes))
+            creatures.append(struct.pack(CHECKPOINT_CREATURE, index,
+                                         creature.orientation, creature.phase,
+                                         creature.position[0],
+                                         creature.position[1],
+                                         creature.energy, creature.age,
+                                         creature.generation, creature.id))
+
+        # random generator: version, internal state and next gaussian
+        version, internal, gauss = self.random.getstate()
+        chunked = isinstance(self.food, ParticleChunks)
+        chunks = [struct.pack(CHECKPOINT_HEADER, CHECKPOINT_MAGIC,
+                              CHECKPOINT_VERSION, self.size[0], self.size[1],
+                              self.offspring_energy, self.energy_loss,
+                              self.energy_gain, self.wrap_vertical,
+                              self.wrap_horizontal, self.mutation_probability,
+                              self.cycle, self.food.side if chunked else 0),
+                  struct.pack('<iI?d', version, len(internal), gauss is not None,
+                              gauss or 0.0),
+                  array('I', internal).tostring()]
+
+        # genomes, in orientation zero, with their lineage identifiers
+        chunks.append(struct.pack('<I', len(genomes)))
+        for genome in sorted(genomes, key=genomes.get):
+            cells = genome.cells[0]
+            chunks.append(struct.pack('<II', self.genome_ids.get(genome, 0),
+                                      len(cells)))
+            chunks.append(struct.pack('<%di' % (2 * len(cells)),
+                                      *chain.from_iterable(cells)))
+
+        chunks.append(struct.pack('<I', len(creatures)))
+        chunks.extend(creatures)
+        chunks.append(self.food.dump())
+        chunks.append(self.keys.dump())
+        if chunked:
+            chunks.append(self.food.touch.dump())
+        return ''.join(chunks)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a simulation from a checkpoint file written by save, restoring
+        the random generator state, so the simulation can be resumed.
+        """
+        with open(path, 'rb') as checkpoint:
+            buffer = mmap.mmap(checkpoint.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return Zoo.restore(buffer, name = path)
+        finally:
+            buffer.close()
+
+    @staticmethod
+    def restore(buffer, offset=0, name='checkpoint'):
+        """
+        Return the simulation of a checkpoint written by dump, from a binary
+        string (or memory map), starting at offset. "name" is the checkpoint's
+        name in the error messages.
+        """
+        (magic, version, width, height, offspring_energy, energy_loss,
+         energy_gain, wrap_vertical, wrap_horizontal, mutation_probability,
+         cycle_count, side) = struct.unpack_from(CHECKPOINT_HEADER, buffer, offset)
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError("Invalid checkpoint: %s" % name)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version: %d" % version)
+        offset += struct.calcsize(CHECKPOINT_HEADER)
+
+        zoo = Zoo([], (width, height), offspring_energy, 0, 0,
+                  energy_loss = energy_loss, energy_gain = energy_gain,
+                  wrap_vertical = wrap_vertical,
+                  wrap_horizontal = wrap_horizontal,
+                  mutation_probability = mutation_probability, chunk = side)
+        zoo.cycle = cycle_count
+
+        random_version, length, has_gauss, gauss = struct.unpack_from('<iI?d', buffer, offset)
+        offset += struct.calcsize('<iI?d')
+        internal = array('I')
+        internal.fromstring(buffer[offset:offset + length * internal.itemsize])
+        offset += length * internal.itemsize
+        zoo.random.setstate((random_version, tuple(internal), gauss if has_gauss else None))
+
+        # genomes were saved in orientation zero, which may not be the
+        # orientation zero of the genome interned in this process
+        genomes = []
+        count, = struct.unpack_from('<I', buffer, offset)
+        offset += 4
+        for i in xrange(count):
+            genome_id, length = struct.unpack_from('<II', buffer, offset)
+            offset += 8
+            values = struct.unpack_from('<%di' % (2 * length), buffer, offset)
+            offset += 8 * length
+            genomes.append(Genome.intern(zip(values[::2], values[1::2])))
+            if genome_id:
+                zoo.genome_ids[genomes[-1][0]] = genome_id
+
+        count, = struct.unpack_from('<I', buffer, offset)
+        offset += 4
+        size = struct.calcsize(CHECKPOINT_CREATURE)
+        for i in xrange(count):
+            (index, orientation, phase, x, y, energy, age, generation,
+             identifier) = struct.unpack_from(CHECKPOINT_CREATURE, buffer, offset)
+            offset += size
+            genome, base = genomes[index]
+            orientation = ORIENTATIONS.index(compose(ORIENTATIONS[base],
+                                                     ORIENTATIONS[orientation]))
+            creature = Creature((x, y), generation = generation,
+                                energy = energy, genome = genome,
+                                orientation = orientation, ledger = zoo.ledger)
+            creature.phase = phase
+            creature.age = age
+            creature.id = identifier
+            zoo.creatures.append(creature)
+            zoo.statistics.add(creature)
+            zoo.index.add(creature)
+
+        offset = zoo.food.restore(buffer, offset)
+        offset = zoo.keys.restore(buffer, offset)
+        if side:
+            zoo.food.touch.restore(buffer, offset)
+        return zoo
+
+def address(value):
+    "parse a [HOST:]PORT address (the host is localhost by default)"
+    host, separator, port = value.rpartition(':')
+    return (host or 'localhost', int(port))
+
+def tiles(value):
+    "parse a COLUMNSxROWS tiles grid, of positive numbers"
+    columns, rows = [int(n) for n in value.split('x')]
+    if columns < 1 or rows < 1:
+        raise ValueError("Invalid tiles: %s" % value)
+    return (columns, rows)
+
+def argument_parser():
+    """
+    Return the command line argument parser, shared by the graphical and the
+    headless modes.
+    """
     import argparse
 
-    # parse arguments, possibly replacing default values
     parser = argparse.ArgumentParser(description="Biotopia - The Artificial Life Simulator")
     parser.add_argument('--width', '-wd', default=800, type=int, metavar='WIDTH',
                         dest='width', help='the simulation environment width')
@@ -484,7 +1941,510 @@ if __name__  == "__main__":
                         dest='wrap_horizontally', help="Whether or not to wrap the environment horizontally")
     parser.add_argument('--auto-restart', '-r', default=False, action='store_true',
                         dest='auto_restart', help="Whether or not to restart simulation if population reaches zero")
+    parser.add_argument('--headless', '-x', default=False, action='store_true',
+                        dest='headless', help="Run the simulation without display, as fast as possible")
+    parser.add_argument('--cycles', '-n', default=0, type=int, metavar='CYCLES',
+                        dest='cycles', help="In headless mode, the number of cycles to run (zero runs until extinction)")
+    parser.add_argument('--report-every', '-e', default=1000, type=int, metavar='CYCLES',
+                        dest='report_every', help="In headless mode, the period of the summary lines")
+    parser.add_argument('--load', '-L', default=None, metavar='PATH',
+                        dest='load', help="Resume the simulation from a checkpoint file")
+    parser.add_argument('--save', '-S', default=None, metavar='PATH',
+                        dest='save', help="The checkpoint file to save the simulation to (in headless mode, at the end; in the GUI, on the 's' key)")
+    parser.add_argument('--checkpoint-every', '-C', default=0, type=int, metavar='CYCLES',
+                        dest='checkpoint_every', help="In headless mode, the period of the checkpoints (zero saves only at the end)")
+    parser.add_argument('--seed', '-s', default=None, type=int, metavar='SEED',
+                        dest='seed', help="The random generator seed: the same seed always yields the same simulation")
+    parser.add_argument('--fast-forward', '-F', default=0, type=int, metavar='CYCLES',
+                        dest='fast_forward', help="In the GUI, run as fast as possible up to this cycle before showing the simulation at normal speed")
+    parser.add_argument('--profile', '-P', default=0, type=int, metavar='CYCLES',
+                        dest='profile', help="Profile the phases of the steps, dumping the profile each CYCLES cycles (in headless mode, to the standard error; in the GUI, in debug mode)")
+    parser.add_argument('--lineage', '-G', default=None, metavar='PATH',
+                        dest='lineage', help="Record the lineage of the creatures to this log file (and the genomes to PATH.genomes)")
+    parser.add_argument('--record', '-R', default=None, metavar='PATH',
+                        dest='record', help="Record the simulation to this replay file, to be played back with --replay")
+    parser.add_argument('--keyframe-every', default=1000, type=int, metavar='CYCLES',
+                        dest='keyframe_every', help="The period of the keyframes of the replay file, that playback seeks to")
+    parser.add_argument('--replay', '-Y', default=None, metavar='PATH',
+                        dest='replay', help="In the GUI, play back a replay file instead of simulating (--fast-forward seeks to a cycle)")
+    parser.add_argument('--serve', default=None, type=address, metavar='[HOST:]PORT',
+                        dest='serve', help="In headless mode, serve the simulation to viewers connecting to this address (see --connect)")
+    parser.add_argument('--metrics', default=None, type=address, metavar='[HOST:]PORT',
+                        dest='metrics', help="In headless mode, serve the metrics of the simulation over HTTP at this address, in the Prometheus text format")
+    parser.add_argument('--connect', default=None, type=address, metavar='[HOST:]PORT',
+                        dest='connect', help="In the GUI, show the simulation served at this address instead of simulating")
+    parser.add_argument('--chunk', '-K', default=0, type=int, metavar='CELLS',
+                        dest='chunk', help="Keep the particles in square chunks of this side (a power of two), generated when first touched, so huge environments start at once")
+    parser.add_argument('--population-cap', '-N', default=0, type=int, metavar='AMOUNT',
+                        dest='population_cap', help="Refuse births (or, with --cull, cull the creatures with the least energy) beyond this population")
+    parser.add_argument('--cull', default=False, action='store_true',
+                        dest='cull', help="Cull the creatures with the least energy beyond the population cap, instead of refusing births")
+    parser.add_argument('--memory-budget', '-M', default=0, type=int, metavar='MB',
+                        dest='memory_budget', help="Cap the population at its size once the resident memory exceeds this many megabytes")
+    parser.add_argument('--engine', '-E', default='python', choices=('python', 'numpy', 'tiled'),
+                        dest='engine', help="The simulation engine: per-creature Python objects, batched NumPy arrays, or tiles stepped by parallel processes (headless only)")
+    parser.add_argument('--tiles', '-T', default=(4, 1), type=tiles,
+                        metavar='COLUMNSxROWS', dest='tiles', help="With the tiled engine, the number of tile columns and rows (one process each)")
+    parser.add_argument('--halo', default=32, type=int, metavar='CELLS',
+                        dest='halo', help="With the tiled engine, how far creatures may reach beyond their tiles")
+    return parser
+
+def check_arguments(args):
+    """
+    Check that the command line arguments can be run together, raising a
+    ValueError with the reason if they can't.
+    """
+    if args.engine != 'python' and (args.load or args.save):
+        raise ValueError("checkpoints are only supported by the python engine")
+    if args.engine != 'python' and args.profile:
+        raise ValueError("profiling is only supported by the python engine")
+    if args.engine != 'python' and args.lineage:
+        raise ValueError("lineage recording is only supported by the python engine")
+    if args.engine != 'python' and args.record:
+        raise ValueError("replay recording is only supported by the python engine")
+    if args.replay and (args.headless or args.load or args.record):
+        raise ValueError("replays are only played back in the GUI, without loading or recording")
+    if args.serve and not args.headless:
+        raise ValueError("serving is only supported in headless mode")
+    if args.engine != 'python' and args.serve:
+        raise ValueError("serving is only supported by the python engine")
+    if args.metrics and not args.headless:
+        raise ValueError("metrics are only served in headless mode")
+    if args.connect and (args.headless or args.load or args.record or args.replay):
+        raise ValueError("served simulations are only shown in the GUI, without loading, recording or replaying")
+    if args.engine != 'python' and (args.population_cap or args.memory_budget):
+        raise ValueError("population caps and memory budgets are only supported by the python engine")
+    if args.cull and not args.population_cap:
+        raise ValueError("culling needs a population cap")
+    if args.engine != 'python' and args.chunk:
+        raise ValueError("chunked particles are only supported by the python engine")
+    if args.chunk & (args.chunk - 1):
+        raise ValueError("the chunk side must be a power of two")
+    if args.engine == 'tiled' and not args.headless:
+        raise ValueError("the tiled engine is only supported in headless mode")
+    if args.engine == 'tiled':
+        from biotopia_tiled import check_tiles
+        check_tiles((args.width, args.height), args.tiles, args.halo,
+                    args.wrap_horizontally, args.wrap_vertically)
+
+def new_zoo(args, seed=None):
+    """
+    Create a new simulation, with randomly placed ancestors, from the command
+    line arguments. The random generator is seeded with "seed" or, if not
+    given, with "args.seed".
+    """
+    options = {}
+    if args.chunk:
+        options = dict(chunk = args.chunk)
+    if args.engine == 'numpy':
+        from biotopia_numpy import NumpyZoo as zoo_class
+    elif args.engine == 'tiled':
+        from biotopia_tiled import TiledZoo as zoo_class
+        options = dict(tiles = args.tiles, halo = args.halo)
+    else:
+        zoo_class = Zoo
+
+    zoo = zoo_class([],
+                    size = (args.width, args.height),
+                    offspring_energy = args.offspring_energy,
+                    start_food = args.start_food,
+                    start_keys = args.start_keys,
+                    energy_loss = args.energy_loss,
+                    energy_gain = args.energy_gain,
+                    wrap_horizontal = args.wrap_horizontally,
+                    wrap_vertical = args.wrap_vertically,
+                    mutation_probability = args.mutation_probability,
+                    seed = args.seed if seed is None else seed,
+                    **options)
+    zoo.populate(args.start_population, args.ancestors_energy)
+    return zoo
+
+def bound(zoo, args):
+    """
+    Apply the population cap and memory budget of the command line arguments
+    to a zoo, warning on the standard error when they're reached. Returns the
+    zoo.
+    """
+    import sys
+
+    def warn(message):
+        sys.stderr.write("warning at cycle %d: %s\n" % (zoo.cycle, message))
+
+    zoo.population_cap = args.population_cap
+    zoo.cull = args.cull
+    zoo.memory_budget = args.memory_budget << 20
+    zoo.warning_callback = warn
+    return zoo
+
+def headless(args, output=None):
+    """
+    Run the simulation without display, stepping the zoo in a tight loop for
+    "args.cycles" cycles (or until extinction if zero), and printing a summary
+    line each "args.report_every" cycles. Restarts the simulation on
+    extinction if "args.auto_restart" is set. Resumes from the "args.load"
+    checkpoint, if given, and saves checkpoints to "args.save" each
+    "args.checkpoint_every" cycles and at the end. Profiles the steps, dumping
+    the profile to the standard error each "args.profile" cycles, if set,
+    records the lineage to "args.lineage", and the replay to "args.record", if
+    given, serves the simulation at the "args.serve" address, and its metrics
+    at the "args.metrics" address, if given. The population is bounded as
+    the arguments ask (see bound). Returns the exit status.
+    """
+    import sys
+
+    output = output or sys.stdout
+
+    def report(zoo):
+        statistics = zoo.statistics
+        output.write("cycle: %012d pop/keys: %d/%d food: %d mouths: %.2f gen: %d species: %d\n" %
+                     (zoo.cycle, len(zoo.creatures), len(zoo.keys),
+                      len(zoo.food), statistics.mouths[1],
+                      statistics.generation[2], statistics.diversity[0]))
+        output.flush()
+
+    def dump(profile):
+        sys.stderr.write("profile at cycle %d:\n" % zoo.cycle)
+        for line in profile.report():
+            sys.stderr.write("    %s\n" % line)
+        profile.reset()
+
+    # the profile and the lineage go on across restarts
+    profile = Profile() if args.profile else None
+    lineage = None
+    if args.lineage:
+        from biotopia_lineage import LineageRecorder
+        lineage = LineageRecorder(args.lineage)
+    recorder = None
+    if args.record:
+        from biotopia_replay import ReplayRecorder
+        recorder = ReplayRecorder(args.record, args.keyframe_every)
+    server = None
+    if args.serve:
+        from biotopia_stream import StreamServer
+        server = StreamServer(args.serve)
+    metrics = None
+    if args.metrics:
+        from biotopia_metrics import MetricsServer
+        metrics = MetricsServer(args.metrics)
+
+    def instrument(zoo):
+        zoo.profile = profile
+        if lineage:
+            lineage.attach(zoo)
+        bound(zoo, args)
+        if recorder:
+            recorder.record(zoo)
+        if server:
+            server.publish(zoo)
+        return zoo
+
+    zoo = instrument(Zoo.load(args.load) if args.load else new_zoo(args))
+    cycle_count = 0
+    start = time()
+
+    try:
+        while not args.cycles or cycle_count < args.cycles:
+            if args.report_every and zoo.cycle % args.report_every == 0:
+                report(zoo)
+            if (args.save and args.checkpoint_every and cycle_count and
+                    zoo.cycle % args.checkpoint_every == 0):
+                mark = time()
+                zoo.save(args.save)
+                if metrics:
+                    metrics.spend('checkpoint', time() - mark)
+
+            mark = time()
+            zoo.step()
+            stepped = time()
+            cycle_count += 1
+            if recorder:
+                recorder.record(zoo)
+            if server:
+                server.publish(zoo)
+            if metrics:
+                if recorder or server:
+                    metrics.spend('recording', time() - stepped)
+                metrics.observe(zoo, stepped - mark)
+            if profile and cycle_count % args.profile == 0:
+                dump(profile)
+
+            # if population is zero: restart or finish the simulation
+            if not zoo.creatures:
+                report(zoo)
+                if not args.auto_restart:
+                    break
+                output.write("extinction: restarting simulation\n")
+                # the next simulation is seeded by the previous one, so a
+                # seeded run is still reproducible
+                seed = zoo.random.getrandbits(32)
+                if hasattr(zoo, 'close'):
+                    zoo.close()
+                zoo = instrument(new_zoo(args, seed))
+    except KeyboardInterrupt:
+        pass
+
+    if args.save:
+        zoo.save(args.save)
+    if hasattr(zoo, 'close'):
+        zoo.close()
+    if lineage:
+        lineage.close()
+    if recorder:
+        recorder.close()
+    if server:
+        server.close()
+    if metrics:
+        metrics.close()
+
+    elapsed = time() - start
+    output.write("%d cycles in %.2f seconds (%.2f steps/sec)\n" %
+                 (cycle_count, elapsed, cycle_count / elapsed if elapsed else 0.0))
+    return 0
+
+#: A read-only copy of a creature, in a frame
+Snapshot = namedtuple('Snapshot', 'position cells mouths energy age generation')
+
+def snapshot(creature):
+    "return a Snapshot of a creature"
+    return Snapshot(creature.position, frozenset(creature.cells),
+                    tuple(creature.mouths), creature.energy, creature.age,
+                    creature.generation)
+
+class Frame(object):
+    """
+    An immutable picture of a zoo, published by a Simulation for display: the
+    cycle, the population, keys and food counts, the statistics (and species
+    diversity, as the number of species and the Shannon index), the cells of
+    the creatures (as returned by Zoo.cells), the particles changed since the
+    previous frame (all of them, if "reset") as (position, 'food', 'key' or
+    'background') pairs, the chart samples (cycle, population, keys) taken
+    since the previous frame, the spotlighted creatures' snapshots, and the
+    report lines of the last profile of the steps (or None).
+    """
+
+    def __init__(self, zoo, cells, particles, reset, samples, spotlight,
+                 profile=None):
+        self.cycle = zoo.cycle
+        self.population = len(zoo.creatures)
+        self.keys = len(zoo.keys)
+        self.food = len(zoo.food)
+        statistics = zoo.statistics
+        self.age = statistics.age
+        self.mouths = statistics.mouths
+        self.energy = statistics.energy
+        self.generation = statistics.generation
+        self.species, self.shannon, simpson = statistics.diversity
+        self.cells = cells
+        self.particles = particles
+        self.reset = reset
+        self.samples = samples
+        self.spotlight = spotlight
+        self.profile = profile
+
+class Simulation(Thread):
+    """
+    Steps a zoo in a background thread, decoupled from its display. The display
+    takes the frames with next_frame, and each one asks for the next: the zoo
+    is normally stepped once per frame, but in turbo mode (or while fast
+    forwarding to the "target" cycle) it is stepped as fast as possible, and a
+    frame is published whenever one is asked for. Any other change to the zoo
+    is sent as a command (a function of the zoo) to the thread, which runs it
+    between steps; a command that fails is reported on the standard error, and
+    the simulation goes on.
+
+    "restart", if given, is called with the zoo when its population is extinct,
+    and returns the zoo to continue with. A chart sample is taken each
+    "chart_every" cycles. While "debugging", frames spotlight the creature
+    nearest to "pointer" and some of the best creatures, and carry the report
+    of the steps profiled over the last "profile_every" cycles, if set. Every
+    zoo and step is recorded to the "recorder", if given (a
+    biotopia_replay.ReplayRecorder).
+    """
+
+    def __init__(self, zoo, restart=None, chart_every=1, profile_every=0,
+                 recorder=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.restart = restart
+        self.chart_every = chart_every
+        self.profile_every = profile_every
+        self.recorder = recorder
+        self.turbo = False
+        self.paused = False
+        self.debugging = False
+        self.pointer = None
+        self.running = True
+        self.commands = deque()
+        self.wanted = Event()
+        # guards the hand over of the frame between the threads
+        self.lock = Lock()
+        self.attach(zoo)
+        self.frame = self.publish()
+
+    def attach(self, zoo):
+        "continue with another zoo, at normal speed"
+        self.zoo = zoo
+        self.target = None
+        self.changed = set()
+        self.reset = True
+        self.samples = []
+        self.sampled = None
+        self.tracked = {}
+        self.profiled = None
+        if self.profile_every:
+            zoo.profile = Profile()
+        if self.recorder:
+            self.recorder.record(zoo)
+
+    def command(self, function):
+        "run a function of the zoo in the simulation thread, between steps"
+        self.commands.append(function)
+        self.wanted.set()
+
+    def next_frame(self):
+        "return the frame published since the last call (or None), and ask for another"
+        with self.lock:
+            frame, self.frame = self.frame, None
+        self.wanted.set()
+        return frame
+
+    def stop(self):
+        "stop the thread, after the current step"
+        self.running = False
+        self.wanted.set()
+        self.join()
+
+    def run(self):
+        while self.running:
+            if self.paused or not (self.turbo or self.target is not None):
+                self.wanted.wait()
+            while self.commands:
+                self.execute(self.commands.popleft())
+            if not self.paused:
+                self.advance()
+            if self.wanted.is_set():
+                self.wanted.clear()
+                # a frame not taken yet isn't replaced (its changes would be
+                # lost): the changes go on accumulating for the next one
+                with self.lock:
+                    taken = self.frame is None
+                if taken:
+                    frame = self.publish()
+                    with self.lock:
+                        self.frame = frame
+
+    def execute(self, command):
+        "run a command, reporting its failure on the standard error"
+        import sys
+
+        try:
+            command(self.zoo)
+        except Exception as error:
+            sys.stderr.write("error at cycle %d: %s\n" % (self.zoo.cycle, error))
+
+    def advance(self):
+        "step the zoo, sampling the chart and restarting on extinction"
+        zoo = self.zoo
+        if zoo.cycle % self.chart_every == 0 and zoo.cycle != self.sampled:
+            # (played back zoos may not advance in a step)
+            self.samples.append((zoo.cycle, len(zoo.creatures), len(zoo.keys)))
+            self.sampled = zoo.cycle
+        zoo.step()
+        if self.recorder:
+            self.recorder.record(zoo)
+        for changes in (zoo.food_added, zoo.food_removed, zoo.keys_added,
+                        zoo.keys_removed):
+            if len(changes):
+                self.changed.update(pairs(changes))
+        if self.profile_every and zoo.cycle % self.profile_every == 0:
+            self.profiled = zoo.profile.report()
+            zoo.profile.reset()
+        if self.target is not None and zoo.cycle >= self.target:
+            self.target = None
+        if not zoo.creatures and self.restart:
+            self.attach(self.restart(zoo))
+
+    def publish(self):
+        "return a frame of the zoo, with the changes since the last one"
+        zoo = self.zoo
+        if self.reset:
+            colors = dict((p, 'food') for p in zoo.food.iter_unique())
+            colors.update((p, 'key') for p in zoo.keys.iter_unique())
+            particles = colors.items()
+        else:
+            food, keys = zoo.food, zoo.keys
+            particles = [(p, 'key' if p in keys else 'food' if p in food else 'background')
+                         for p in self.changed]
+        self.changed.clear()
+        frame = Frame(zoo, zoo.cells(), particles, self.reset, self.samples,
+                      self.spotlight() if self.debugging else {},
+                      self.profiled if self.debugging else None)
+        self.reset = False
+        self.samples = []
+        return frame
+
+    def spotlight(self):
+        """
+        Return the snapshots of the creature nearest to the pointer, and of
+        the oldest, most energetic, most mouths and oldest generation ones.
+        Creatures are tracked while they live (and remain the best).
+        """
+        zoo = self.zoo
+        index, statistics, tracked = zoo.index, zoo.statistics, self.tracked
+        for name, creature in tracked.items():
+            if creature not in index:
+                del tracked[name]
+        if not zoo.creatures:
+            return {}
+
+        if self.pointer and (0 <= self.pointer[0] <= zoo.size[0] and
+                             0 <= self.pointer[1] <= zoo.size[1]):
+            tracked['nearest'] = index.nearest(self.pointer)
+        else:
+            tracked.pop('nearest', None)
+        if 'oldest' not in tracked:
+            tracked['oldest'] = max(zoo.creatures, key=lambda c: c.age)
+        if ('most_energetic' not in tracked or
+                tracked['most_energetic'].energy < statistics.energy[2]):
+            tracked['most_energetic'] = max(zoo.creatures, key=lambda c: c.energy)
+        if ('most_mouths' not in tracked or
+                len(tracked['most_mouths'].mouths) < statistics.mouths[2]):
+            tracked['most_mouths'] = max(zoo.creatures, key=lambda c: len(c.mouths))
+        if 'oldest_generation' not in tracked:
+            tracked['oldest_generation'] = min(zoo.creatures, key=lambda c: c.generation)
+        return dict((name, snapshot(c)) for name, c in tracked.iteritems())
+
+if __name__  == "__main__":
+    import sys
+
+    # parse arguments, possibly replacing default values
+    parser = argument_parser()
     args = parser.parse_args()
+    try:
+        check_arguments(args)
+    except ValueError as error:
+        parser.error(str(error))
+
+    # run without display, as fast as possible
+    if args.headless:
+        sys.exit(headless(args))
+
+    import pygame
+    from biotopia_render import Renderer
+    from pygame.locals import MOUSEBUTTONDOWN, MOUSEBUTTONUP, QUIT, K_SPACE, K_r, K_d, K_v, K_h, K_s, K_t, K_f, K_b, KEYDOWN
+
+    # a resumed simulation (or a replay, from the cycle to fast-forward to)
+    # determines the environment size
+    loaded = Zoo.load(args.load) if args.load else None
+    replay = viewer = None
+    if args.replay:
+        from biotopia_replay import Replay
+        loaded = replay = Replay(args.replay).seek(args.fast_forward)
+    elif args.connect:
+        from biotopia_stream import StreamViewer
+        loaded = viewer = StreamViewer(args.connect)
+    if loaded:
+        args.width, args.height = loaded.size
 
     #: the maximum amount of population or keys
     POP_MAX = args.start_keys + args.start_population
@@ -522,91 +2482,77 @@ if __name__  == "__main__":
     font_size = 20
     stats_font = pygame.font.SysFont("monospace", 12)
 
-    # soup surface
-    soup_surface = pygame.Surface((width, height+1))
-
-    # convenient function to start a new simulation
-    def start_new_simulation():
-        zoo = Zoo([ancestor(position = (randint(0,width), randint(0, height)),
-                            energy = args.ancestors_energy) for i in
-                   xrange(args.start_population)],
-                  size = (width, height),
-                  offspring_energy = args.offspring_energy,
-                  start_food = args.start_food,
-                  start_keys = args.start_keys,
-                  energy_loss = args.energy_loss,
-                  energy_gain = args.energy_gain,
-                  wrap_horizontal = args.wrap_horizontally,
-                  wrap_vertical = args.wrap_vertically,
-                  mutation_probability = args.mutation_probability)
-
-        # clear soup surface
-        soup_surface.fill(background_color)
-
-        # print each initial food particle
-        for food in zoo.food.iter_unique():
-            if 0 <= food[0] <= width and 0 <= food[1] <= height:
-                soup_surface.set_at(food, food_color)
-
-        # print each initial key particle
-        for key in zoo.keys.iter_unique():
-            soup_surface.set_at(key, key_color)
-
-        # set callbacks for adding or removing food and key particles
-        zoo.new_food_callback = lambda p: soup_surface.set_at(p, food_color)
-        zoo.new_key_callback = lambda p: soup_surface.set_at(p, key_color)
-        zoo.del_key_callback = zoo.del_food_callback = lambda p: soup_surface.set_at(p, background_color)
-
-        return zoo
+    # the environment (particles and creatures) renderer
+    renderer = Renderer(window, (width, height+1),
+                        dict(background = background_color, food = food_color,
+                             key = key_color, head = head_color,
+                             cell = cell_color, newborn = new_born_color,
+                             dying = die_color, highlight = (255,255,255)))
+
+    # the lineage of every simulation is recorded to the same log, if asked to
+    lineage = None
+    if args.lineage:
+        from biotopia_lineage import LineageRecorder
+        lineage = LineageRecorder(args.lineage)
+
+    def record(zoo):
+        if lineage:
+            lineage.attach(zoo)
+        return bound(zoo, args)
+
+    # and every simulation to the same replay file
+    recorder = None
+    if args.record:
+        from biotopia_replay import ReplayRecorder
+        recorder = ReplayRecorder(args.record, args.keyframe_every)
+
+    # the simulation runs in its own thread, publishing frames to be drawn;
+    # it restarts itself with a new simulation on extinction, if asked to
+    def restart(zoo):
+        # the next simulation is seeded by the previous one
+        return record(new_zoo(args, zoo.random.getrandbits(32)))
+
+    if replay or viewer:
+        simulation = Simulation(replay or viewer, None, chart_update)
+    else:
+        simulation = Simulation(record(loaded or new_zoo(args)),
+                                restart if auto_restart else None, chart_update,
+                                args.profile, recorder)
+        if args.fast_forward:
+            simulation.target = args.fast_forward
+    simulation.start()
 
-    # initialize simulation
-    zoo = start_new_simulation()
+    #: how many cycles the 'f' key fast-forwards (and, in a replay, 'f' and 'b'
+    #: seek forward and back)
+    FAST_FORWARD = 10000
 
     # flags and control variables
     zooming = False
     debugging = False
-    paused = False
-    cycle_count = 0
+    frame = None
 
-    # debugging references
-    nearest = None
-    most_energetic = choice(list(zoo.creatures)) if zoo.creatures else None
-    most_mouths = choice(list(zoo.creatures)) if zoo.creatures else None
-    oldest = choice(list(zoo.creatures)) if zoo.creatures else None
-    oldest_generation = choice(list(zoo.creatures)) if zoo.creatures else None
+    # whether the last frame had debugging or zoom overlays
+    overlays = False
 
     # main loop
     while True:
-        # clear zoo screen
-        window.blit(soup_surface, (0,0))
-
-        # print each creature
-        for creature in zoo.creatures:
-
-            if debugging and (creature is nearest or
-                              creature is oldest or
-                              creature is oldest_generation or
-                              creature is most_mouths or
-                              creature is most_energetic):
-                color = (255,255,255)
-            elif creature.age <= 0:
-                color = new_born_color
-            elif creature.energy <= 0:
-                color = die_color
-            else:
-                color = cell_color
+        latest = simulation.next_frame()
+        if latest:
+            frame = latest
+            if frame.reset:
+                window.fill(background_color)
+                renderer.invalidate()
 
-            # print each creature cell
-            for cell in creature.cells:
-                cell_position = (creature.position[0] + cell[0],
-                                 creature.position[1] + cell[1])
-                if 0 <= cell_position[0] <= width and 0 <= cell_position[1] <= height:
-                    window.set_at(cell_position,
-                                  head_color if cell == creature.head else color)
+        # overlays are drawn over the whole environment, and erased in the
+        # next frame: redraw it all while (and right after) they are shown
+        if overlays or debugging or zooming:
+            renderer.invalidate()
+        overlays = debugging or zooming
 
-        # do some math
-        total_creatures = len(zoo.creatures)
-        total_keys = len(zoo.keys)
+        # print the particles and each creature
+        spotlight = frame.spotlight if debugging else {}
+        if latest or overlays:
+            renderer.draw(frame, spotlight.values())
 
         # draw zoom, if active
         if zooming:
@@ -623,23 +2569,11 @@ if __name__  == "__main__":
             pygame.draw.rect(window, zoom_border_color,
                              (blit_point, (width/4, height/4)), 1)
 
-        # print the nearest creature's information, if debugging:
-        if debugging and total_creatures > 0:
-            # clear references, if creatures are dead
-            if nearest not in zoo.creatures:
-                nearest = None
-            if oldest not in zoo.creatures:
-                oldest = None
-            if oldest_generation not in zoo.creatures:
-                oldest_generation = None
-            if most_energetic not in zoo.creatures:
-                most_energetic = None
-            if most_mouths not in zoo.creatures:
-                most_mouths = None
-
-            # find out nearest creature energy and age
-            if 0 <= mouse_pos[0] <= width and 0 <= mouse_pos[1] <= height:
-                nearest = min(zoo.creatures, key=lambda c: distance(c.position, mouse_pos))
+        # print the spotlighted creatures' information, if debugging:
+        if debugging and spotlight:
+            # print nearest creature energy and age alongside it
+            nearest = spotlight.get('nearest')
+            if nearest:
                 energy_text = stats_font.render("e: %d" % nearest.energy, False, text_color)
                 age_text =    stats_font.render("a: %d" % nearest.age, False, text_color)
                 gen_text =    stats_font.render("g: %d" % nearest.generation, False, text_color)
@@ -653,12 +2587,9 @@ if __name__  == "__main__":
                 window.blit(energy_text, blit_pos)
                 window.blit(age_text, (blit_pos[0], blit_pos[1] + energy_text.get_height()))
                 window.blit(gen_text, (blit_pos[0], blit_pos[1] + energy_text.get_height() + age_text.get_height()))
-            else:
-                nearest = None
 
-            # find oldest and identify
-            if oldest is None:
-                oldest = max(zoo.creatures, key=lambda c: c.age)
+            # identify oldest
+            oldest = spotlight['oldest']
             text = stats_font.render('oldest age (%d)' % oldest.age, False, text_color)
 
             # print information alongside the creature
@@ -666,9 +2597,8 @@ if __name__  == "__main__":
                         oldest.position[1] - text.get_height() / 2)
             window.blit(text, blit_pos)
 
-            # find most energetic and identify
-            creature = max(zoo.creatures, key=lambda c: c.energy)
-            most_energetic = creature if most_energetic is None or most_energetic.energy < creature.energy else most_energetic
+            # identify most energetic
+            most_energetic = spotlight['most_energetic']
             text = stats_font.render('most energetic (%d)' % most_energetic.energy, False, text_color)
 
             # print information alongside the creature
@@ -676,19 +2606,8 @@ if __name__  == "__main__":
                         most_energetic.position[1] - 10 - text.get_height() if most_energetic.position[1] - 10 - text.get_height() > 0 else most_energetic.position[1] + 10)
             window.blit(text, blit_pos)
 
-            # find most mouth and identify
-            creature = max(zoo.creatures, key=lambda c: len(c.mouths))
-            most_mouths = creature if most_mouths is None or len(most_mouths.mouths) < len(creature.mouths) else most_mouths
-            text = stats_font.render('most mouths (%d)' % len(most_mouths.mouths), False, text_color)
-
-            # print information alongside the creature
-            blit_pos = (most_mouths.position[0] - 10 - text.get_width() if most_mouths.position[0] - 10 - text.get_width() > 0 else most_mouths.position[0] + 10,
-                        most_mouths.position[1] - text.get_height() / 2)
-            window.blit(text, blit_pos)
-
-            # find most mouth and identify
-            creature = max(zoo.creatures, key=lambda c: len(c.mouths))
-            most_mouths = creature if most_mouths is None or len(most_mouths.mouths) < len(creature.mouths) else most_mouths
+            # identify most mouths
+            most_mouths = spotlight['most_mouths']
             text = stats_font.render('most mouths (%d)' % len(most_mouths.mouths), False, text_color)
 
             # print information alongside the creature
@@ -696,9 +2615,8 @@ if __name__  == "__main__":
                         most_mouths.position[1] - text.get_height() / 2)
             window.blit(text, blit_pos)
 
-            # find oldest generation and identify
-            if oldest_generation is None:
-                oldest_generation = min(zoo.creatures, key=lambda c: c.generation)
+            # identify oldest generation
+            oldest_generation = spotlight['oldest_generation']
             text = stats_font.render('oldest gen (%d)' % oldest_generation.generation, False, text_color)
 
             # print information alongside the creature
@@ -706,97 +2624,83 @@ if __name__  == "__main__":
                         oldest_generation.position[1] + 10 if oldest_generation.position[1] + 10 + text.get_height() < height else oldest_generation.position[1] - 10 - text.get_height())
             window.blit(text, blit_pos)
 
+        # print the last profile of the steps, if debugging
+        if debugging and frame.profile:
+            for i, line in enumerate(frame.profile):
+                text = stats_font.render(line, False, text_color, background_color)
+                window.blit(text, (10, 10 + i * text.get_height()))
+
         # update screen and fps
-        pygame.display.update()
+        renderer.present()
         fps_clock.tick(60)
 
-        # do stuff if not paused
-        if not paused:
-            # draw chart:
-            if cycle_count % chart_update == 0:
-                # first, move chart left
-                chart = window.subsurface(((1,height+1),
-                                           (chart_width-1, chart_height-1))).copy()
-                window.blit(chart, (0, height+1))
+        # draw chart, one column for each sample taken since the last frame:
+        if latest and frame.samples:
+            columns = min(len(frame.samples), chart_width - 1)
+
+            # first, move chart left
+            chart = window.subsurface(((columns, height+1),
+                                       (chart_width-columns, chart_height-1))).copy()
+            window.blit(chart, (0, height+1))
+            pygame.draw.rect(window, background_color,
+                             ((chart_width-columns, height+1), (columns, chart_height-1)))
 
-                # then, print chart pixels
+            # then, print chart pixels
+            for x, (cycle, total_creatures, total_keys) in enumerate(frame.samples[-columns:],
+                                                                    chart_width - columns):
                 pygame.draw.line(window, key_color,
-                                 (chart_width-1, height),
-                                 (chart_width-1,
-                                  height + (total_keys * chart_height /  POP_MAX)))
+                                 (x, height),
+                                 (x, height + (total_keys * chart_height /  POP_MAX)))
                 pygame.draw.line(window, head_color,
-                                 (chart_width-1, height + chart_height),
-                                 (chart_width-1,
-                                  height+chart_height - (total_creatures * chart_height /  POP_MAX)))
-                window.set_at((chart_width-1, height + chart_height/2),
-                              background_color)
-
-                # print some statistics: average age, average mouths, average energy
-                if total_creatures > 0:
-                    min_age = min(c.age for c in zoo.creatures)
-                    max_age = max(c.age for c in zoo.creatures)
-                    average_age = sum(c.age for c in zoo.creatures) / float(total_creatures)
-
-                    creature_mouths = [len(c.mouths) for c in zoo.creatures]
-                    min_mouths = min(creature_mouths)
-                    max_mouths = max(creature_mouths)
-                    average_mouths = sum(creature_mouths) / float(total_creatures)
-
-                    min_energy = min(c.energy for c in zoo.creatures)
-                    max_energy = max(c.energy for c in zoo.creatures)
-                    average_energy = sum(c.energy for c in zoo.creatures) / float(total_creatures)
-
-                    min_gen = min(c.generation for c in zoo.creatures)
-                    max_gen = max(c.generation for c in zoo.creatures)
-                    average_gen = sum(c.generation for c in zoo.creatures) / float(total_creatures)
-                else:
-                    average_age = max_age = min_age = 0
-                    average_mouths = max_mouths = min_mouths = 0
-                    average_energy = max_energy = min_energy = 0
-                    average_gen = max_gen = min_gen = 0
-
-                text_age = stats_font.render("age: %04d %04.2f %04d" % (min_age, average_age, max_age),
-                                             False, text_color, background_color)
-                text_mouths = stats_font.render("mouths: %04d %04.2f %04d" % (min_mouths, average_mouths, max_mouths),
-                                                False, text_color, background_color)
-                text_energy = stats_font.render("energy: %04d %04.2f %04d" % (min_energy, average_energy, max_energy),
-                                                False, text_color, background_color)
-                text_gen    = stats_font.render("gen: %04d %04.2f %04d" % (min_gen, average_gen, max_gen),
-                                                False, text_color, background_color)
-                text_pop    = stats_font.render("pop/keys: %04d/%04d" % (total_creatures, total_keys),
-                                                False, text_color, background_color)
-                text_cycle  = stats_font.render("cycle: %012d" % cycle_count,
-                                                False, text_color, background_color)
-                text_height = max(text_age.get_height(), text_mouths.get_height(),
-                                  text_energy.get_height(), text_energy.get_height(),
-                                  text_gen.get_height(), text_pop.get_height(),
-                                  text_cycle.get_height())
-
-                pygame.draw.rect(window, background_color, ((chart_width+1, height+1),
-                                                            (width - chart_width,
-                                                             chart_height)))
-                window.blit(text_age,    (chart_width+10, height + 10))
-                window.blit(text_mouths, (chart_width+10, height + 1*text_height + 10))
-                window.blit(text_energy, (chart_width+10, height + 2*text_height + 10))
-                window.blit(text_gen,    (chart_width+10, height + 3*text_height + 10))
-                window.blit(text_pop,    (chart_width+10, height + 4*text_height + 10))
-                window.blit(text_cycle,  (chart_width+10, height + 5*text_height + 10))
-
-            # update simulation
-            zoo.step()
-
-            # increment cycle_count
-            cycle_count += 1
-
-            # if population is zero and auto_restart is True: restart simulation
-            if total_creatures <= 0 and auto_restart:
-                window.fill(background_color)
-                zoo = start_new_simulation()
-                cycle_count = 0
+                                 (x, height + chart_height),
+                                 (x, height+chart_height - (total_creatures * chart_height /  POP_MAX)))
+                window.set_at((x, height + chart_height/2), background_color)
+
+            # print some statistics: minimum, average and maximum age,
+            # mouths, energy and generation
+            text_age = stats_font.render("age: %04d %04.2f %04d" % frame.age,
+                                         False, text_color, background_color)
+            text_mouths = stats_font.render("mouths: %04d %04.2f %04d" % frame.mouths,
+                                            False, text_color, background_color)
+            text_energy = stats_font.render("energy: %04d %04.2f %04d" % frame.energy,
+                                            False, text_color, background_color)
+            text_gen    = stats_font.render("gen: %04d %04.2f %04d" % frame.generation,
+                                            False, text_color, background_color)
+            text_pop    = stats_font.render("pop/keys: %04d/%04d sp: %d %.2f" %
+                                            (frame.population, frame.keys,
+                                             frame.species, frame.shannon),
+                                            False, text_color, background_color)
+            text_cycle  = stats_font.render("cycle: %012d%s" % (frame.cycle,
+                                                                " >>" if simulation.turbo or simulation.target else ""),
+                                            False, text_color, background_color)
+            text_height = max(text_age.get_height(), text_mouths.get_height(),
+                              text_energy.get_height(), text_energy.get_height(),
+                              text_gen.get_height(), text_pop.get_height(),
+                              text_cycle.get_height())
+
+            pygame.draw.rect(window, background_color, ((chart_width+1, height+1),
+                                                        (width - chart_width,
+                                                         chart_height)))
+            window.blit(text_age,    (chart_width+10, height + 10))
+            window.blit(text_mouths, (chart_width+10, height + 1*text_height + 10))
+            window.blit(text_energy, (chart_width+10, height + 2*text_height + 10))
+            window.blit(text_gen,    (chart_width+10, height + 3*text_height + 10))
+            window.blit(text_pop,    (chart_width+10, height + 4*text_height + 10))
+            window.blit(text_cycle,  (chart_width+10, height + 5*text_height + 10))
+            renderer.dirty(((0, height), (width, chart_height)))
 
         # handle events
         for event in pygame.event.get():
             if event.type == QUIT:
+                simulation.stop()
+                if lineage:
+                    lineage.close()
+                if recorder:
+                    recorder.close()
+                if replay:
+                    replay.close()
+                if viewer:
+                    viewer.close()
                 pygame.quit()
                 sys.exit()
             elif event.type == MOUSEBUTTONDOWN:
@@ -806,22 +2710,40 @@ if __name__  == "__main__":
             elif event.type == KEYDOWN:
                 if event.key == K_SPACE:
                     # toggle pausing
-                    paused = not paused
+                    simulation.paused = not simulation.paused
+                elif event.key == K_t:
+                    # toggle turbo: as many steps per frame as possible
+                    simulation.turbo = not simulation.turbo
+                elif event.key == K_f and replay:
+                    # seek some cycles forward
+                    simulation.command(lambda zoo: simulation.attach(zoo.seek(frame.cycle + FAST_FORWARD)))
+                elif event.key == K_b and replay:
+                    # seek some cycles back
+                    simulation.command(lambda zoo: simulation.attach(zoo.seek(frame.cycle - FAST_FORWARD)))
+                elif event.key == K_f and not viewer:
+                    # fast-forward some cycles
+                    simulation.target = frame.cycle + FAST_FORWARD
                 elif event.key == K_h:
                     # toggle horizontal wrapping
-                    zoo.wrap_horizontal = not zoo.wrap_horizontal
+                    simulation.command(lambda zoo: setattr(zoo, 'wrap_horizontal',
+                                                           not zoo.wrap_horizontal))
                 elif event.key == K_v:
                     # toggle vertical wrapping
-                    zoo.wrap_vertical = not zoo.wrap_vertical
+                    simulation.command(lambda zoo: setattr(zoo, 'wrap_vertical',
+                                                           not zoo.wrap_vertical))
                 elif event.key == K_d:
                     # toggle debugging
-                    debugging = not debugging
-                elif event.key == K_r:
+                    debugging = simulation.debugging = not debugging
+                elif event.key == K_r and replay:
+                    # play the replay back from the start
+                    simulation.command(lambda zoo: simulation.attach(zoo.seek(zoo.first)))
+                elif event.key == K_r and not viewer:
                     # start new simulation!
-                    window.fill(background_color)
-                    zoo = start_new_simulation()
-                    cycle_count = 0
+                    simulation.command(lambda zoo: simulation.attach(restart(zoo)))
+                elif event.key == K_s and args.engine == 'python' and not replay and not viewer:
+                    # save a checkpoint (not of a playback, which can't be
+                    # resumed faithfully)
+                    simulation.command(lambda zoo: zoo.save(args.save or 'biotopia.checkpoint'))
 
         # get mouse position
-        mouse_pos = pygame.mouse.get_pos()
-
+        mouse_pos = simulation.pointer = pygame.mouse.get_pos()
@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark suite for Biotopia.
+
+Runs fixed-seed simulation scenarios (the command line defaults, a dense late
+game population, a huge world, and wrapping instead of bouncing), reporting
+the steps/sec, the cost per creature step and the peak memory of each, and
+microbenchmarks of the creature structure analysis and mutations. Every
+scenario runs in its own process, so the peak memory is its own.
+
+The results are written to a JSON file, which may be compared against the
+results of a previous run, flagging the regressions. For example:
+
+    python biotopia_bench.py --output before.json
+    python biotopia_bench.py --output after.json --compare before.json
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["SCENARIOS", "scenario", "microbenchmarks", "compare", "run"]
+
+import json
+import platform
+import resource
+import sys
+from multiprocessing import Pool
+from random import Random
+from time import time
+
+from biotopia import Creature, analyze, ancestor, argument_parser, new_zoo
+
+#: Scenarios: name, simulation parameters (over the command line defaults),
+#: and the number of mutations of each ancestor
+SCENARIOS = [
+    ('default', {}, 0),
+    ('default-wrap', dict(wrap_horizontally=True, wrap_vertically=True), 0),
+    ('dense', dict(start_population=5000, start_keys=1000, start_food=150000), 8),
+    ('huge', dict(width=4000, height=3000, start_population=6250,
+                  start_keys=6250, start_food=1250000), 0),
+]
+
+def peak_memory():
+    "return the peak resident memory of this process, in kilobytes"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes in Mac OS X, kilobytes elsewhere
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+def scenario(task):
+    """
+    Run a scenario (in a worker process): create its zoo and step it "cycles"
+    times. Return its results.
+    """
+    name, parameters, mutations, engine, cycles, seed = task
+
+    args = argument_parser().parse_args([])
+    vars(args).update(parameters)
+    args.engine = engine
+    args.seed = seed
+    population = args.start_population
+    args.start_population = 0
+
+    start = time()
+    zoo = new_zoo(args)
+    rng = Random(seed)
+    creatures = []
+    for i in xrange(population):
+        creature = ancestor((rng.randint(0, args.width), rng.randint(0, args.height)),
+                            args.ancestors_energy, rng)
+        for j in xrange(mutations):
+            creature.mutate(rng)
+        creatures.append(creature)
+    if hasattr(zoo, 'append'):
+        zoo.append(creatures)
+    else:
+        zoo.creatures.extend(creatures)
+    setup = time() - start
+
+    creature_steps = 0
+    start = time()
+    for i in xrange(cycles):
+        creature_steps += len(zoo.creatures)
+        zoo.step()
+    elapsed = time() - start
+
+    return name, {'parameters': parameters,
+                  'mutations': mutations,
+                  'cycles': cycles,
+                  'setup_seconds': setup,
+                  'seconds': elapsed,
+                  'steps_per_second': cycles / elapsed if elapsed else 0.0,
+                  'creature_steps': creature_steps,
+                  'usec_per_creature_step': (elapsed * 1e6 / creature_steps
+                                             if creature_steps else 0.0),
+                  'final_population': len(zoo.creatures),
+                  'peak_memory_kb': peak_memory()}
+
+def microbenchmarks(task):
+    """
+    Time the structure analysis, and adding and removing random cells, over a
+    fixed corpus of creature structures (in a worker process). Return the
+    microseconds per call of each.
+    """
+    seed, size = task
+    rng = Random(seed)
+
+    # structures of 5 to 40 cells, grown by random mutations
+    corpus = []
+    creature = ancestor(rng=rng)
+    while len(corpus) < size:
+        creature.add_random_cell(rng)
+        if len(creature.cells) >= 40:
+            creature = ancestor(rng=rng)
+        corpus.append(frozenset(creature.cells))
+
+    def measure(operation):
+        elapsed = 0.0
+        for cells in corpus:
+            creature = Creature((0, 0), cells)
+            start = time()
+            operation(creature)
+            elapsed += time() - start
+        return {'calls': len(corpus), 'usec_per_call': elapsed * 1e6 / len(corpus)}
+
+    results = {'analyze': measure(lambda c: analyze(c.cells)),
+               'add_random_cell': measure(lambda c: c.add_random_cell(rng)),
+               'remove_random_cell': measure(lambda c: c.remove_random_cell(rng))}
+    results['peak_memory_kb'] = peak_memory()
+    return results
+
+#: Measures compared between runs, and whether higher is better
+MEASURES = [('steps_per_second', True), ('usec_per_creature_step', False),
+            ('usec_per_call', False), ('peak_memory_kb', False)]
+
+def compare(previous, current, tolerance):
+    """
+    Compare two results and return (report lines, regressions count): a
+    measure regresses if it's worse than the previous by more than
+    "tolerance" (a proportion).
+    """
+    lines = []
+    regressions = 0
+    sections = [('scenarios', name) for name in sorted(current['scenarios'])]
+    sections += [('micro', name) for name in sorted(current['micro'])
+                 if isinstance(current['micro'][name], dict)]
+    for section, name in sections:
+        before = previous.get(section, {}).get(name)
+        after = current[section][name]
+        if not isinstance(before, dict):
+            continue
+        for measure, higher_is_better in MEASURES:
+            if measure not in after or not before.get(measure):
+                continue
+            ratio = after[measure] / float(before[measure])
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            regressions += worse
+            lines.append("%-20s %-24s %12.2f %12.2f %7.2fx%s" %
+                         (name, measure, before[measure], after[measure], ratio,
+                          "  REGRESSION" if worse else ""))
+    return lines, regressions
+
+def run(engine, cycles, seed, corpus, only=None, processes=1):
+    """
+    Run the scenarios (or "only" the named ones) and the microbenchmarks,
+    each in a fresh worker process. Return the results.
+    """
+    tasks = [(name, parameters, mutations, engine, cycles, seed)
+             for name, parameters, mutations in SCENARIOS
+             if not only or name in only]
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        scenarios = dict(pool.map(scenario, tasks, chunksize=1))
+        micro = pool.apply(microbenchmarks, ((seed, corpus),))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': engine,
+            'cycles': cycles,
+            'seed': seed,
+            'scenarios': scenarios,
+            'micro': micro}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Biotopia - benchmark suite")
+    parser.add_argument('--engine', '-E', default='python', choices=('python', 'numpy'),
+                        dest='engine', help="The simulation engine to benchmark")
+    parser.add_argument('--cycles', '-n', default=200, type=int, metavar='CYCLES',
+                        dest='cycles', help="The number of cycles of each scenario")
+    parser.add_argument('--seed', '-s', default=1, type=int, metavar='SEED',
+                        dest='seed', help="The random generator seed of every scenario")
+    parser.add_argument('--corpus', default=2000, type=int, metavar='AMOUNT',
+                        dest='corpus', help="The number of structures of the microbenchmarks")
+    parser.add_argument('--scenario', default=[], action='append', metavar='NAME',
+                        choices=[name for name, parameters, mutations in SCENARIOS],
+                        dest='scenarios', help="Run only this scenario (may be repeated)")
+    parser.add_argument('--processes', '-j', default=1, type=int, metavar='AMOUNT',
+                        dest='processes', help="The number of scenarios run at once (more than one skews the timings)")
+    parser.add_argument('--output', '-o', default='benchmark.json', metavar='PATH',
+                        dest='output', help="The result file")
+    parser.add_argument('--compare', default=None, metavar='PATH',
+                        dest='compare', help="A previous result file to compare with (exits with status 1 on regressions)")
+    parser.add_argument('--tolerance', '-t', default=0.1, type=float, metavar='PROPORTION',
+                        dest='tolerance', help="How much worse than the previous result a measure may be")
+    args = parser.parse_args()
+
+    results = run(args.engine, args.cycles, args.seed, args.corpus,
+                  args.scenarios, args.processes)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+    for name, result in sorted(results['scenarios'].iteritems()):
+        print "%-20s %10.2f steps/sec %8.2f usec/creature step %10d KB" % (
+            name, result['steps_per_second'], result['usec_per_creature_step'],
+            result['peak_memory_kb'])
+    for name, result in sorted(results['micro'].iteritems()):
+        if isinstance(result, dict):
+            print "%-20s %10.2f usec/call" % (name, result['usec_per_call'])
+
+    if args.compare:
+        with open(args.compare) as previous:
+            lines, regressions = compare(json.load(previous), results, args.tolerance)
+        print
+        print "%-20s %-24s %12s %12s %8s" % ('', 'measure', 'before', 'after', 'ratio')
+        for line in lines:
+            print line
+        sys.exit(1 if regressions else 0)
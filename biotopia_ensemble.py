@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+Ensemble and parameter sweep runner for Biotopia.
+
+Runs independent headless simulations, for every combination of a grid of
+parameters and a number of replicates, across a pool of worker processes.
+Each completed run is appended to a single result file, as a JSON line with
+its parameters and the time series of its summary statistics (population,
+keys, food, mean mouths, max generation, and the number of species and their
+Shannon diversity). Runs already in the result file
+(with the same simulation parameters and cycles) are skipped, so an interrupted
+sweep is resumed by running it again.
+
+Any other argument is a simulation parameter, as in biotopia.py (see
+--help-simulation). For example:
+
+    python biotopia_ensemble.py --grid mutation_probability=0.1,0.2,0.4 \\
+        --grid energy_gain=10,20 --replicates 5 --cycles 100000 \\
+        --output sweep.jsonl -- --start-food 20000
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["tasks", "run", "sweep"]
+
+import json
+import sys
+from itertools import product
+from multiprocessing import Pool, cpu_count
+from zlib import crc32
+
+from biotopia import argument_parser, bound, check_arguments, new_zoo
+
+#: The arguments of biotopia.py that change the results of a headless run (the
+#: tiled engine's are left out, as it doesn't run in sweeps), so they identify
+#: the runs; the others (display, output, recording...) don't
+SIMULATION_PARAMETERS = ('width', 'height', 'ancestors_energy',
+                         'offspring_energy', 'energy_loss', 'energy_gain',
+                         'start_food', 'start_keys', 'start_population',
+                         'mutation_probability', 'wrap_vertically',
+                         'wrap_horizontally', 'seed', 'chunk',
+                         'population_cap', 'cull', 'memory_budget', 'engine')
+
+def parse_grid(definitions, parser):
+    """
+    Parse the "name=value,value,..." grid definitions into a list of (name,
+    values) pairs, converting the values as the simulation "parser" converts
+    the parameter's argument (flags are true for 1, true or yes).
+    """
+    actions = dict((action.dest, action) for action in parser._actions)
+    grid = []
+    for definition in definitions:
+        name, _, values = definition.partition('=')
+        name = name.strip().replace('-', '_')
+        action = actions.get(name)
+        if action is None or action.dest == 'help':
+            raise ValueError("Unknown simulation parameter: %s" % name)
+        if action.nargs == 0:
+            kind = lambda v: v.strip().lower() in ('1', 'true', 'yes')
+        else:
+            kind = action.type or str
+        converted = [kind(v) for v in values.split(',')]
+        for value in converted:
+            if action.choices and value not in action.choices:
+                raise ValueError("Invalid %s: %s (choose from %s)" %
+                                 (name, value, ", ".join(map(str, action.choices))))
+        grid.append((name, converted))
+    return grid
+
+def tasks(grid, replicates, base, cycles):
+    """
+    Generate the runs of the sweep: a (key, parameters, replicate) tuple for
+    each combination of the grid values and replicate. The key identifies the
+    run in the result file: it holds the base simulation parameters (but those
+    of the grid) and cycles too, so runs of other settings are never taken for
+    it.
+    """
+    names = [name for name, values in grid]
+    settings = dict((name, base[name]) for name in SIMULATION_PARAMETERS
+                    if name not in names)
+    settings['cycles'] = cycles
+    for values in product(*[values for name, values in grid]):
+        parameters = dict(zip(names, values))
+        for replicate in xrange(replicates):
+            key = json.dumps([parameters, replicate, settings], sort_keys=True)
+            yield key, parameters, replicate
+
+def check(settings):
+    """
+    Check that the simulation parameters "settings" (a dict of the arguments
+    of biotopia.py) can be run in the sweep, as headless runs, raising a
+    ValueError with the reason if they can't.
+    """
+    if settings['engine'] == 'tiled':
+        raise ValueError("the tiled engine can't run in the pool's worker processes")
+    args = argument_parser().parse_args([])
+    vars(args).update(settings)
+    args.headless = True
+    check_arguments(args)
+
+def run(task):
+    """
+    Run a single simulation of the sweep (in a worker process) and return its
+    result record. The seed is derived from the run key and the base seed, so
+    every run is reproducible.
+    """
+    key, parameters, replicate, base, cycles, sample_every = task
+
+    args = argument_parser().parse_args([])
+    vars(args).update(base)
+    vars(args).update(parameters)
+    seed = (crc32(key) ^ (args.seed or 0)) & 0xffffffff
+    zoo = bound(new_zoo(args, seed), args)
+    try:
+        return simulate(zoo, key, parameters, replicate, seed, cycles, sample_every)
+    finally:
+        if hasattr(zoo, 'close'):
+            zoo.close()
+
+def simulate(zoo, key, parameters, replicate, seed, cycles, sample_every):
+    "step a run's zoo for \"cycles\" cycles (or until extinction) and return its result record"
+    samples = []
+    def sample():
+        statistics = zoo.statistics
+        samples.append({'cycle': zoo.cycle,
+                        'population': statistics.population,
+                        'keys': len(zoo.keys),
+                        'food': len(zoo.food),
+                        'mean_mouths': statistics.mouths[1],
+                        'max_generation': statistics.generation[2],
+                        'species': statistics.diversity[0],
+                        'shannon': statistics.diversity[1]})
+
+    extinct = None
+    while zoo.cycle < cycles:
+        if zoo.cycle % sample_every == 0:
+            sample()
+        zoo.step()
+        if not zoo.creatures:
+            extinct = zoo.cycle
+            break
+    sample()
+
+    return {'key': key, 'parameters': parameters, 'replicate': replicate,
+            'seed': seed, 'extinct': extinct, 'samples': samples}
+
+def terminate(path):
+    """
+    End the result file with a newline, if it doesn't (as when a sweep was
+    interrupted while writing a result), so the next result starts a line.
+    """
+    try:
+        with open(path, 'rb+') as results:
+            results.seek(0, 2)
+            if results.tell():
+                results.seek(-1, 2)
+                if results.read(1) != '\n':
+                    results.write('\n')
+    except IOError:
+        pass
+
+def completed(path):
+    "return the keys of the runs already in the result file"
+    keys = set()
+    try:
+        with open(path) as results:
+            for line in results:
+                try:
+                    keys.add(json.loads(line)['key'])
+                except (ValueError, KeyError):
+                    # partially written line, of an interrupted sweep
+                    pass
+    except IOError:
+        pass
+    return keys
+
+def sweep(grid, replicates, base, cycles, sample_every, output,
+          processes=None, log=None):
+    """
+    Run all the runs of the sweep not yet in the "output" result file, across
+    a pool of "processes" workers (one per core by default), appending each
+    result as soon as it completes. Returns the number of runs performed.
+    """
+    done = completed(output)
+    pending = [(key, parameters, replicate, base, cycles, sample_every)
+               for key, parameters, replicate in tasks(grid, replicates, base, cycles)
+               if key not in done]
+    if log:
+        log.write("%d runs to go (%d already done)\n" % (len(pending), len(done)))
+    if not pending:
+        return 0
+
+    terminate(output)
+    pool = Pool(processes or cpu_count())
+    try:
+        with open(output, 'a') as results:
+            for i, result in enumerate(pool.imap_unordered(run, pending)):
+                results.write(json.dumps(result, sort_keys=True) + '\n')
+                results.flush()
+                if log:
+                    log.write("[%d/%d] %s\n" % (i + 1, len(pending),
+                                                  json.dumps([result['parameters'],
+                                                              result['replicate']],
+                                                             sort_keys=True)))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return len(pending)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Biotopia - ensemble and parameter sweep runner")
+    parser.add_argument('--grid', '-g', default=[], action='append', metavar='NAME=VALUES',
+                        dest='grid', help="A swept parameter and its comma separated values (may be repeated)")
+    parser.add_argument('--replicates', '-r', default=1, type=int, metavar='AMOUNT',
+                        dest='replicates', help="The number of independent runs of each combination")
+    parser.add_argument('--cycles', '-n', default=100000, type=int, metavar='CYCLES',
+                        dest='cycles', help="The number of cycles of each run (or until extinction)")
+    parser.add_argument('--sample-every', '-e', default=1000, type=int, metavar='CYCLES',
+                        dest='sample_every', help="The period of the summary statistics samples")
+    parser.add_argument('--output', '-o', default='sweep.jsonl', metavar='PATH',
+                        dest='output', help="The result file (existing runs in it are skipped)")
+    parser.add_argument('--processes', '-j', default=None, type=int, metavar='AMOUNT',
+                        dest='processes', help="The number of worker processes (default: one per core)")
+    parser.add_argument('--help-simulation', default=False, action='store_true',
+                        dest='help_simulation', help="Show the simulation parameters and exit")
+    args, simulation = parser.parse_known_args()
+
+    if args.help_simulation:
+        argument_parser().print_help()
+        sys.exit(0)
+
+    if simulation[:1] == ['--']:
+        simulation = simulation[1:]
+    base = vars(argument_parser().parse_args(simulation))
+
+    try:
+        grid = parse_grid(args.grid, argument_parser())
+        names = [name for name, values in grid]
+        for values in product(*[values for name, values in grid]):
+            check(dict(base, **dict(zip(names, values))))
+    except ValueError as error:
+        parser.error(str(error))
+
+    sweep(grid, args.replicates, base, args.cycles, args.sample_every,
+          args.output, args.processes, sys.stderr)
@@ -0,0 +1,308 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+Lineage recording for Biotopia simulations.
+
+A LineageRecorder, attached to a Zoo as its "lineage", is told of every birth. It gives
+each recorded creature and each distinct genome an identifier, and appends a
+fixed-size record (child, parent, genome, cycle, mutated) for each creature to
+a log file, and the cells of each genome, the first time one is recorded, to
+a companion ".genomes" file. Records are written in batches, and nothing else
+is kept in memory but the identifiers of the living genomes, so its memory
+use doesn't grow with the length of the run.
+
+Creatures are identified in the order they're recorded, starting from one,
+so a LineageReader finds the record of any creature directly, and walks its
+ancestry (or streams its descendants) without loading the log. For example:
+
+    python biotopia_lineage.py lineage.log --ancestry 123456
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["Birth", "LineageRecorder", "LineageReader"]
+
+import mmap
+import os
+import struct
+from array import array
+from collections import namedtuple
+from itertools import chain, count
+from weakref import WeakKeyDictionary
+
+#: Lineage files signature and format version
+LINEAGE_MAGIC = 'BIOLINEA'
+GENOMES_MAGIC = 'BIOGENOM'
+LINEAGE_VERSION = 1
+
+#: Lineage files header: magic and version
+LINEAGE_HEADER = '<8sH'
+
+#: Lineage record: child, parent (zero for ancestors), genome, the cycle of
+#: the birth, and whether the child is a mutation
+LINEAGE_RECORD = '<QQIQ?'
+
+#: Genome record: identifier and number of cells, followed by the cells'
+#: coordinates (in orientation zero)
+GENOME_RECORD = '<II'
+
+#: A record of the lineage log
+Birth = namedtuple('Birth', 'child parent genome cycle mutated')
+
+def open_log(path, magic, whole):
+    """
+    Open a lineage file for appending, writing its header if it's new. The
+    tail of an existing file past "whole(contents)", the length of its whole
+    records, is cut: a record partly written by a run that was killed would
+    shift every record appended after it. Return the file.
+    """
+    if os.path.exists(path) and os.path.getsize(path):
+        check_header(path, magic)
+        buffer = map_file(path)
+        try:
+            length = whole(buffer)
+        finally:
+            buffer.close()
+        log = open(path, 'ab')
+        if length < os.path.getsize(path):
+            log.truncate(length)
+        return log
+    log = open(path, 'ab')
+    log.write(struct.pack(LINEAGE_HEADER, magic, LINEAGE_VERSION))
+    log.flush()
+    return log
+
+def check_header(path, magic):
+    "raise ValueError if a file isn't a lineage file of the current version"
+    with open(path, 'rb') as log:
+        header = log.read(struct.calcsize(LINEAGE_HEADER))
+    if len(header) < struct.calcsize(LINEAGE_HEADER):
+        raise ValueError("Invalid lineage file: %s" % path)
+    file_magic, version = struct.unpack(LINEAGE_HEADER, header)
+    if file_magic != magic:
+        raise ValueError("Invalid lineage file: %s" % path)
+    if version != LINEAGE_VERSION:
+        raise ValueError("Unsupported lineage file version: %d" % version)
+
+def map_file(path):
+    "return a read-only memory map of a file"
+    with open(path, 'rb') as mapped:
+        return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+def genome_offsets(buffer):
+    "return the offsets of the whole records of a genomes file, in an array"
+    offsets = array('L')
+    offset = struct.calcsize(LINEAGE_HEADER)
+    while offset + struct.calcsize(GENOME_RECORD) <= len(buffer):
+        identifier, length = struct.unpack_from(GENOME_RECORD, buffer, offset)
+        end = offset + struct.calcsize(GENOME_RECORD) + 8 * length
+        if end > len(buffer):
+            break
+        offsets.append(offset)
+        offset = end
+    return offsets
+
+def log_length(buffer):
+    "return the length of the whole records of a lineage log"
+    header = struct.calcsize(LINEAGE_HEADER)
+    size = struct.calcsize(LINEAGE_RECORD)
+    return header + (len(buffer) - header) // size * size
+
+def genomes_length(buffer):
+    "return the length of the whole records of a genomes file"
+    offsets = genome_offsets(buffer)
+    if not offsets:
+        return struct.calcsize(LINEAGE_HEADER)
+    identifier, length = struct.unpack_from(GENOME_RECORD, buffer, offsets[-1])
+    return offsets[-1] + struct.calcsize(GENOME_RECORD) + 8 * length
+
+class LineageRecorder(object):
+    """
+    Records the births of a zoo to the lineage log at "path", and the genomes
+    to "path.genomes", buffering "batch" records. An existing log is continued:
+    the identifiers go on from the last whole records in it. Call close() at
+    the end.
+    """
+
+    def __init__(self, path, batch=4096):
+        self.path = path
+        self.batch = batch
+        self.log = open_log(path, LINEAGE_MAGIC, log_length)
+        self.genomes_log = open_log(path + '.genomes', GENOMES_MAGIC, genomes_length)
+
+        # continue the identifiers of an existing log
+        self.creature_ids = count((os.path.getsize(path) - struct.calcsize(LINEAGE_HEADER)) //
+                                  struct.calcsize(LINEAGE_RECORD) + 1)
+        buffer = map_file(path + '.genomes')
+        try:
+            self.genome_ids = count(len(genome_offsets(buffer)) + 1)
+        finally:
+            buffer.close()
+
+        # the identifiers of the living genomes already recorded
+        self.recorded = WeakKeyDictionary()
+        self.records = []
+        self.genomes = []
+
+    def attach(self, zoo):
+        """
+        Record the births of a zoo, setting the recorder as its lineage. The
+        identifiers of its genomes already recorded (as restored from a
+        checkpoint) are kept, and the zoo shares the recorder's from then on,
+        so its checkpoints keep them.
+        """
+        self.recorded.update(zoo.genome_ids)
+        zoo.genome_ids = self.recorded
+        zoo.lineage = self
+
+    def birth(self, child, parent, mutated, cycle):
+        """
+        Record the birth of "child", from "parent", at a cycle. A parent not
+        yet recorded (an ancestor) is recorded first, born "parent.age" cycles
+        before, from no parent.
+        """
+        if not parent.id:
+            self.record(parent, 0, False, cycle - parent.age)
+        self.record(child, parent.id, mutated, cycle)
+
+    def record(self, creature, parent_id, mutated, cycle):
+        "give a creature an identifier, and append its record"
+        creature.id = next(self.creature_ids)
+        genome = creature.genome
+        genome_id = self.recorded.get(genome)
+        if genome_id is None:
+            genome_id = self.recorded[genome] = next(self.genome_ids)
+            cells = genome.cells[0]
+            self.genomes.append(struct.pack(GENOME_RECORD, genome_id, len(cells)))
+            self.genomes.append(struct.pack('<%di' % (2 * len(cells)),
+                                            *chain.from_iterable(cells)))
+        self.records.append(struct.pack(LINEAGE_RECORD, creature.id, parent_id,
+                                        genome_id, cycle, mutated))
+        if len(self.records) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        "write the buffered records (genomes first, so records never miss theirs)"
+        self.genomes_log.write(''.join(self.genomes))
+        self.genomes_log.flush()
+        self.log.write(''.join(self.records))
+        self.log.flush()
+        self.genomes = []
+        self.records = []
+
+    def close(self):
+        "write the buffered records and close the files"
+        self.flush()
+        self.log.close()
+        self.genomes_log.close()
+
+class LineageReader(object):
+    """
+    Reads a lineage log (and its ".genomes" file), mapped in memory rather than
+    loaded: records are looked up by creature identifier directly. Call close()
+    at the end.
+    """
+
+    def __init__(self, path):
+        check_header(path, LINEAGE_MAGIC)
+        check_header(path + '.genomes', GENOMES_MAGIC)
+        self.buffer = map_file(path)
+        self.genomes_buffer = map_file(path + '.genomes')
+        self.header = struct.calcsize(LINEAGE_HEADER)
+        self.size = struct.calcsize(LINEAGE_RECORD)
+        # the genome records' offsets, found on demand
+        self.offsets = None
+
+    def __len__(self):
+        return (len(self.buffer) - self.header) // self.size
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, first=1):
+        "iterate the records, from the one of the \"first\" creature identifier"
+        for offset in xrange(self.header + (first - 1) * self.size,
+                             self.header + len(self) * self.size, self.size):
+            yield Birth._make(struct.unpack_from(LINEAGE_RECORD, self.buffer, offset))
+
+    def record(self, creature_id):
+        "return the record of a creature"
+        if not 1 <= creature_id <= len(self):
+            raise KeyError(creature_id)
+        return Birth._make(struct.unpack_from(LINEAGE_RECORD, self.buffer,
+                                              self.header + (creature_id - 1) * self.size))
+
+    def ancestry(self, creature_id):
+        "iterate the records of a creature, its parent, and so on up to its ancestor"
+        while creature_id:
+            record = self.record(creature_id)
+            yield record
+            creature_id = record.parent
+
+    def descendants(self, creature_id):
+        """
+        Iterate the records of the descendants of a creature, in order of
+        birth. Only the identifiers of the descendants are kept.
+        """
+        family = set([creature_id])
+        for record in self.records(creature_id + 1):
+            if record.parent in family:
+                family.add(record.child)
+                yield record
+
+    def genome(self, genome_id):
+        "return the cells of a genome (in orientation zero), as a frozenset"
+        if self.offsets is None:
+            self.offsets = genome_offsets(self.genomes_buffer)
+        if not 1 <= genome_id <= len(self.offsets):
+            raise KeyError(genome_id)
+        offset = self.offsets[genome_id - 1]
+        identifier, length = struct.unpack_from(GENOME_RECORD, self.genomes_buffer, offset)
+        values = struct.unpack_from('<%di' % (2 * length), self.genomes_buffer,
+                                    offset + struct.calcsize(GENOME_RECORD))
+        return frozenset(zip(values[::2], values[1::2]))
+
+    def close(self):
+        self.buffer.close()
+        self.genomes_buffer.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Biotopia - lineage log reader")
+    parser.add_argument('path', metavar='PATH', help="The lineage log")
+    parser.add_argument('--ancestry', '-a', default=None, type=int, metavar='ID',
+                        dest='ancestry', help="Show the ancestry of a creature, up to its ancestor")
+    parser.add_argument('--descendants', '-d', default=None, type=int, metavar='ID',
+                        dest='descendants', help="Show the descendants of a creature")
+    args = parser.parse_args()
+
+    try:
+        reader = LineageReader(args.path)
+    except (IOError, ValueError) as error:
+        parser.error(str(error))
+
+    def show(record):
+        print "creature: %d parent: %d genome: %d (%d cells) cycle: %d%s" % (
+            record.child, record.parent, record.genome,
+            len(reader.genome(record.genome)), record.cycle,
+            " mutated" if record.mutated else "")
+
+    try:
+        if args.ancestry is not None:
+            for record in reader.ancestry(args.ancestry):
+                show(record)
+        elif args.descendants is not None:
+            show(reader.record(args.descendants))
+            for record in reader.descendants(args.descendants):
+                show(record)
+        else:
+            ancestors = mutations = 0
+            for record in reader:
+                ancestors += not record.parent
+                mutations += record.mutated
+            print "%d creatures (%d ancestors, %d mutations)" % (len(reader), ancestors, mutations)
+    except KeyError as error:
+        parser.error("unknown creature or genome: %s" % error)
+    finally:
+        reader.close()
@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""
+Live telemetry of Biotopia simulations.
+
+A MetricsServer serves the metrics of a running zoo over HTTP, in the
+Prometheus text format: the steps and their rate, the latency percentiles of
+the latest steps, the population and the food and key totals, the births,
+deaths and meals (and, if the zoo is profiled, the mutations, bounces and the
+time of each phase of the steps), the time of the bookkeeping passes between
+steps, and the resident memory of the process (and of its tile workers, with
+the tiled engine). See --metrics:
+
+    python biotopia.py --headless --metrics 9100
+    curl localhost:9100/metrics
+
+The requests are served by a background thread. The simulation only adds up
+the counts of each step, and publishes them whole by replacing a single
+attribute: the serving thread never holds anything the step waits for.
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["MetricsServer"]
+
+from array import array
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from time import time
+
+from biotopia import Profile, resident_memory
+
+#: Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: The step latency quantiles served
+QUANTILES = (0.5, 0.9, 0.99)
+
+#: The events counted only while profiled (the rest are counted from the
+#: particle changes of every step)
+PROFILED_EVENTS = ('mutations', 'bounces')
+
+def number(value):
+    "format a sample value (integers without a fraction)"
+    return repr(value) if isinstance(value, float) else "%d" % value
+
+def family(lines, name, kind, description, samples):
+    "append a metric family, with its (labels, value) samples, to lines"
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for labels, value in samples:
+        lines.append("%s%s %s" % (name, labels, number(value)))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    "Serves the metrics of the server's MetricsServer at /metrics"
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(object):
+    """
+    Serves the metrics of the zoo given to observe after each step at
+    "address" (host, port; port zero picks a free one, in "self.address").
+    The steps rate and latency percentiles are of the last "window" steps.
+    Call close() at the end.
+    """
+
+    def __init__(self, address, window=1024):
+        self.window = window
+        # the latency and end time of the last steps, in rings
+        self.latencies = array('d', [0.0]) * window
+        self.finished = array('d', [0.0]) * window
+        self.steps = 0
+        self.latency_sum = 0.0
+        self.events = {}
+        self.phases = {}
+        self.passes = {}
+        # the steps, elapsed time, times and counts of the profile when last
+        # observed
+        self.seen = (0, 0.0, dict.fromkeys(Profile.PHASES, 0.0),
+                     dict.fromkeys(Profile.EVENTS, 0))
+        # the metrics of the last step, replaced whole
+        self.sample = None
+
+        self.server = HTTPServer(address, MetricsHandler)
+        self.server.metrics = self
+        self.address = self.server.server_address
+        self.thread = Thread(target=self.server.serve_forever, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def spend(self, name, seconds):
+        "add the time of a bookkeeping pass between steps"
+        self.passes[name] = self.passes.get(name, 0.0) + seconds
+
+    def observe(self, zoo, latency):
+        "add up the last step of a zoo, which took \"latency\" seconds, and publish it"
+        slot = self.steps % self.window
+        self.latencies[slot] = latency
+        self.finished[slot] = time()
+        self.steps += 1
+        self.latency_sum += latency
+
+        events = self.events
+        if hasattr(zoo, 'keys_removed'):
+            # every food and key eaten is a meal and a birth, and every death
+            # leaves a key
+            for event, changes in (('meals', zoo.food_removed),
+                                   ('births', zoo.keys_removed),
+                                   ('deaths', zoo.keys_added)):
+                events[event] = events.get(event, 0) + len(changes) // 2
+        elif hasattr(zoo, 'events'):
+            # counted by the workers of a tiled zoo
+            for event, value in zoo.events.iteritems():
+                events[event] = events.get(event, 0) + value
+        profile = getattr(zoo, 'profile', None)
+        if profile:
+            self.profiled(profile)
+
+        # the rings are copied, as the next steps overwrite them while served
+        count = min(self.steps, self.window)
+        self.sample = dict(cycle = zoo.cycle, steps = self.steps,
+                           latencies = self.latencies[:count],
+                           finished = self.finished[:count],
+                           latency_sum = self.latency_sum,
+                           population = len(zoo.creatures),
+                           food = len(zoo.food), keys = len(zoo.keys),
+                           events = dict(events), phases = dict(self.phases),
+                           passes = dict(self.passes),
+                           workers = zoo.memory() if hasattr(zoo, 'tiles') else None)
+
+    def profiled(self, profile):
+        """
+        Add up what a profile accumulated since last observed, a step before
+        (unless it was reset since).
+        """
+        steps, elapsed, times, counts = self.seen
+        if profile.steps <= steps:
+            steps, elapsed = 0, 0.0
+            times = dict.fromkeys(Profile.PHASES, 0.0)
+            counts = dict.fromkeys(Profile.EVENTS, 0)
+        phases = self.phases
+        other = profile.elapsed - elapsed
+        for phase in Profile.PHASES:
+            spent = profile.times[phase] - times[phase]
+            phases[phase] = phases.get(phase, 0.0) + spent
+            other -= spent
+        phases['other'] = phases.get('other', 0.0) + other
+        for event in PROFILED_EVENTS:
+            self.events[event] = (self.events.get(event, 0) +
+                                  profile.counts[event] - counts[event])
+        self.seen = (profile.steps, profile.elapsed, dict(profile.times),
+                     dict(profile.counts))
+
+    def exposition(self):
+        "return the metrics of the last step published, in the Prometheus text format"
+        lines = []
+        sample = self.sample
+        if sample is not None:
+            steps = sample['steps']
+            count = min(steps, self.window)
+            latencies = sorted(sample['latencies'])
+            finished = sample['finished']
+            newest = (steps - 1) % self.window
+            oldest = steps % self.window if steps > self.window else 0
+            period = finished[newest] - finished[oldest]
+
+            family(lines, 'biotopia_cycle', 'gauge', "The cycle of the simulation.",
+                   [('', sample['cycle'])])
+            family(lines, 'biotopia_steps_total', 'counter', "The steps performed.",
+                   [('', steps)])
+            family(lines, 'biotopia_steps_per_second', 'gauge',
+                   "The rate of the last steps, bookkeeping included.",
+                   [('', (count - 1) / period if period > 0 else 0.0)])
+            family(lines, 'biotopia_step_latency_seconds', 'summary',
+                   "The time of the steps (quantiles of the last ones).",
+                   [('{quantile="%s"}' % q, latencies[min(int(q * count), count - 1)])
+                    for q in QUANTILES])
+            lines.append("biotopia_step_latency_seconds_sum %s" % number(sample['latency_sum']))
+            lines.append("biotopia_step_latency_seconds_count %d" % steps)
+            family(lines, 'biotopia_population', 'gauge', "The living creatures.",
+                   [('', sample['population'])])
+            family(lines, 'biotopia_food', 'gauge', "The food particles.",
+                   [('', sample['food'])])
+            family(lines, 'biotopia_keys', 'gauge', "The key particles.",
+                   [('', sample['keys'])])
+            for event, value in sorted(sample['events'].iteritems()):
+                family(lines, 'biotopia_%s_total' % event, 'counter',
+                       "The %s of the creatures." % event, [('', value)])
+            if sample['phases']:
+                family(lines, 'biotopia_phase_seconds_total', 'counter',
+                       "The time of each phase of the profiled steps.",
+                       [('{phase="%s"}' % phase, spent)
+                        for phase, spent in sorted(sample['phases'].iteritems())])
+            if sample['passes']:
+                family(lines, 'biotopia_pass_seconds_total', 'counter',
+                       "The time of each bookkeeping pass between steps.",
+                       [('{pass="%s"}' % name, spent)
+                        for name, spent in sorted(sample['passes'].iteritems())])
+            if sample['workers'] is not None:
+                family(lines, 'biotopia_workers_resident_memory_bytes', 'gauge',
+                       "The resident memory of the worker processes (of the tiles).",
+                       [('', sample['workers'])])
+
+        memory = resident_memory()
+        if memory is not None:
+            family(lines, 'process_resident_memory_bytes', 'gauge',
+                   "The resident memory of the process.", [('', memory)])
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        "stop serving"
+        self.server.shutdown()
+        self.server.server_close()
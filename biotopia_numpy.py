@@ -0,0 +1,545 @@
+# coding: utf-8
+
+"""
+A NumPy simulation engine for Biotopia.
+
+NumpyZoo is built from the same parameters as biotopia.Zoo, but it holds the
+creatures as a structure of arrays (positions, energy, age, generation,
+movement phase and genome index) and the food and key particles as dense count
+grids. Feeding, energy loss, movement, collisions and deaths are then performed
+as batched array operations, instead of a Python loop over every creature and
+every mouth.
+
+Creature structures (genomes) are interned in a table: each distinct set of
+cells is analyzed once, and creatures only refer to it by index.
+
+The results are statistically equivalent to biotopia.Zoo, but not identical:
+when more mouths than particles probe the same place at the same step, the
+winners are chosen at random instead of by the iteration order of the
+creatures.
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["NumpyZoo"]
+
+from itertools import chain
+from random import Random
+
+import numpy
+
+from biotopia import (Census, Creature, CreatureIndex, ancestor, report_changes,
+                      HEAD, BODY, NEWBORN, DYING)
+
+def expand(starts, counts, genomes):
+    """
+    Expand per-genome variable length items (cells, mouths or movements) for
+    each creature of "genomes". Return the creature index and the item table
+    index for every expanded item.
+    """
+    counts = counts[genomes]
+    owners = numpy.repeat(numpy.arange(len(genomes)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return owners, starts[genomes][owners] + offsets
+
+class Genomes(object):
+    """
+    Table of interned creature structures. Each structure is analyzed only
+    once, and the mouths, cells and movement cycles of all of them are kept in
+    flat arrays, indexed by the genome's start offset and count.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.prototypes = []
+        self.transforms = {}
+        self.extent = 0
+        self.tables = None
+
+    def intern(self, cells):
+        "return the genome index of the structure, with head at (0,0)"
+        key = frozenset(cells)
+        genome = self.index.get(key)
+        if genome is None:
+            prototype = Creature((0, 0), key, (0, 0))
+            genome = self.index[key] = len(self.prototypes)
+            self.prototypes.append(prototype)
+            self.extent = max(self.extent,
+                              max(max(abs(c[0]), abs(c[1])) for c in
+                                  chain(prototype.cells, prototype.mouths)))
+            self.tables = None
+        return genome
+
+    def transform(self, genome, operation):
+        """
+        return the genome index of the structure after an operation, which is
+        one of Creature's rotation or mirror method names
+        """
+        key = (genome, operation)
+        result = self.transforms.get(key)
+        if result is None:
+            creature = Creature((0, 0), self.prototypes[genome].cells, (0, 0))
+            getattr(creature, operation)()
+            result = self.transforms[key] = self.intern(creature.cells)
+        return result
+
+    def transform_all(self, genomes, operation):
+        "transform an array of genome indexes"
+        return numpy.array([self.transform(g, operation) for g in genomes],
+                           dtype=numpy.int32)
+
+    def mutated(self, genome, rng):
+        "return the genome index of a random mutation of the structure"
+        creature = Creature((0, 0), self.prototypes[genome].cells, (0, 0))
+        creature.mutate(rng)
+        return self.intern(creature.cells)
+
+    def arrays(self):
+        """
+        Return the flat tables (as a dictionary of arrays), rebuilding them if
+        new genomes were interned since the last call.
+        """
+        if self.tables is None:
+            tables = {}
+            for name, items in (('cell', lambda p: sorted(p.cells)),
+                                ('mouth', lambda p: sorted(p.mouths)),
+                                ('move', lambda p: p.movements)):
+                values = [items(p) for p in self.prototypes]
+                counts = numpy.array([len(v) for v in values], dtype=numpy.int64)
+                flat = list(chain.from_iterable(values))
+                tables[name + '_count'] = counts
+                tables[name + '_start'] = numpy.cumsum(counts) - counts
+                tables[name + '_x'] = numpy.array([c[0] for c in flat], dtype=numpy.int32)
+                tables[name + '_y'] = numpy.array([c[1] for c in flat], dtype=numpy.int32)
+            tables['cell_head'] = (tables['cell_x'] == 0) & (tables['cell_y'] == 0)
+            self.tables = tables
+        return self.tables
+
+class DenseParticles(object):
+    """
+    A multi-set of particles positions stored as a dense grid of counts. The
+    grid covers the environment plus a margin all around it, for the particles
+    left by creatures' cells beyond the limits. The total count is kept up to
+    date, so its length is O(1).
+    """
+
+    def __init__(self, size, margin):
+        self.size = size
+        self.margin = margin
+        self.counts = numpy.zeros((size[0] + 1 + 2*margin, size[1] + 1 + 2*margin),
+                                  dtype=numpy.int32)
+        self.total = 0
+
+    def grow(self, margin):
+        "enlarge the margin around the environment"
+        counts = numpy.zeros((self.size[0] + 1 + 2*margin, self.size[1] + 1 + 2*margin),
+                             dtype=numpy.int32)
+        delta = margin - self.margin
+        counts[delta:delta + self.counts.shape[0],
+               delta:delta + self.counts.shape[1]] = self.counts
+        self.counts = counts
+        self.margin = margin
+
+    def flat(self, x, y):
+        "return the flat grid indexes of the positions"
+        return (x + self.margin) * self.counts.shape[1] + (y + self.margin)
+
+    def position(self, index):
+        "return the position of a flat grid index"
+        x, y = divmod(int(index), self.counts.shape[1])
+        return (x - self.margin, y - self.margin)
+
+    def positions(self, indexes):
+        "return the positions of flat grid indexes, as a flat x0, y0, x1, y1... array"
+        x, y = numpy.divmod(indexes, self.counts.shape[1])
+        return (numpy.column_stack((x, y)) - self.margin).astype(numpy.int32).ravel()
+
+    def add_all(self, indexes):
+        "add a particle at each flat grid index"
+        numpy.add.at(self.counts.reshape(-1), indexes, 1)
+        self.total += len(indexes)
+
+    def remove_all(self, indexes):
+        "remove a particle from each flat grid index"
+        numpy.subtract.at(self.counts.reshape(-1), indexes, 1)
+        self.total -= len(indexes)
+
+    def __contains__(self, value):
+        x, y = value[0] + self.margin, value[1] + self.margin
+        return (0 <= x < self.counts.shape[0] and 0 <= y < self.counts.shape[1]
+                and self.counts[x, y] > 0)
+
+    def __len__(self):
+        return self.total
+
+    def add(self, value):
+        "adds this value to the set, incrementing the value's count"
+        self.counts[value[0] + self.margin, value[1] + self.margin] += 1
+        self.total += 1
+
+    def remove(self, value):
+        "remove this value from the set, decrementing the value's count"
+        self.counts[value[0] + self.margin, value[1] + self.margin] -= 1
+        self.total -= 1
+
+    def __iter__(self):
+        for x, y in zip(*numpy.nonzero(self.counts)):
+            for i in xrange(self.counts[x, y]):
+                yield (x - self.margin, y - self.margin)
+
+    def iter_unique(self):
+        """
+        iterate over the unique values of the set, not repeating if the same
+        value occurs more than once in the set.
+        """
+        for x, y in zip(*numpy.nonzero(self.counts)):
+            yield (x - self.margin, y - self.margin)
+
+class CreatureView(object):
+    """
+    A read-only snapshot of one of NumpyZoo's creatures, with the same
+    attributes of a Creature.
+    """
+
+    __slots__ = ('position', 'cells', 'head', 'mouths', 'energy', 'age',
+                 'generation')
+
+    def __init__(self, position, prototype, energy, age, generation):
+        self.position = position
+        self.cells = prototype.cells
+        self.head = prototype.head
+        self.mouths = prototype.mouths
+        self.energy = energy
+        self.age = age
+        self.generation = generation
+
+    def __repr__(self):
+        return "<Creature %s, head=%s>" % (self.cells, self.head)
+
+class Population(object):
+    """
+    The creatures of a NumpyZoo at a given step. The snapshots are only built
+    when iterated.
+    """
+
+    def __init__(self, zoo):
+        self.zoo = zoo
+        self.views = None
+        self.index = None
+
+    def __len__(self):
+        return len(self.zoo.x)
+
+    def __nonzero__(self):
+        return len(self.zoo.x) > 0
+
+    def snapshots(self):
+        if self.views is None:
+            zoo = self.zoo
+            prototypes = zoo.genomes.prototypes
+            self.views = [CreatureView((int(x), int(y)), prototypes[g], int(e),
+                                       int(a), int(n))
+                          for x, y, g, e, a, n in zip(zoo.x, zoo.y, zoo.genome,
+                                                      zoo.energy, zoo.age,
+                                                      zoo.generation)]
+        return self.views
+
+    def __iter__(self):
+        return iter(self.snapshots())
+
+    def __contains__(self, creature):
+        return any(c is creature for c in self.snapshots())
+
+class ArrayStatistics(object):
+    """
+    The statistics of a NumPy zoo at a given step, with the same interface of
+    biotopia.Statistics. Each aggregate is only computed when first queried.
+    """
+
+    def __init__(self, zoo):
+        self.zoo = zoo
+        self.population = len(zoo.x)
+        self.summaries = {}
+        self.census = None
+
+    def summary(self, name):
+        result = self.summaries.get(name)
+        if result is None:
+            zoo = self.zoo
+            if name == 'mouths':
+                values = zoo.genomes.arrays()['mouth_count'][zoo.genome]
+            else:
+                values = getattr(zoo, name)
+            if len(values):
+                result = (int(values.min()), float(values.mean()), int(values.max()))
+            else:
+                result = (0, 0.0, 0)
+            self.summaries[name] = result
+        return result
+
+    age = property(lambda self: self.summary('age'))
+    mouths = property(lambda self: self.summary('mouths'))
+    energy = property(lambda self: self.summary('energy'))
+    generation = property(lambda self: self.summary('generation'))
+
+    @property
+    def species(self):
+        "the species census (the genomes of the table are oriented structures)"
+        if self.census is None:
+            counts = {}
+            prototypes = self.zoo.genomes.prototypes
+            for genome, population in enumerate(numpy.bincount(self.zoo.genome)):
+                if population:
+                    species = prototypes[genome].genome
+                    counts[species] = counts.get(species, 0) + int(population)
+            self.census = Census(counts)
+        return self.census
+
+    @property
+    def diversity(self):
+        return self.species.diversity()
+
+    def top_species(self, k):
+        return self.species.top(k)
+
+class NumpyZoo(object):
+    """
+    Holds a complete simulation with arrays of creatures, and grids of foods
+    and key particles. Has the same interface of biotopia.Zoo.
+    """
+
+    def __init__(self, descendants, size,
+                 offspring_energy,
+                 start_food, start_keys,
+                 energy_loss=1, energy_gain=10,
+                 wrap_vertical=False, wrap_horizontal=False,
+                 mutation_probability = 0.2, seed=None):
+        """
+        Create a new simulation. The array operations draw from a NumPy random
+        generator, and the mutations and ancestors from a Python one, both
+        seeded with "seed".
+        """
+        self.size = size
+        self.offspring_energy = offspring_energy
+        self.energy_loss = energy_loss
+        self.energy_gain = energy_gain
+        self.wrap_horizontal = wrap_horizontal
+        self.wrap_vertical = wrap_vertical
+        self.mutation_probability = mutation_probability
+        self.random = Random(seed)
+        self.numpy_random = numpy.random.RandomState(seed)
+        self.cycle = 0
+
+        self.genomes = Genomes()
+        self.x = numpy.zeros(0, dtype=numpy.int32)
+        self.y = numpy.zeros(0, dtype=numpy.int32)
+        self.energy = numpy.zeros(0, dtype=numpy.int64)
+        self.age = numpy.zeros(0, dtype=numpy.int64)
+        self.generation = numpy.zeros(0, dtype=numpy.int64)
+        self.genome = numpy.zeros(0, dtype=numpy.int32)
+        self.phase = numpy.zeros(0, dtype=numpy.int32)
+
+        self.food = DenseParticles(size, 0)
+        self.keys = DenseParticles(size, 0)
+        self.append(descendants)
+
+        # scatter distinct food and key particles over the environment
+        places = (size[0] + 1) * (size[1] + 1)
+        chosen = self.numpy_random.choice(places, min(start_food + start_keys, places),
+                                          replace=False)
+        x, y = numpy.divmod(chosen, size[1] + 1)
+        self.food.add_all(self.food.flat(x[:start_food], y[:start_food]))
+        self.keys.add_all(self.keys.flat(x[start_food:], y[start_food:]))
+
+        # the particles added and removed in the last step, as flat
+        # x0, y0, x1, y1... coordinates arrays
+        self.food_added = self.food_removed = numpy.zeros(0, dtype=numpy.int32)
+        self.keys_added = self.keys_removed = numpy.zeros(0, dtype=numpy.int32)
+
+        # also reported to these, if set, after each step
+        self.new_food_callback = None
+        self.del_food_callback = None
+        self.new_key_callback = None
+        self.del_key_callback = None
+
+    @property
+    def creatures(self):
+        return self.population
+
+    @property
+    def index(self):
+        "the creatures of the current step, in a CreatureIndex built on demand"
+        if self.population.index is None:
+            self.population.index = CreatureIndex(self.size, self.population)
+        return self.population.index
+
+    def append(self, creatures):
+        "add Creature objects to the arrays"
+        creatures = list(creatures)
+        def extend(array, values):
+            return numpy.concatenate((array, numpy.array(values, dtype=array.dtype)))
+        self.x = extend(self.x, [c.position[0] for c in creatures])
+        self.y = extend(self.y, [c.position[1] for c in creatures])
+        self.energy = extend(self.energy, [c.energy for c in creatures])
+        self.age = extend(self.age, [c.age for c in creatures])
+        self.generation = extend(self.generation, [c.generation for c in creatures])
+        self.genome = extend(self.genome, [self.genomes.intern(c.cells) for c in creatures])
+        self.phase = extend(self.phase, [c.phase for c in creatures])
+        self.fit_margin()
+        self.population = Population(self)
+        self.statistics = ArrayStatistics(self)
+
+    def cells(self):
+        """
+        Return the absolute positions of every creature cell, as two arrays of
+        coordinates, and an array of their kinds, as biotopia.Zoo.cells.
+        """
+        tables = self.genomes.arrays()
+        owners, items = expand(tables['cell_start'], tables['cell_count'], self.genome)
+        kinds = numpy.where(self.age <= 0, NEWBORN,
+                            numpy.where(self.energy <= 0, DYING, BODY)).astype(numpy.int8)
+        kinds = numpy.where(tables['cell_head'][items], HEAD, kinds[owners])
+        return (self.x[owners] + tables['cell_x'][items],
+                self.y[owners] + tables['cell_y'][items], kinds)
+
+    def populate(self, amount, energy):
+        "add an amount of ancestors, at random positions, with some energy"
+        self.append(ancestor((self.random.randint(0, self.size[0]),
+                              self.random.randint(0, self.size[1])),
+                             energy, self.random) for i in xrange(amount))
+
+    def fit_margin(self):
+        "enlarge the particles grids if a genome reaches beyond their margin"
+        if self.genomes.extent > self.food.margin:
+            margin = max(2 * self.genomes.extent, 4)
+            self.food.grow(margin)
+            self.keys.grow(margin)
+
+    def consume(self, particles, indexes):
+        """
+        Remove the particles probed by the mouths at the flat grid indexes, at
+        most as many as available at each place. Return the indexes of the
+        winning probes, and the positions of the removed particles.
+        """
+        available = particles.counts.reshape(-1)[indexes]
+        candidates = numpy.nonzero(available > 0)[0]
+        if not len(candidates):
+            return candidates, numpy.zeros(0, dtype=numpy.int32)
+
+        # order probes by place, and randomly among the same place
+        order = candidates[numpy.lexsort((self.numpy_random.random_sample(len(candidates)),
+                                          indexes[candidates]))]
+        places = indexes[order]
+        starts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(places))[0] + 1))
+        lengths = numpy.diff(numpy.concatenate((starts, [len(order)])))
+        ranks = numpy.arange(len(order)) - numpy.repeat(starts, lengths)
+
+        winners = order[ranks < available[order]]
+        particles.remove_all(indexes[winners])
+        return winners, particles.positions(indexes[winners])
+
+    def collide(self, position, limit, wrap, operation):
+        """
+        Wrap or collide the creatures beyond the limits of one dimension,
+        mirroring the colliding ones.
+        """
+        lower = position < 0
+        upper = position > limit
+        if wrap:
+            position[lower] += limit
+            position[upper] -= limit
+        else:
+            position[lower] = 0
+            position[upper] = limit
+            bounced = lower | upper
+            if bounced.any():
+                self.genome[bounced] = self.genomes.transform_all(self.genome[bounced],
+                                                                  operation)
+                self.phase[bounced] = 0
+
+    def step(self):
+        """
+        Perform one step of the simulation, collecting the particle changes in
+        the buffers.
+        """
+        genomes = self.genomes
+        tables = genomes.arrays()
+        population = len(self.x)
+
+        self.energy -= self.energy_loss
+        self.age += 1
+
+        # calculate absolute mouth positions
+        owners, items = expand(tables['mouth_start'], tables['mouth_count'],
+                               self.genome)
+        mouth_x = self.x[owners] + tables['mouth_x'][items]
+        mouth_y = self.y[owners] + tables['mouth_y'][items]
+        places = self.food.flat(mouth_x, mouth_y)
+
+        # eat food, incrementing creatures' energy
+        eaten, self.food_removed = self.consume(self.food, places)
+        self.energy += self.energy_gain * numpy.bincount(owners[eaten],
+                                                         minlength=population)
+
+        # eat keys, creating offspring at the mouth positions
+        eaten, self.keys_removed = self.consume(self.keys, places)
+        parents = owners[eaten]
+        offspring = numpy.empty(len(parents), dtype=numpy.int32)
+        for i, parent in enumerate(parents):
+            genome = self.genome[parent]
+
+            # mutate with probability
+            if self.random.random() < self.mutation_probability:
+                genome = genomes.mutated(genome, self.random)
+
+            # turn to a random direction (left or right)
+            offspring[i] = genomes.transform(genome,
+                                             'rotate_left' if self.random.randint(1, 2) == 1
+                                             else 'rotate_right')
+
+        # move
+        moves = tables['move_start'][self.genome] + self.phase
+        self.x += tables['move_x'][moves]
+        self.y += tables['move_y'][moves]
+        self.phase += 1
+        self.phase %= tables['move_count'][self.genome]
+
+        # colide or wrap horizontally and vertically
+        self.collide(self.x, self.size[0], self.wrap_horizontal, 'mirror_horizontal')
+        self.collide(self.y, self.size[1], self.wrap_vertical, 'mirror_vertical')
+        self.fit_margin()
+        tables = genomes.arrays()
+
+        # dying creatures leave a trace of food for each of its cells and head
+        # as key
+        dead = self.energy < 0
+        self.food_added = self.keys_added = numpy.zeros(0, dtype=numpy.int32)
+        if dead.any():
+            dead_index = numpy.nonzero(dead)[0]
+            owners, items = expand(tables['cell_start'], tables['cell_count'],
+                                   self.genome[dead_index])
+            places = self.food.flat(self.x[dead_index][owners] + tables['cell_x'][items],
+                                    self.y[dead_index][owners] + tables['cell_y'][items])
+            heads = tables['cell_head'][items]
+            self.keys.add_all(places[heads])
+            self.food.add_all(places[~heads])
+            self.keys_added = self.keys.positions(places[heads])
+            self.food_added = self.food.positions(places[~heads])
+
+        # survivors and offspring go to the next step
+        alive = ~dead
+        births = len(offspring)
+        self.x = numpy.concatenate((self.x[alive], mouth_x[eaten]))
+        self.y = numpy.concatenate((self.y[alive], mouth_y[eaten]))
+        self.energy = numpy.concatenate((self.energy[alive],
+                                         numpy.repeat(self.offspring_energy, births)))
+        self.age = numpy.concatenate((self.age[alive], numpy.zeros(births, dtype=numpy.int64)))
+        self.generation = numpy.concatenate((self.generation[alive],
+                                             self.generation[parents] + 1))
+        self.genome = numpy.concatenate((self.genome[alive], offspring))
+        self.phase = numpy.concatenate((self.phase[alive], numpy.zeros(births, dtype=numpy.int32)))
+        self.fit_margin()
+
+        self.population = Population(self)
+        self.statistics = ArrayStatistics(self)
+        self.cycle += 1
+        report_changes(self)
@@ -0,0 +1,148 @@
+# coding: utf-8
+
+"""
+A batch renderer of Biotopia simulations, for pygame displays.
+
+Renderer draws the frames published by a biotopia.Simulation. It keeps the
+food and key particles as an array of pixel colors, updated with the particles
+changed in each frame, and draws all the creature cells at once through a
+surfarray view of the display, from the frame's coordinate arrays. Only the
+parts of the display that changed since the last frame (the cells of the
+previous and current frames, the changed particles, and any rectangle marked
+by the caller) are pushed to the screen, as dirty rectangles made of square
+tiles.
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["Renderer"]
+
+from array import array
+
+import numpy
+import pygame
+import pygame.surfarray
+
+from biotopia import HEAD, BODY, NEWBORN, DYING
+
+def as_array(values):
+    "return a NumPy view of an array of coordinates or kinds"
+    if isinstance(values, array):
+        if not values:
+            return numpy.zeros(0, dtype=numpy.int32)
+        return numpy.frombuffer(values, dtype=numpy.dtype(values.typecode))
+    return numpy.asarray(values)
+
+class Renderer(object):
+    """
+    Draws a zoo's environment at the top left of a pygame window, of "size"
+    (width, height) pixels. "colors" maps 'background', 'food', 'key',
+    'head', 'cell', 'newborn', 'dying' and 'highlight' to pygame colors.
+    """
+
+    def __init__(self, window, size, colors, tile=32):
+        self.window = window
+        self.size = size
+        self.tile = tile
+        self.rows = (size[1] + tile - 1) // tile
+        self.mapped = dict((name, window.map_rgb(color))
+                           for name, color in colors.iteritems())
+        self.palette = numpy.zeros(4, dtype=numpy.uint32)
+        for kind, name in ((HEAD, 'head'), (BODY, 'cell'),
+                           (NEWBORN, 'newborn'), (DYING, 'dying')):
+            self.palette[kind] = self.mapped[name]
+        self.soup = numpy.zeros(size, dtype=numpy.uint32)
+        self.previous = (numpy.zeros(0, dtype=numpy.int32),) * 2
+        self.rectangles = []
+        self.full = True
+
+    def inside(self, position):
+        return 0 <= position[0] < self.size[0] and 0 <= position[1] < self.size[1]
+
+    def invalidate(self):
+        "redraw and push the whole window in the next frame"
+        self.full = True
+
+    def dirty(self, rectangle):
+        "push a rectangle of the window, drawn by the caller, in the next frame"
+        self.rectangles.append(pygame.Rect(rectangle))
+
+    def draw(self, frame, highlighted=()):
+        """
+        Draw a frame: its changed particles and its creatures, with the body
+        of the "highlighted" ones in the highlight color. Drawing the same
+        frame again is harmless.
+        """
+        width, height = self.size
+        soup = self.soup
+
+        if frame.reset:
+            soup[...] = self.mapped['background']
+            self.previous = (numpy.zeros(0, dtype=numpy.int32),) * 2
+            self.invalidate()
+
+        # repaint the changed particles
+        particles = [(p, color) for p, color in frame.particles if self.inside(p)]
+        if particles:
+            positions, colors = zip(*particles)
+            changed_x, changed_y = (numpy.array(c, dtype=numpy.int32)
+                                    for c in zip(*positions))
+            soup[changed_x, changed_y] = [self.mapped[c] for c in colors]
+        else:
+            changed_x = changed_y = numpy.zeros(0, dtype=numpy.int32)
+
+        xs, ys, kinds = (as_array(values) for values in frame.cells)
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        xs, ys, kinds = xs[inside], ys[inside], kinds[inside]
+
+        pixels = pygame.surfarray.pixels2d(self.window)
+        view = pixels[:width, :height]
+        # erase the cells of the previous frame, unless redrawing everything
+        if self.full:
+            view[...] = soup
+        else:
+            previous_x, previous_y = self.previous
+            view[previous_x, previous_y] = soup[previous_x, previous_y]
+            view[changed_x, changed_y] = soup[changed_x, changed_y]
+        view[xs, ys] = self.palette[kinds]
+        for creature in highlighted:
+            for x, y in creature.cells:
+                position = (creature.position[0] + x, creature.position[1] + y)
+                if (x or y) and self.inside(position):
+                    view[position] = self.mapped['highlight']
+        del view, pixels
+
+        if not self.full:
+            self.rectangles.extend(self.tiles(numpy.concatenate((self.previous[0], changed_x, xs)),
+                                              numpy.concatenate((self.previous[1], changed_y, ys))))
+        self.previous = (xs, ys)
+
+    def tiles(self, xs, ys):
+        "return the rectangles of the tiles of some pixels, merged by column"
+        tile, rows = self.tile, self.rows
+        rectangles = []
+        run = None
+        for index in numpy.unique(xs // tile * rows + ys // tile):
+            column, row = divmod(int(index), rows)
+            if run and run[0] == column and run[2] == row:
+                run[2] += 1
+            else:
+                if run:
+                    rectangles.append(self.run_rectangle(run))
+                run = [column, row, row + 1]
+        if run:
+            rectangles.append(self.run_rectangle(run))
+        return rectangles
+
+    def run_rectangle(self, run):
+        column, first, last = run
+        return pygame.Rect(column * self.tile, first * self.tile,
+                           self.tile, (last - first) * self.tile)
+
+    def present(self):
+        "push the changes of the frame to the display"
+        if self.full:
+            pygame.display.update()
+        elif self.rectangles:
+            pygame.display.update(self.rectangles)
+        self.full = False
+        self.rectangles = []
@@ -0,0 +1,455 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+Record and replay of Biotopia simulations.
+
+A ReplayRecorder is given a zoo after each step, and appends what changed in
+it to a replay file: the births, deaths, moves and meals of the creatures, and
+the particles added and removed, as compressed columns of numbers. Every
+"keyframe_every" cycles (and whenever another zoo is given, e.g. a restarted
+simulation) the whole zoo is written instead, as a checkpoint (see Zoo.dump).
+
+A Replay plays a replay file back: it seeks to any cycle by restoring the
+nearest keyframe before it and applying the changes up to it, and steps by
+applying the changes of the next cycle, without probing mouths, mutating or
+analyzing any structure. It has the interface of the zoo being replayed (as
+a Playback, which applies records, from a file or from elsewhere; see
+biotopia_stream), so the GUI plays it back as a simulation (see --replay):
+
+    python biotopia.py --headless --cycles 100000 --record run.replay
+    python biotopia.py --replay run.replay --fast-forward 50000
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["ReplayRecorder", "Playback", "Replay"]
+
+import mmap
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from itertools import chain
+from weakref import WeakKeyDictionary
+
+from biotopia import ORIENTATIONS, Creature, Genome, Zoo, compose
+
+#: Replay files signature and format version
+REPLAY_MAGIC = 'BIOREPLY'
+REPLAY_VERSION = 1
+
+#: Replay file header: magic, version and keyframe period
+REPLAY_HEADER = '<8sHI'
+
+#: Replay record header: kind, cycle and length of the (compressed) contents
+REPLAY_RECORD = '<BQI'
+
+#: Replay record kinds
+KEYFRAME, DELTA = 0, 1
+
+#: The columns of a keyframe: creature identifiers (in the zoo's order), and
+#: the genomes defined (identifiers, cells count and coordinates), followed by
+#: the checkpoint of the zoo
+KEYFRAME_COLUMNS = 'III' 'i'
+
+#: The columns of a delta: the genomes defined; births (identifier, genome,
+#: orientation, position and generation); deaths; moves (identifier, offset
+#: and orientation); meals (identifier and the energy after the step, as a
+#: double, exact for any integer energy); and the food and keys added and
+#: removed, as flat coordinates
+DELTA_COLUMNS = 'IIi' 'IIBiiI' 'I' 'IiiB' 'Id' 'iiii'
+
+#: The orientation of a recorded orientation, for a genome interned in
+#: orientation "base" in this process: REORIENTED[base][orientation]
+REORIENTED = [[ORIENTATIONS.index(compose(ORIENTATIONS[base], ORIENTATIONS[orientation]))
+               for orientation in xrange(len(ORIENTATIONS))]
+              for base in xrange(len(ORIENTATIONS))]
+
+def pack_columns(columns):
+    "return arrays as a binary string: their lengths, then their contents"
+    return ''.join([struct.pack('<%dI' % len(columns), *map(len, columns))] +
+                   [column.tostring() for column in columns])
+
+def unpack_columns(buffer, typecodes):
+    """
+    Return the arrays of a binary string written by pack_columns, of some
+    typecodes, and the offset right after them.
+    """
+    lengths = struct.unpack_from('<%dI' % len(typecodes), buffer)
+    offset = 4 * len(typecodes)
+    columns = []
+    for typecode, length in zip(typecodes, lengths):
+        column = array(typecode)
+        column.fromstring(buffer[offset:offset + length * column.itemsize])
+        offset += length * column.itemsize
+        columns.append(column)
+    return columns, offset
+
+class ReplayRecorder(object):
+    """
+    Records a simulation to the replay file at "path" (replacing it), or to a
+    file-like "output" (given each header and record in a single write), with
+    a keyframe each "keyframe_every" cycles (if not zero). Call record(zoo)
+    with the zoo to start with, and after each of its steps; the cycles go on
+    across restarted simulations. Call close() at the end.
+    """
+
+    def __init__(self, path=None, keyframe_every=1000, level=1, output=None):
+        self.keyframe_every = keyframe_every
+        self.level = level
+        self.replay = output or open(path, 'wb')
+        self.replay.write(struct.pack(REPLAY_HEADER, REPLAY_MAGIC,
+                                      REPLAY_VERSION, keyframe_every))
+        self.zoo = None
+        self.cycle = 0
+        self.energy_loss = None
+        self.next_id = 1
+        # the recorded state of each creature: identifier, position,
+        # orientation and energy
+        self.states = {}
+        # the identifiers of the living genomes, and those defined since the
+        # last keyframe
+        self.genome_ids = WeakKeyDictionary()
+        self.next_genome_id = 1
+        self.defined = set()
+
+    def genome_id(self, genome, columns, defined=None):
+        """
+        Return the identifier of a genome, defining it in some columns if not
+        yet "defined" (since the last keyframe, by default).
+        """
+        if defined is None:
+            defined = self.defined
+        genome_id = self.genome_ids.get(genome)
+        if genome_id is None:
+            genome_id = self.genome_ids[genome] = self.next_genome_id
+            self.next_genome_id += 1
+        if genome_id not in defined:
+            defined.add(genome_id)
+            identifiers, lengths, coordinates = columns
+            cells = genome.cells[0]
+            identifiers.append(genome_id)
+            lengths.append(len(cells))
+            coordinates.extend(chain.from_iterable(cells))
+        return genome_id
+
+    def record(self, zoo):
+        """
+        Record the changes of a zoo since it was last recorded (the whole zoo,
+        if it's a keyframe).
+        """
+        if zoo is self.zoo:
+            self.cycle += 1
+        elif self.zoo is not None:
+            # a restarted simulation goes on from the same cycle
+            self.states = {}
+        if (zoo is not self.zoo or zoo.energy_loss != self.energy_loss or
+                self.keyframe_every and self.cycle % self.keyframe_every == 0):
+            self.keyframe(zoo)
+        else:
+            self.delta(zoo)
+
+    def keyframe(self, zoo):
+        "write the whole zoo"
+        if self.zoo is None:
+            self.cycle = zoo.cycle
+        self.zoo = zoo
+        self.energy_loss = zoo.energy_loss
+        self.defined = set()
+        self.write(KEYFRAME, self.contents(zoo, self.defined))
+
+    def contents(self, zoo, defined, genomes=()):
+        """
+        Return the contents of a keyframe of a zoo, defining the genomes of
+        its creatures and some other "genomes" (and adding them to
+        "defined").
+        """
+        ids = array('I')
+        columns = (array('I'), array('I'), array('i'))
+        for genome in genomes:
+            self.genome_id(genome, columns, defined)
+        states = {}
+        for creature in zoo.creatures:
+            state = self.states.get(creature)
+            if state is None:
+                state = [self.next_id, None, None, None]
+                self.next_id += 1
+            state[1:] = creature.position, creature.orientation, creature.energy
+            states[creature] = state
+            ids.append(state[0])
+            self.genome_id(creature.genome, columns, defined)
+        self.states = states
+        return pack_columns((ids,) + columns) + zoo.dump()
+
+    def snapshot(self):
+        """
+        Return a keyframe record of the zoo as last recorded, not written, to
+        follow with the next records: it defines the genomes the next deltas
+        may refer to without defining them.
+        """
+        genomes = [genome for genome, genome_id in self.genome_ids.items()
+                   if genome_id in self.defined]
+        return self.pack(KEYFRAME, self.contents(self.zoo, set(), genomes))
+
+    def delta(self, zoo):
+        "write the changes of the zoo's last step"
+        genomes = (array('I'), array('I'), array('i'))
+        births = (array('I'), array('I'), array('B'), array('i'), array('i'), array('I'))
+        deaths = array('I')
+        moves = (array('I'), array('i'), array('i'), array('B'))
+        meals = (array('I'), array('d'))
+        energy_loss = zoo.energy_loss
+
+        previous, states = self.states, {}
+        for creature in zoo.creatures:
+            state = previous.pop(creature, None)
+            x, y = position = creature.position
+            if state is None:
+                state = states[creature] = [self.next_id, position,
+                                            creature.orientation, creature.energy]
+                self.next_id += 1
+                for column, value in zip(births, (state[0], self.genome_id(creature.genome, genomes),
+                                                  creature.orientation, x, y,
+                                                  creature.generation)):
+                    column.append(value)
+                continue
+            states[creature] = state
+            if position != state[1] or creature.orientation != state[2]:
+                for column, value in zip(moves, (state[0], x - state[1][0],
+                                                 y - state[1][1], creature.orientation)):
+                    column.append(value)
+                state[1], state[2] = position, creature.orientation
+            if creature.energy != state[3] - energy_loss:
+                meals[0].append(state[0])
+                meals[1].append(creature.energy)
+            state[3] = creature.energy
+        # the creatures left are dead
+        deaths.extend(state[0] for state in previous.itervalues())
+        self.states = states
+
+        self.write(DELTA, pack_columns(genomes + births + (deaths,) + moves + meals +
+                                       (zoo.food_added, zoo.food_removed,
+                                        zoo.keys_added, zoo.keys_removed)))
+
+    def pack(self, kind, contents):
+        "return a record of the current cycle"
+        contents = zlib.compress(contents, self.level)
+        return struct.pack(REPLAY_RECORD, kind, self.cycle, len(contents)) + contents
+
+    def write(self, kind, contents):
+        self.replay.write(self.pack(kind, contents))
+        if kind == KEYFRAME:
+            self.replay.flush()
+
+    def close(self):
+        self.replay.close()
+
+class Playback(object):
+    """
+    The zoo of a recording, played back: a Zoo restored from a keyframe record
+    and updated with the delta records after it. The attributes not of the
+    playback are the current zoo's, so it has the interface of a Zoo.
+    """
+
+    def __init__(self):
+        self.zoo = None
+        self.cycle = 0
+        self.genomes, self.bases = {}, {}
+        self.creature_ids = {}
+        self.food_added = self.food_removed = array('i')
+        self.keys_added = self.keys_removed = array('i')
+
+    def __getattr__(self, name):
+        return getattr(self.zoo, name)
+
+    def define(self, identifiers, lengths, coordinates):
+        "intern some recorded genomes"
+        start = 0
+        for genome_id, length in zip(identifiers, lengths):
+            cells = coordinates[start:start + 2 * length]
+            start += 2 * length
+            genome, base = Genome.intern(zip(cells[::2], cells[1::2]))
+            self.genomes[genome_id] = genome
+            self.bases[genome] = base
+
+    def restore(self, contents, cycle):
+        """
+        Restore the zoo of a keyframe (as the uncompressed contents of its
+        record). The particle buffers are emptied.
+        """
+        (ids, identifiers, lengths, coordinates), offset = unpack_columns(contents, KEYFRAME_COLUMNS)
+        self.genomes, self.bases = {}, {}
+        self.define(identifiers, lengths, coordinates)
+        self.zoo = Zoo.restore(contents, offset)
+        self.zoo.cycle = self.cycle = cycle
+        self.creature_ids = dict(zip(ids, self.zoo.creatures))
+        self.food_added = self.food_removed = array('i')
+        self.keys_added = self.keys_removed = array('i')
+
+    def replace(self, contents, cycle):
+        """
+        Restore the zoo of a keyframe in place of the current one, reporting
+        every particle of the current zoo as removed, and the new ones as
+        added.
+        """
+        previous = self.zoo
+        self.restore(contents, cycle)
+        for name in ('food', 'keys'):
+            removed, added = array('i'), array('i')
+            removed.extend(chain.from_iterable(getattr(previous, name).iter_unique()))
+            added.extend(chain.from_iterable(getattr(self.zoo, name).iter_unique()))
+            setattr(self, name + '_removed', removed)
+            setattr(self, name + '_added', added)
+
+    def apply(self, contents, cycle):
+        "apply a delta (as the uncompressed contents of its record)"
+        columns, offset = unpack_columns(contents, DELTA_COLUMNS)
+        self.define(*columns[0:3])
+        births, deaths, moves, meals = (columns[3:9], columns[9], columns[10:14],
+                                        columns[14:16])
+        zoo, creature_ids = self.zoo, self.creature_ids
+        statistics, index = zoo.statistics, zoo.index
+
+        # every creature ages and loses energy, as in the step
+        zoo.ledger.advance(zoo.energy_loss)
+
+        for creature_id, energy in zip(*meals):
+            statistics.update_energy(creature_ids[creature_id], int(energy))
+
+        for creature_id in deaths:
+            creature = creature_ids.pop(creature_id)
+            statistics.remove(creature)
+            index.remove(creature)
+        survivors = [c for c in zoo.creatures if c in index] if deaths else zoo.creatures
+
+        # survivors are always within the environment, so their buckets need
+        # no clamping (as in the step)
+        places, bucket, rows, bases = index.places, index.bucket, index.rows, self.bases
+        for creature_id, dx, dy, orientation in zip(*moves):
+            creature = creature_ids[creature_id]
+            x, y = creature.position = (creature.position[0] + dx, creature.position[1] + dy)
+            orientation = REORIENTED[bases[creature.genome]][orientation]
+            if orientation != creature.orientation:
+                creature.orient(orientation)
+            place = x // bucket * rows + y // bucket
+            if place != places[creature]:
+                index.move(creature, place)
+
+        for creature_id, genome_id, orientation, x, y, generation in zip(*births):
+            genome = self.genomes[genome_id]
+            creature = Creature((x, y), generation = generation,
+                                energy = zoo.offspring_energy, genome = genome,
+                                orientation = REORIENTED[bases[genome]][orientation],
+                                ledger = zoo.ledger)
+            creature_ids[creature_id] = creature
+            survivors.append(creature)
+            statistics.add(creature)
+            index.add(creature)
+        zoo.creatures = survivors
+
+        for particles, (added, removed) in ((zoo.food, columns[16:18]),
+                                            (zoo.keys, columns[18:20])):
+            for i in xrange(0, len(added), 2):
+                particles.add((added[i], added[i + 1]))
+            for i in xrange(0, len(removed), 2):
+                particles.remove((removed[i], removed[i + 1]))
+        (self.food_added, self.food_removed,
+         self.keys_added, self.keys_removed) = columns[16:20]
+
+        zoo.cycle = self.cycle = cycle
+
+class Replay(Playback):
+    """
+    Plays back the replay file at "path", mapped in memory. Seek to a cycle
+    with seek, and step forward with step. Call close() at the end.
+    """
+
+    def __init__(self, path):
+        Playback.__init__(self)
+        with open(path, 'rb') as replay:
+            self.buffer = mmap.mmap(replay.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.keyframe_every = struct.unpack_from(REPLAY_HEADER, self.buffer)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Invalid replay: %s" % path)
+        if version != REPLAY_VERSION:
+            raise ValueError("Unsupported replay version: %d" % version)
+
+        # the kinds, cycles, offsets and lengths of the records, and the
+        # positions of the keyframes among them
+        self.kinds, self.cycles = array('B'), array('L')
+        self.offsets, self.lengths = array('L'), array('L')
+        self.keyframes = array('L')
+        header = struct.calcsize(REPLAY_RECORD)
+        offset = struct.calcsize(REPLAY_HEADER)
+        while offset + header <= len(self.buffer):
+            kind, cycle, length = struct.unpack_from(REPLAY_RECORD, self.buffer, offset)
+            if offset + header + length > len(self.buffer):
+                # the record of a recording cut short
+                break
+            if kind == KEYFRAME:
+                self.keyframes.append(len(self.kinds))
+            self.kinds.append(kind)
+            self.cycles.append(cycle)
+            self.offsets.append(offset + header)
+            self.lengths.append(length)
+            offset += header + length
+        if not self.keyframes:
+            raise ValueError("Empty replay: %s" % path)
+        self.keyframe_cycles = [self.cycles[i] for i in self.keyframes]
+        self.first = self.cycles[0]
+        self.last = self.cycles[-1]
+        self.position = None
+        self.seek(self.first)
+
+    def contents(self, position):
+        "return the uncompressed contents of a record"
+        offset = self.offsets[position]
+        return zlib.decompress(self.buffer[offset:offset + self.lengths[position]])
+
+    def seek(self, cycle):
+        """
+        Go to a cycle (clamped to the recorded ones): restore the last
+        keyframe up to it, and apply the changes since. Returns the replay.
+        """
+        cycle = min(max(cycle, self.first), self.last)
+        self.position = self.keyframes[bisect_right(self.keyframe_cycles, cycle) - 1]
+        self.restore(self.contents(self.position), self.cycles[self.position])
+        while (self.position + 1 < len(self.kinds) and
+               self.cycles[self.position + 1] <= cycle):
+            self.step()
+        return self
+
+    def step(self):
+        """
+        Apply the changes of the next recorded cycle (restoring the zoo of a
+        restarted simulation). Does nothing at the end of the replay.
+        """
+        if self.position + 1 >= len(self.kinds):
+            return
+        self.position += 1
+        contents = self.contents(self.position)
+        if self.kinds[self.position] == KEYFRAME:
+            self.replace(contents, self.cycles[self.position])
+        else:
+            self.apply(contents, self.cycles[self.position])
+
+    def close(self):
+        self.buffer.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Biotopia - replay file summary")
+    parser.add_argument('path', metavar='PATH', help="The replay file")
+    args = parser.parse_args()
+
+    try:
+        replay = Replay(args.path)
+    except (IOError, ValueError) as error:
+        parser.error(str(error))
+    try:
+        print "cycles %d to %d: %d records, %d keyframes (each %d cycles), %d bytes" % (
+            replay.first, replay.last, len(replay.kinds), len(replay.keyframes),
+            replay.keyframe_every, len(replay.buffer))
+    finally:
+        replay.close()
@@ -0,0 +1,279 @@
+# coding: utf-8
+
+"""
+Live streaming of Biotopia simulations to remote viewers.
+
+A StreamServer serves a running zoo over TCP to any number of viewers. Each
+one is sent the header of a replay file (see biotopia_replay), a keyframe of
+the zoo, and then the delta record of each step: records are made once for
+all the viewers, and not at all while none is connected. The server never
+waits for a viewer: the records a slow viewer hasn't taken yet are queued,
+and when too many are, the deltas are dropped, and the viewer is sent a new
+keyframe instead, skipping the cycles in between. Keyframes are never
+dropped, however large: a newer one replaces them.
+
+A StreamViewer connects to a server and plays its records back as they
+arrive. It has the interface of a Zoo, each step applying every record
+received since the previous one, so the GUI shows a remote simulation as it
+runs (see --serve and --connect):
+
+    python biotopia.py --headless --serve 8765
+    python biotopia.py --connect simulation-host:8765
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["StreamServer", "StreamViewer"]
+
+import errno
+import socket
+import struct
+import zlib
+from array import array
+from collections import deque
+from select import select
+from time import sleep
+
+from biotopia_replay import (DELTA, KEYFRAME, REPLAY_HEADER, REPLAY_MAGIC,
+                             REPLAY_RECORD, REPLAY_VERSION, Playback, ReplayRecorder)
+
+#: Socket errors of operations that would block
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class Viewer(object):
+    "The server's end of a viewer's connection, and the records queued to it"
+
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        # the queued records, and their kinds (None for the header)
+        self.queue = deque()
+        self.queued = 0
+        # how much of the first record was sent
+        self.sent = 0
+        # whether the viewer has a keyframe to follow the records with
+        self.synced = False
+
+    def enqueue(self, record, kind, backlog):
+        """
+        Queue a record of a kind (None for the header). A keyframe replaces
+        the records not yet begun before it (but the header). A delta is only
+        queued after a keyframe, and past "backlog" bytes the deltas not yet
+        begun are dropped, and the viewer needs a new keyframe: the header and
+        keyframes are never dropped, whatever their size.
+        """
+        if kind == KEYFRAME:
+            self.discard(lambda kind: kind is not None)
+            self.synced = True
+        elif kind == DELTA and not self.synced:
+            return
+        self.queue.append((record, kind))
+        self.queued += len(record)
+        if kind == DELTA and self.queued > backlog:
+            self.discard(lambda kind: kind == DELTA)
+            self.synced = False
+
+    def discard(self, droppable):
+        "drop the queued records not yet begun of the kinds \"droppable\" accepts"
+        queue = [entry for i, entry in enumerate(self.queue)
+                 if not droppable(entry[1]) or i == 0 and self.sent]
+        self.queue = deque(queue)
+        self.queued = sum(len(record) for record, kind in queue)
+
+    def flush(self):
+        "send as much of the queued records as the connection takes without blocking"
+        while self.queue:
+            record, kind = self.queue[0]
+            try:
+                self.sent += self.connection.send(buffer(record, self.sent))
+            except socket.error as error:
+                if error.errno in WOULD_BLOCK:
+                    return
+                raise
+            if self.sent < len(record):
+                return
+            self.queue.popleft()
+            self.queued -= len(record)
+            self.sent = 0
+
+class StreamServer(object):
+    """
+    Serves the zoo given to publish after each step to the viewers connecting
+    at "address" (host, port; port zero picks a free one, in
+    "self.address"). A viewer with more than "backlog" bytes queued skips to a
+    new keyframe. Call close() at the end.
+    """
+
+    def __init__(self, address, backlog=1 << 22, level=1):
+        self.backlog = backlog
+        self.level = level
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.header = struct.pack(REPLAY_HEADER, REPLAY_MAGIC, REPLAY_VERSION, 0)
+        self.viewers = []
+        # the records of the last publish, written by the recorder (only
+        # while there are viewers)
+        self.recorder = None
+        self.records = []
+
+    def write(self, record):
+        self.records.append((record, struct.unpack_from(REPLAY_RECORD, record)[0]))
+
+    def flush(self):
+        pass
+
+    def publish(self, zoo):
+        """
+        Record a zoo's last step (or a new zoo) for the viewers, accept the
+        new ones, and send them what they take without blocking.
+        """
+        self.accept()
+        if not self.viewers:
+            self.recorder = None
+            return
+
+        if self.recorder is None:
+            # a new recording, starting with a keyframe for everyone (the
+            # header it writes first was sent already)
+            self.recorder = ReplayRecorder(keyframe_every = 0, level = self.level,
+                                           output = self)
+            del self.records[:]
+        self.recorder.record(zoo)
+        for record, kind in self.records:
+            for viewer in self.viewers:
+                viewer.enqueue(record, kind, self.backlog)
+        del self.records[:]
+
+        # the viewers that joined or fell behind are sent a keyframe of the
+        # zoo as just recorded, made once for them all
+        snapshot = None
+        for viewer in list(self.viewers):
+            if not viewer.synced:
+                if snapshot is None:
+                    snapshot = self.recorder.snapshot()
+                viewer.enqueue(snapshot, KEYFRAME, self.backlog)
+            try:
+                viewer.flush()
+            except socket.error:
+                # the viewer is gone
+                viewer.connection.close()
+                self.viewers.remove(viewer)
+
+    def accept(self):
+        "accept the viewers waiting to connect"
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except socket.error as error:
+                if error.errno in WOULD_BLOCK:
+                    return
+                raise
+            connection.setblocking(False)
+            viewer = Viewer(connection, address)
+            viewer.enqueue(self.header, None, self.backlog)
+            self.viewers.append(viewer)
+
+    def close(self):
+        for viewer in self.viewers:
+            viewer.connection.close()
+        self.listener.close()
+
+class StreamViewer(Playback):
+    """
+    Plays back the records of the server at "address" (host, port) as they
+    arrive, from the first keyframe. Each step applies every record received
+    since the previous one, waiting up to "timeout" seconds for one; the
+    particle buffers hold the changes of them all. Once the server is gone,
+    steps do nothing. Call close() at the end.
+    """
+
+    def __init__(self, address, timeout=0.5):
+        Playback.__init__(self)
+        self.timeout = timeout
+        self.connection = socket.create_connection(address)
+        self.connection.setblocking(False)
+        self.received = bytearray()
+        self.closed = False
+
+        while len(self.received) < struct.calcsize(REPLAY_HEADER) and not self.closed:
+            self.receive(None)
+        if self.closed:
+            raise ValueError("Connection closed by the server")
+        magic, version, keyframe_every = struct.unpack_from(REPLAY_HEADER, self.received)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Invalid stream from the server")
+        if version != REPLAY_VERSION:
+            raise ValueError("Unsupported stream version: %d" % version)
+        del self.received[:struct.calcsize(REPLAY_HEADER)]
+        while self.zoo is None:
+            if self.closed:
+                raise ValueError("Connection closed by the server")
+            self.step(None)
+
+    def receive(self, timeout):
+        """
+        Read what the server sent, waiting up to "timeout" seconds (forever,
+        if None) for anything.
+        """
+        readable, writable, failed = select([self.connection], [], [], timeout)
+        while readable:
+            try:
+                data = self.connection.recv(1 << 16)
+            except socket.error as error:
+                if error.errno in WOULD_BLOCK:
+                    return
+                raise
+            if not data:
+                self.closed = True
+                return
+            self.received.extend(data)
+
+    def records(self):
+        """
+        Return the complete records received and not yet returned, as (kind,
+        cycle, contents) tuples.
+        """
+        records = []
+        header = struct.calcsize(REPLAY_RECORD)
+        offset = 0
+        while offset + header <= len(self.received):
+            kind, cycle, length = struct.unpack_from(REPLAY_RECORD, self.received, offset)
+            if offset + header + length > len(self.received):
+                break
+            contents = str(self.received[offset + header:offset + header + length])
+            records.append((kind, cycle, zlib.decompress(contents)))
+            offset += header + length
+        del self.received[:offset]
+        return records
+
+    def step(self, timeout=-1):
+        """
+        Apply every record received since the last step, waiting up to
+        "timeout" seconds (the viewer's, by default) for one.
+        """
+        if self.closed:
+            sleep(self.timeout)
+            return
+        records = self.records()
+        self.receive(0 if records else self.timeout if timeout == -1 else timeout)
+        records.extend(self.records())
+
+        changes = [array('i') for i in xrange(4)]
+        for kind, cycle, contents in records:
+            if kind != KEYFRAME:
+                self.apply(contents, cycle)
+            elif self.zoo is None:
+                self.restore(contents, cycle)
+            else:
+                self.replace(contents, cycle)
+            for merged, changed in zip(changes, (self.food_added, self.food_removed,
+                                                 self.keys_added, self.keys_removed)):
+                merged.extend(changed)
+        (self.food_added, self.food_removed,
+         self.keys_added, self.keys_removed) = changes
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,431 @@
+# coding: utf-8
+
+"""
+A spatially partitioned Biotopia simulation, stepped by parallel processes.
+
+TiledZoo splits the environment into a grid of rectangular tiles, each one
+owned by a worker process that holds the tile's creatures in its own
+biotopia.Zoo. The food and key particles of the whole environment (plus a halo
+margin around it) are counts in shared memory, so the workers eat and deposit
+particles across tile edges directly.
+
+Each cycle, the tiles are stepped in phases, by the parity of their column
+and row (four phases, or two in a single row or column of tiles): tiles
+stepped at the same time are at least a whole tile apart, so they never touch
+the same particles as long as creatures reach no more than "halo" cells from
+their position (and tiles are at least twice the halo). Every phase must have
+at least two tiles, to step them in parallel, and a wrapped axis an even
+number of tiles (or just one), as the first and last tiles of a wrapped axis
+touch across the edge. After the phases, creatures
+whose position (or newborns whose mouth position) left their tile migrate to
+the tile that owns it. Wrapping works as in Zoo: creatures wrap to the
+opposite tiles, particles are never wrapped.
+
+The reach of the creatures is checked after each step: while any creature
+reaches beyond the halo (as mutations may grow them to), the tiles are
+stepped one at a time instead, so they still never touch the same particles.
+
+The rules are the same as in a single Zoo; only the order in which creatures
+compete for the same particle differs. Particle callbacks are not supported,
+and the few particles left beyond the halo around the environment (only by
+creatures reaching beyond it) stay with the tile that left them.
+"""
+
+__author__ = "Rodrigo Setti"
+__all__ = ["TiledZoo"]
+
+from multiprocessing import Pipe, Process
+from multiprocessing.sharedctypes import RawArray
+from random import Random
+from weakref import WeakKeyDictionary
+
+from biotopia import (Census, Creature, CreatureIndex, Genome, ParticleGrid, Zoo,
+                      ancestor, resident_memory)
+
+#: The reach of the genomes seen, by genome
+reaches = WeakKeyDictionary()
+
+def reach(cells):
+    """
+    Return how far from their position creatures with some cells touch
+    particles in a step: their cells, after a movement.
+    """
+    return max(max(abs(x), abs(y)) for x, y in cells) + 1
+
+def genome_reach(genome):
+    "return the reach of a genome's creatures (see reach)"
+    if genome not in reaches:
+        reaches[genome] = reach(genome.cells[0])
+    return reaches[genome]
+
+def record(creature):
+    "return a picklable record of a creature, to move it between processes"
+    return (tuple(creature.cells), creature.phase, creature.position,
+            creature.energy, creature.age, creature.generation)
+
+def restore(record):
+    "return the creature of a record"
+    cells, phase, position, energy, age, generation = record
+    creature = Creature(position, cells, generation = generation,
+                        energy = energy)
+    creature.phase = phase
+    creature.age = age
+    return creature
+
+def work(connection, bounds, parameters, seed, food, keys):
+    """
+    Worker process main loop: own the creatures of the tile within "bounds"
+    (left, top, right, bottom, inclusive) and obey the coordinator's commands.
+    """
+    zoo = Zoo([], start_food = 0, start_keys = 0, seed = seed, **parameters)
+    zoo.food, zoo.keys = food, keys
+    left, top, right, bottom = bounds
+
+    def inside(creature):
+        x, y = creature.position
+        return left <= x <= right and top <= y <= bottom
+
+    while True:
+        command = connection.recv()
+        name = command[0]
+
+        if name == 'step':
+            food.total = keys.total = 0
+            zoo.step()
+            # the particles added, the meals, births and deaths (as in the
+            # metrics), and the resident memory of the worker
+            connection.send((food.total, keys.total, len(zoo.food_removed) // 2,
+                             len(zoo.keys_removed) // 2, len(zoo.keys_added) // 2,
+                             resident_memory()))
+        elif name == 'emigrate':
+            # the reach of every creature, emigrants included
+            furthest = max([genome_reach(genome) for genome
+                            in zoo.statistics.species.counts] or [0])
+            emigrants = [c for c in zoo.creatures if not inside(c)]
+            for creature in emigrants:
+                zoo.statistics.remove(creature)
+                zoo.index.remove(creature)
+            zoo.creatures = [c for c in zoo.creatures if inside(c)]
+            connection.send(([record(c) for c in emigrants], len(zoo.creatures),
+                             furthest))
+        elif name == 'immigrate':
+            for creature in (restore(r) for r in command[1]):
+                creature.transfer(zoo.ledger)
+                zoo.creatures.append(creature)
+                zoo.statistics.add(creature)
+                zoo.index.add(creature)
+        elif name == 'statistics':
+            statistics = zoo.statistics
+            connection.send((statistics.population, statistics.age,
+                             statistics.mouths, statistics.energy,
+                             statistics.generation,
+                             [(genome.morphology, population) for genome, population
+                              in statistics.species.counts.iteritems()]))
+        elif name == 'creatures':
+            connection.send([record(c) for c in zoo.creatures])
+        elif name == 'set':
+            setattr(zoo, command[1], command[2])
+        elif name == 'stop':
+            break
+
+class Tile(object):
+    "The coordinator's handle of a worker process and its tile"
+
+    def __init__(self, column, row, bounds, parameters, seed, food, keys):
+        self.column = column
+        self.row = row
+        self.population = 0
+        # the resident memory of the worker, after its last step
+        self.memory = None
+        self.connection, remote = Pipe()
+        self.process = Process(target=work, args=(remote, bounds, parameters,
+                                                  seed, food, keys))
+        self.process.daemon = True
+        self.process.start()
+
+class TiledPopulation(object):
+    """
+    The creatures of a TiledZoo. The count is kept by the coordinator; the
+    creatures themselves are only fetched from the workers when iterated.
+    """
+
+    def __init__(self, zoo):
+        self.zoo = zoo
+        self.snapshot = None
+        self.index = None
+
+    def __len__(self):
+        return sum(tile.population for tile in self.zoo.tiles)
+
+    def __nonzero__(self):
+        return any(tile.population for tile in self.zoo.tiles)
+
+    def __iter__(self):
+        if self.snapshot is None:
+            for tile in self.zoo.tiles:
+                tile.connection.send(('creatures',))
+            self.snapshot = [restore(r) for tile in self.zoo.tiles
+                             for r in tile.connection.recv()]
+        return iter(self.snapshot)
+
+class TiledStatistics(object):
+    """
+    The statistics of a TiledZoo, with the same interface of
+    biotopia.Statistics: the aggregates of every tile, combined. Species are
+    matched across tiles by their canonical morphology.
+    """
+
+    def __init__(self, tiles):
+        for tile in tiles:
+            tile.connection.send(('statistics',))
+        summaries = [tile.connection.recv() for tile in tiles]
+        summaries = [s for s in summaries if s[0]]
+        counts = {}
+        for summary in summaries:
+            for morphology, population in summary[5]:
+                counts[morphology] = counts.get(morphology, 0) + population
+        # each morphology's genome, interned in this process
+        self.species = Census((Genome.intern(morphology)[0], population)
+                              for morphology, population in counts.iteritems())
+        self.population = sum(s[0] for s in summaries)
+        for i, name in enumerate(('age', 'mouths', 'energy', 'generation'), 1):
+            if summaries:
+                setattr(self, name,
+                        (min(s[i][0] for s in summaries),
+                         sum(s[0] * s[i][1] for s in summaries) / float(self.population),
+                         max(s[i][2] for s in summaries)))
+            else:
+                setattr(self, name, (0, 0.0, 0))
+
+    @property
+    def diversity(self):
+        return self.species.diversity()
+
+    def top_species(self, k):
+        return self.species.top(k)
+
+def check_tiles(size, tiles, halo, wrap_horizontal, wrap_vertical):
+    """
+    Raise ValueError if an environment of some size can't be split in some
+    tiles (columns, rows) with some halo (see the module documentation).
+    """
+    columns, rows = tiles
+    if columns < 1 or rows < 1:
+        raise ValueError("There must be at least one tile column and row")
+    if halo < 0:
+        raise ValueError("The halo can't be negative")
+    if (size[0] + 1) / columns < 2 * halo or (size[1] + 1) / rows < 2 * halo:
+        raise ValueError("Tiles must be at least twice the halo (%d)" % halo)
+    # the tiles of each phase (see TiledZoo.step), by column and row parity
+    sizes = [(columns + 1 - c) // 2 * ((rows + 1 - r) // 2)
+             for c in (0, 1) for r in (0, 1)]
+    if min(size for size in sizes if size) < 2:
+        raise ValueError("Every phase must have at least two tiles (e.g. 4x1, "
+                         "4x2 or 4x4 tiles)")
+    check_wrap(tiles, wrap_horizontal, wrap_vertical)
+
+def check_wrap(tiles, wrap_horizontal, wrap_vertical):
+    """
+    Raise ValueError if a wrapped axis has an odd number of tiles (but one):
+    its first and last tiles, touching across the edge, would share a phase.
+    """
+    for count, wrap, axis in ((tiles[0], wrap_horizontal, "columns"),
+                              (tiles[1], wrap_vertical, "rows")):
+        if wrap and count > 1 and count % 2:
+            raise ValueError("A wrapped axis must have an even number of tile "
+                             "%s (or just one)" % axis)
+
+class TiledZoo(object):
+    """
+    Holds a complete simulation split in tiles, stepped by parallel worker
+    processes. Has the same interface of biotopia.Zoo, plus "tiles" (columns,
+    rows) and "halo" parameters. "reach" is the furthest any creature reaches
+    (see reach). "events" counts the meals, births and deaths of the last
+    step. Call close() to stop the workers.
+    """
+
+    def __init__(self, descendants, size,
+                 offspring_energy,
+                 start_food, start_keys,
+                 energy_loss=1, energy_gain=10,
+                 wrap_vertical=False, wrap_horizontal=False,
+                 mutation_probability = 0.2, seed=None,
+                 tiles=(4, 1), halo=32):
+        check_tiles(size, tiles, halo, wrap_horizontal, wrap_vertical)
+        columns, rows = tiles
+
+        self.size = size
+        self.offspring_energy = offspring_energy
+        self.energy_loss = energy_loss
+        self.energy_gain = energy_gain
+        self.mutation_probability = mutation_probability
+        self.halo = halo
+        self.grid = tiles
+        self.random = Random(seed)
+        self.cycle = 0
+        self.reach = 0
+        self._wrap_horizontal = wrap_horizontal
+        self._wrap_vertical = wrap_vertical
+
+        # the particles of the environment and halo, in shared memory
+        length = (size[0] + 1 + 2*halo) * (size[1] + 1 + 2*halo)
+        shared_food = RawArray('I', length)
+        shared_keys = RawArray('I', length)
+        self.food = ParticleGrid(size, margin = halo, counts = shared_food)
+        self.keys = ParticleGrid(size, margin = halo, counts = shared_keys)
+
+        # scatter distinct food and key particles over the environment
+        places = self.random.sample(xrange((size[0] + 1) * (size[1] + 1)),
+                                    start_food + start_keys)
+        for i, place in enumerate(places):
+            (self.food if i < start_food else self.keys).add(divmod(place, size[1] + 1))
+
+        parameters = dict(size = size, offspring_energy = offspring_energy,
+                          energy_loss = energy_loss, energy_gain = energy_gain,
+                          wrap_vertical = wrap_vertical,
+                          wrap_horizontal = wrap_horizontal,
+                          mutation_probability = mutation_probability)
+        # the first position of each column and row, as in the tile method
+        first = lambda i, n, length: -(-i * length // n)
+        self.tiles = []
+        for column in xrange(columns):
+            for row in xrange(rows):
+                bounds = (first(column, columns, size[0] + 1),
+                          first(row, rows, size[1] + 1),
+                          first(column + 1, columns, size[0] + 1) - 1,
+                          first(row + 1, rows, size[1] + 1) - 1)
+                self.tiles.append(Tile(column, row, bounds, parameters,
+                                       self.random.getrandbits(32),
+                                       ParticleGrid(size, margin = halo, counts = shared_food),
+                                       ParticleGrid(size, margin = halo, counts = shared_keys)))
+
+        # tiles stepped together, by column and row parity
+        phases = [[t for t in self.tiles if (t.column % 2, t.row % 2) == parity]
+                  for parity in ((0, 0), (1, 0), (0, 1), (1, 1))]
+        self.phases = [phase for phase in phases if phase]
+
+        self.population = TiledPopulation(self)
+        self.immigrate(record(c) for c in descendants)
+
+        # the meals, births and deaths of the last step, counted by the
+        # workers (which keep the particle changes)
+        self.events = {}
+
+        self.new_food_callback = None
+        self.del_food_callback = None
+        self.new_key_callback = None
+        self.del_key_callback = None
+
+    @property
+    def creatures(self):
+        return self.population
+
+    @property
+    def index(self):
+        "the creatures of the current step, in a CreatureIndex built on demand"
+        if self.population.index is None:
+            self.population.index = CreatureIndex(self.size, self.population)
+        return self.population.index
+
+    @property
+    def statistics(self):
+        return TiledStatistics(self.tiles)
+
+    def tile(self, position):
+        "return the tile that owns a position (clamped to the environment)"
+        x = min(max(position[0], 0), self.size[0])
+        y = min(max(position[1], 0), self.size[1])
+        column = x * self.grid[0] / (self.size[0] + 1)
+        row = y * self.grid[1] / (self.size[1] + 1)
+        return self.tiles[column * self.grid[1] + row]
+
+    def immigrate(self, records):
+        "send creature records to the workers of the tiles that own them"
+        arrivals = dict((tile, []) for tile in self.tiles)
+        for r in records:
+            arrivals[self.tile(r[2])].append(r)
+            self.reach = max(self.reach, reach(r[0]))
+        for tile, records in arrivals.iteritems():
+            if records:
+                tile.population += len(records)
+                tile.connection.send(('immigrate', records))
+        self.population = TiledPopulation(self)
+
+    def populate(self, amount, energy):
+        "add an amount of ancestors, at random positions, with some energy"
+        self.immigrate([record(ancestor((self.random.randint(0, self.size[0]),
+                                         self.random.randint(0, self.size[1])),
+                                        energy, self.random))
+                        for i in xrange(amount)])
+
+    def configure(self, name, value):
+        "change a parameter of every worker's zoo"
+        for tile in self.tiles:
+            tile.connection.send(('set', name, value))
+
+    @property
+    def wrap_horizontal(self):
+        return self._wrap_horizontal
+
+    @wrap_horizontal.setter
+    def wrap_horizontal(self, value):
+        check_wrap(self.grid, value, self._wrap_vertical)
+        self._wrap_horizontal = value
+        self.configure('wrap_horizontal', value)
+
+    @property
+    def wrap_vertical(self):
+        return self._wrap_vertical
+
+    @wrap_vertical.setter
+    def wrap_vertical(self, value):
+        check_wrap(self.grid, self._wrap_horizontal, value)
+        self._wrap_vertical = value
+        self.configure('wrap_vertical', value)
+
+    def step(self):
+        """
+        Perform one step of the simulation: step the tiles, phases of
+        non-adjacent tiles in parallel (or one at a time, while a creature
+        reaches beyond the halo), then migrate the creatures that left their
+        tiles.
+        """
+        phases = self.phases
+        if self.reach > self.halo:
+            phases = [[tile] for tile in self.tiles]
+        events = self.events = dict.fromkeys(('meals', 'births', 'deaths'), 0)
+        for phase in phases:
+            for tile in phase:
+                tile.connection.send(('step',))
+            for tile in phase:
+                food, keys, meals, births, deaths, tile.memory = tile.connection.recv()
+                self.food.total += food
+                self.keys.total += keys
+                events['meals'] += meals
+                events['births'] += births
+                events['deaths'] += deaths
+
+        emigrants = []
+        for tile in self.tiles:
+            tile.connection.send(('emigrate',))
+        self.reach = 0
+        for tile in self.tiles:
+            records, tile.population, furthest = tile.connection.recv()
+            emigrants.extend(records)
+            self.reach = max(self.reach, furthest)
+        self.immigrate(emigrants)
+        self.cycle += 1
+
+    def memory(self):
+        "return the resident memory of the workers, in bytes (None if unknown)"
+        memories = [tile.memory for tile in self.tiles]
+        if None in memories:
+            return None
+        return sum(memories)
+
+    def close(self):
+        "stop the worker processes"
+        for tile in self.tiles:
+            tile.connection.send(('stop',))
+        for tile in self.tiles:
+            tile.process.join()